@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Times every MACCHIATO stage on synthetic data and writes the results as JSON.
+
+Stages: loading the dtseries, parcellating them, every network matrix
+estimator (and the batch engine on the covariance family), sliding-window
+connectivity, graph theory metrics, time series metrics and the HDF5 write. Each stage reports wall and
+CPU seconds, scans/s, MB/s for the stages that read dense data, and the peak
+resident memory of the process once the stage is done. With --baseline, stage
+times are compared against an earlier JSON and the run fails when a stage got
+slower than --tolerance times its baseline.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --output benchmark.json --baseline benchmarks/baseline.json
+
+benchmarks/baseline.json is the stored reference: the default configuration
+(no size or metric options), run on the machine described by its "environment"
+entry. Timings only compare on similar hardware, so regenerate it on the machine
+regressions are checked on, and whenever a change is meant to alter a stage's cost:
+    python -m benchmarks.run_benchmarks --output benchmarks/baseline.json
+"""
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from benchmarks.synthetic_data import make_dataset
+from tools.batch_connectivity import COVARIANCE_METRICS, batch_network_matrices, stack_timeseries
+from tools.cifti_io import CiftiReader
+from tools.connectivity_metrics import NetworkIO, GraphTheoryIO, GRAPH_THEORY_METRICS
+from tools.dynamic_connectivity import sliding_window_matrices
+from tools.parcellation import ParcellationIO
+from tools.stage_timer import max_rss_mb
+from tools.tangent_space import TangentSpace
+from tools.timeseries_metrics import TimeSeriesIO, TIME_SERIES_METRICS
+from workflow.bids_index import bold_mtime
+from workflow.hdf5_output import HDF5Output, OUTPUT_COMPRESSIONS, OUTPUT_DTYPES, OUTPUT_LAYOUTS
+
+# stages shorter than this in the baseline are timer noise and never count as regressions
+MIN_COMPARED_SECONDS = 0.05
+
+NETWORK_METRICS = ['correlation','partial_correlation','covariance','precision','tangent',
+                   'sparse_inverse_covariance','sparse_inverse_precision','dynamic_time_warping']
+
+def time_stage(stages,name,function,n_scans,n_bytes=None):
+    '''
+    Runs function once and records its timings under stages[name]
+
+    Returns
+    -------
+    Whatever function returns
+    '''
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = function()
+    seconds = time.perf_counter() - wall_start
+    stage = {'seconds':seconds,
+             'cpu_seconds':time.process_time() - cpu_start,
+             'scans_per_second':n_scans/seconds if seconds > 0 else None,
+             'peak_rss_mb':max_rss_mb()}
+    if n_bytes is not None:
+        stage['mb_per_second'] = n_bytes/1024.0**2/seconds if seconds > 0 else None
+    stages[name] = stage
+    print('%-60s %10.3f s' % (name,seconds))
+    return result
+
+def estimate_network_metric(network_metric_inits,network_metric):
+    '''
+    Estimates one network metric for every scan from scratch, dropping the estimates
+    NetworkIO shares between metrics so every metric pays for its own
+    '''
+    if network_metric == 'tangent':
+        covariance = np.stack([init.estimate_empirical_covariance() for init in network_metric_inits])
+        return TangentSpace().fit(lambda: iter([covariance])).transform(covariance)
+    matrices = []
+    for network_metric_init in network_metric_inits:
+        network_metric_init.empirical_covariance = None
+        network_metric_init.network_matrices = {}
+        matrices.append(network_metric_init.create_network_matrix(network_metric))
+    return np.stack(matrices)
+
+def write_hdf5(output_file,dtseries_files,network_matrices,parcellation,layout,dtype,compression):
+    bolds = list(dtseries_files)
+    output = HDF5Output(output_file,bolds,[bold_mtime(bold) for bold in bolds],list(network_matrices),
+                        parcellation.parcel_count,parcellation.parcel_count,parcellation.parcel_file,'synthetic',
+                        'synthetic',layout=layout,dtype=dtype,compression=compression)
+    try:
+        tasks = [(i,tuple(network_matrices)) for i in range(len(bolds))]
+        output.filter_tasks(tasks,[1.0]*len(tasks))
+        for i in range(len(bolds)):
+            output.write_network_matrices((i,),dict((m,matrices[i:i+1]) for m, matrices in network_matrices.items()))
+    finally:
+        output.close()
+    return os.path.getsize(output_file)
+
+def run_benchmarks(args):
+    data_dir = args.data_dir or os.path.join(tempfile.gettempdir(),'MACCHIATO_benchmarks')
+    work_dir = tempfile.mkdtemp(prefix='MACCHIATO_benchmark_outputs_')
+    print('Generating synthetic data in %s' % data_dir)
+    label_file, dtseries_files = make_dataset(data_dir,args.scans,args.grayordinates,args.timepoints,args.parcels)
+    n_scans = len(dtseries_files)
+    dense_bytes = n_scans*args.timepoints*args.grayordinates*4
+    stages = {}
+    try:
+        time_stage(stages,'load',lambda: [CiftiReader(f).read(slice(None)) for f in dtseries_files],n_scans,dense_bytes)
+        parcellation = time_stage(stages,'parcellation_setup',lambda: ParcellationIO(label_file),0)
+        parcellated = time_stage(stages,'parcellate',lambda: [parcellation.parcellate_reader(CiftiReader(f)) for f in dtseries_files],
+                                 n_scans,dense_bytes)
+        network_metric_inits = [NetworkIO(output_dir=work_dir,cifti_data=f,parcel_file=label_file,parcel_name='synthetic',
+                                          network_metric='correlation',fishers_r_to_z_transform='NO',
+                                          parcellation_cache_dir=work_dir,n_jobs=args.n_jobs) for f in dtseries_files]
+        network_matrices = {}
+        for network_metric in args.network_metrics:
+            network_matrices[network_metric] = time_stage(stages,'estimator/' + network_metric,
+                                                          lambda: estimate_network_metric(network_metric_inits,network_metric),n_scans)
+        covariance_metrics = [m for m in args.network_metrics if m in COVARIANCE_METRICS]
+        if covariance_metrics:
+            stack, lengths = stack_timeseries(parcellated)
+            time_stage(stages,'estimator/batch_covariance_family',
+                       lambda: batch_network_matrices(stack,covariance_metrics,'NO',lengths=lengths),n_scans)
+        if args.window_length:
+            time_stage(stages,'dynamic_connectivity',
+                       lambda: [sliding_window_matrices(ts,['correlation'],args.window_length,args.window_step) for ts in parcellated],n_scans)
+        if args.graph_theory_metrics:
+            if not 'correlation' in network_matrices:
+                network_matrices['correlation'] = estimate_network_metric(network_metric_inits,'correlation')
+            for graph_theory_metric in args.graph_theory_metrics:
+                time_stage(stages,'graph_theory/' + graph_theory_metric,
+                           lambda: [GraphTheoryIO(matrix,[graph_theory_metric],args.graph_theory_density).create_graph_theory_vectors()
+                                    for matrix in network_matrices['correlation']],n_scans)
+        for time_series_metric in args.time_series_metrics:
+            time_stage(stages,'time_series/' + time_series_metric,
+                       lambda: [TimeSeriesIO(work_dir,f,time_series_metric,parcellation,'synthetic',n_jobs=args.n_jobs).time_series_data
+                                for f in dtseries_files],n_scans)
+        if network_matrices:
+            for layout in args.output_layouts:
+                output_file = os.path.join(work_dir,'benchmark_%s.hdf5' % layout)
+                stage_name = 'hdf5_write/%s_%s_%s' % (layout,args.output_dtype,args.output_compression)
+                size = time_stage(stages,stage_name,
+                                  lambda: write_hdf5(output_file,dtseries_files,network_matrices,parcellation,layout,
+                                                     args.output_dtype,args.output_compression),n_scans)
+                stages[stage_name]['file_mb'] = size/1024.0**2
+                stages[stage_name]['mb_per_second'] = size/1024.0**2/stages[stage_name]['seconds']
+    finally:
+        shutil.rmtree(work_dir,ignore_errors=True)
+    return {'config':{'scans':args.scans,'grayordinates':args.grayordinates,'timepoints':args.timepoints,
+                      'parcels':args.parcels,'n_jobs':args.n_jobs,'network_metrics':args.network_metrics,
+                      'window_length':args.window_length,'window_step':args.window_step,
+                      'graph_theory_metrics':args.graph_theory_metrics,'time_series_metrics':args.time_series_metrics},
+            'environment':{'python':platform.python_version(),'numpy':np.__version__,'platform':platform.platform(),
+                           'cpu_count':os.cpu_count()},
+            'stages':stages,
+            'peak_rss_mb':max_rss_mb()}
+
+def compare_with_baseline(results,baseline,tolerance):
+    '''
+    Prints the time of every stage relative to the baseline
+
+    Returns
+    -------
+    list
+        Stages that took more than tolerance times their baseline time, ignoring stages
+        shorter than MIN_COMPARED_SECONDS in the baseline
+    '''
+    if baseline.get('config') != results['config']:
+        print('Warning: the baseline was run with a different configuration: %s' % baseline.get('config'))
+    regressions = []
+    print('\n%-60s %10s %10s %8s' % ('stage','baseline','seconds','ratio'))
+    for name, stage in results['stages'].items():
+        baseline_stage = baseline['stages'].get(name)
+        if baseline_stage is None or not baseline_stage['seconds']:
+            print('%-60s %10s %10.3f' % (name,'-',stage['seconds']))
+            continue
+        ratio = stage['seconds']/baseline_stage['seconds']
+        flag = ''
+        if ratio > tolerance and baseline_stage['seconds'] >= MIN_COMPARED_SECONDS:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('%-60s %10.3f %10.3f %8.2f%s' % (name,baseline_stage['seconds'],stage['seconds'],ratio,flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks MACCHIATO stages on synthetic dtseries/dlabel pairs.')
+    parser.add_argument('--scans', help='Number of synthetic scans. ',type=int,default=4)
+    parser.add_argument('--grayordinates', help='Grayordinates per scan. ',type=int,default=91282)
+    parser.add_argument('--timepoints', help='Timepoints per scan. ',type=int,default=400)
+    parser.add_argument('--parcels', help='Parcels of the synthetic label file. ',type=int,default=100)
+    parser.add_argument('--network_metrics', help='Network matrix estimators to time. ',choices=NETWORK_METRICS,nargs='+',default=NETWORK_METRICS)
+    parser.add_argument('--graph_theory_metrics', help='Graph theory metrics to time on the correlation matrices. ',
+                        choices=GRAPH_THEORY_METRICS,nargs='*',default=GRAPH_THEORY_METRICS)
+    parser.add_argument('--graph_theory_density', help='Fraction of the strongest connections kept before graph theory metrics. ',type=float)
+    parser.add_argument('--window_length', help='Frames per sliding window of the dynamic connectivity stage, 0 skips it. ',type=int,default=60)
+    parser.add_argument('--window_step', help='Frames between sliding windows. ',type=int,default=5)
+    parser.add_argument('--time_series_metrics', help='Time series metrics to time, per parcel. ',choices=TIME_SERIES_METRICS,nargs='*',default=TIME_SERIES_METRICS)
+    parser.add_argument('--output_layouts', help='HDF5 layouts whose writes are timed. ',choices=OUTPUT_LAYOUTS,nargs='+',default=OUTPUT_LAYOUTS)
+    parser.add_argument('--output_dtype', help='Precision of the HDF5 writes. ',choices=list(OUTPUT_DTYPES),default='float32')
+    parser.add_argument('--output_compression', help='Compression of the HDF5 writes. ',choices=OUTPUT_COMPRESSIONS,default='none')
+    parser.add_argument('--n_jobs', help='Workers within an estimator. ',type=int,default=1)
+    parser.add_argument('--data_dir', help='Where synthetic data is generated, and reused by later runs of the same size. Defaults to a folder in the temporary directory. ')
+    parser.add_argument('--output', help='JSON file the results are written to. ')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against, e.g. the stored benchmarks/baseline.json of the default configuration. ')
+    parser.add_argument('--tolerance', help='Slowdown relative to the baseline above which a stage counts as a regression. ',type=float,default=1.5)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output,'w') as output_file:
+            json.dump(results,output_file,indent=2)
+    else:
+        print(json.dumps(results,indent=2))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_with_baseline(results,json.load(baseline_file),args.tolerance)
+        if regressions:
+            print('Stages slower than %.2f x baseline: %s' % (args.tolerance,regressions))
+            sys.exit(1)
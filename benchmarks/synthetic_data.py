@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic dense timeseries and label files for benchmarking MACCHIATO stages
+without HCP/ABCD data or Workbench.
+
+Grayordinates are split between the left and right cortical surfaces and
+assigned to contiguous parcels. Every scan mixes a few latent networks into
+parcel signals and adds grayordinate noise, so the parcellated timeseries
+have a well conditioned, non-trivial covariance like real data.
+"""
+import nibabel
+from nibabel.cifti2 import cifti2_axes
+import numpy as np
+import os
+
+# number of latent networks mixed into the parcel signals
+LATENT_NETWORKS = 7
+
+def brain_model_axis(n_grayordinates):
+    left = n_grayordinates//2
+    return (cifti2_axes.BrainModelAxis.from_mask(np.ones(left,dtype=bool),name='CortexLeft') +
+            cifti2_axes.BrainModelAxis.from_mask(np.ones(n_grayordinates-left,dtype=bool),name='CortexRight'))
+
+def parcel_keys(n_grayordinates,n_parcels):
+    '''
+    Label key, 1 to n_parcels, of every grayordinate: contiguous parcels of (nearly) equal size
+    '''
+    return 1 + np.arange(n_grayordinates)*n_parcels//n_grayordinates
+
+def make_label_file(label_file,n_grayordinates,n_parcels):
+    '''
+    Writes a dlabel file of the parcels of parcel_keys
+
+    Returns
+    -------
+    numpy array
+        Label key of every grayordinate
+    '''
+    keys = parcel_keys(n_grayordinates,n_parcels)
+    labels = {0:('???',(0.0,0.0,0.0,0.0))}
+    labels.update((key,('parcel_%d' % key,(1.0,1.0,1.0,1.0))) for key in range(1,n_parcels+1))
+    label_axis = cifti2_axes.LabelAxis(['parcels'],[labels])
+    nibabel.Cifti2Image(keys[None].astype(np.float32),(label_axis,brain_model_axis(n_grayordinates))).to_filename(label_file)
+    return keys
+
+def make_dtseries(dtseries_file,keys,n_timepoints,TR=0.8,seed=0):
+    '''
+    Writes a timepoints x grayordinates dtseries: latent networks mixed into the parcels
+    of keys, plus independent grayordinate noise
+    '''
+    rng = np.random.RandomState(seed)
+    n_parcels = keys.max()
+    latent = rng.standard_normal((n_timepoints,LATENT_NETWORKS)).dot(rng.standard_normal((LATENT_NETWORKS,n_parcels)))
+    parcel_signal = latent + rng.standard_normal((n_timepoints,n_parcels))
+    dense = parcel_signal[:,keys-1].astype(np.float32)
+    dense += rng.standard_normal(dense.shape).astype(np.float32)
+    series_axis = cifti2_axes.SeriesAxis(0,TR,n_timepoints,unit='SECOND')
+    nibabel.Cifti2Image(dense,(series_axis,brain_model_axis(keys.shape[0]))).to_filename(dtseries_file)
+
+def make_dataset(data_dir,n_scans,n_grayordinates,n_timepoints,n_parcels):
+    '''
+    Writes (or reuses) a label file and n_scans dtseries of the given size in data_dir
+
+    Returns
+    -------
+    label_file : string
+    dtseries_files : list
+    '''
+    prefix = os.path.join(data_dir,'g%d_t%d' % (n_grayordinates,n_timepoints))
+    label_file = os.path.join(data_dir,'g%d_p%d.dlabel.nii' % (n_grayordinates,n_parcels))
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    if os.path.isfile(label_file):
+        keys = parcel_keys(n_grayordinates,n_parcels)
+    else:
+        keys = make_label_file(label_file,n_grayordinates,n_parcels)
+    dtseries_files = []
+    for scan in range(n_scans):
+        dtseries_file = '%s_p%d_scan%d.dtseries.nii' % (prefix,n_parcels,scan)
+        if not os.path.isfile(dtseries_file):
+            make_dtseries(dtseries_file,keys,n_timepoints,seed=scan)
+        dtseries_files.append(dtseries_file)
+    return label_file, dtseries_files
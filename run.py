@@ -7,20 +7,19 @@ Created on Fri Oct 23 16:49:56 2020
 """
 
 import argparse
-from argunparse  import ArgumentUnparser #https://github.com/mbdevpl/argunparse
 import json
 import os
+import subprocess
 import sys
 
 sys.path.append(os.path.realpath(__file__))
-from workflow.core import MACCHIATO_setup
 
 
 # specify arguments that MACCHIATO accepts
 parser = argparse.ArgumentParser(description='')
 parser.add_argument('input_dir', help='The directory where the preprocessed derivative needed live')
 parser.add_argument('output_dir', help='The directory where the output files should be stored.')
-parser.add_argument('analysis_level', choices=['participant'],help='Processing stage to be run, only "participant" in this case (see BIDS-Apps specification).')
+parser.add_argument('analysis_level', choices=['participant','group'],help='Processing stage to be run (see BIDS-Apps specification). "group" runs the participant level and also writes the edge-wise count, mean, variance, percentiles and consensus of every network metric over the cohort, as group/<network metric>/<statistic> datasets of the HDF5 output.')
 parser.add_argument('--participant_label', help='The label of the participant that should be analyzed. The label '
                    'corresponds to sub-<participant_label> from the BIDS spec '
                    '(so it does not include "sub-"). If this parameter is not '
@@ -36,33 +35,65 @@ parser.add_argument('--preprocessing_type', help='BIDS-apps preprocessing pipeli
 parser.add_argument('--use_denoised_outputs',help='Use denoised (whether FIX, AROMA, or scrubbed depending on pipeline) outputs for network matrix estimation. Choices include "Y/yes" or "N/no".',choices=['Yes','yes','No','no'],default='Yes')
 parser.add_argument('--combine_resting_scans',help='If multiple of the same resting state BIDS file type exist should they be combined? Choices include "Y/yes" or "N/no".',choices=['Yes','yes','No','no'],default='No')
 parser.add_argument('--parcellation_file', help='The CIFTI label file to use or used to parcellate the brain. ', required=True)
+parser.add_argument('--parcellation_engine', help='How dense timeseries are parcellated. "numpy" averages grayordinates in-process, "workbench" calls wb_command -cifti-parcellate. ',choices=['numpy','workbench'],default='numpy')
 parser.add_argument('--parcellation_name', help='Shorthand name of the CIFTI label file. ', required=True)
 parser.add_argument('--reg_name',help='What type of registration do you want to use (relevant to HCP outputs only!)? Choices are "MSMAll_2_d40_WRN" and "NONE"',choices = ['NONE','MSMAll_2_d40_WRN'],default='MSMAll_2_d40_WRN')
 parser.add_argument('--apply_Fishers_r_to_z_transform', help="For correlation outputs, should Fisher's r-to-z transformation be applied? Choises are 'Yes' or 'No'.", choices = ['YES','NO'],default='YES')
 parser.add_argument('--network_matrix_calculation', help="What method to employ for network matrix estimation. "
                                                     " Choices are 'All', 'correlation','partial_correlation', "
                                                     " 'dynamic_time_warping', 'tangent', 'covariance', 'sparse_inverse_covariance', "
-                                                    "  'precision', 'sparse_inverse_precision'. NOTE: Specifying sparse matrices or dynamic time warping will result in increased computation time. For more information on available methods https://nilearn.github.io/connectivity/index.html#functional-connectivity-and-resting-state", 
+                                                    "  'precision', 'sparse_inverse_precision'. NOTE: Specifying sparse matrices or dynamic time warping will result in increased computation time. 'tangent' is estimated against the geometric mean covariance of all processed bolds and also writes the covariance matrices. For more information on available methods https://nilearn.github.io/connectivity/index.html#functional-connectivity-and-resting-state", 
                                                     choices =['All','correlation','partial_correlation',
-                                                              'dynamic_time_warping','covariance',
+                                                              'dynamic_time_warping','tangent','covariance',
                                                               'precision','sparse_inverse_precision',
                                                               'sparse_inverse_covariance'], default='correlation',nargs='+')
-parser.add_argument('--num_cpus', help='How many concurrent CPUs to use',default=1)
+parser.add_argument('--graph_theory_metric', help="Graph theory metrics computed from every network matrix and written next to it. "
+                                              " Choices are 'All', 'strength', 'eigenvector_centrality', 'clustering_coefficient', "
+                                              " 'local_efficiency', 'node_betweenness_centrality', 'edge_betweenness_centrality'. ",
+                                              choices=['All','strength','eigenvector_centrality','clustering_coefficient',
+                                                       'local_efficiency','node_betweenness_centrality','edge_betweenness_centrality'],nargs='+')
+parser.add_argument('--graph_theory_density', help='Fraction of the strongest connections of every network matrix kept (proportional thresholding) before graph theory metrics are computed. All connections are kept by default. ',type=float)
+parser.add_argument('--time_series_metric', help="Time series metrics computed from every bold, written as scalar CIFTI files and to the HDF5 output. "
+                                             " Choices are 'alff' (amplitude of low frequency fluctuations, 0.01-0.08 Hz), 'falff' (fractional ALFF), "
+                                             " 'wavelet' (parcel correlation matrices at six maximal overlap wavelet scales), 'sample_entropy' "
+                                             " and 'multiscale_entropy' (sample entropy at five coarse graining scales). ",
+                                             choices=['alff','falff','wavelet','sample_entropy','multiscale_entropy'],nargs='+')
+parser.add_argument('--time_series_space', help='Compute ALFF, fALFF and entropies from the parcellated timeseries ("parcels", pscalar outputs) or for every grayordinate ("grayordinates", dscalar outputs). ',choices=['parcels','grayordinates'],default='parcels')
+parser.add_argument('--fd_threshold', help='Framewise displacement thresholds in mm. Frames above a threshold are censored and correlation, partial correlation, covariance and precision are also estimated from the kept frames, one "censored/fd_<threshold>" group per threshold. FD is computed from the movement regressors next to every bold. ',type=float,nargs='+')
+parser.add_argument('--dvars_censoring', help='Also censor frames whose DVARS is an outlier (above the 75th percentile + 1.5 x the interquartile range) at every FD threshold. Choices include "Y/yes" or "N/no".',choices=['Yes','yes','No','no'],default='No')
+parser.add_argument('--output_layout', help='Store every parcels x parcels matrix whole ("full") or as its upper triangle, diagonal included ("upper_triangle"), which halves the HDF5 output. Use workflow.hdf5_output.NetworkMatrixReader to read either layout back as full matrices. ',choices=['full','upper_triangle'],default='full')
+parser.add_argument('--output_dtype', help='Precision of the matrices and vectors stored in the HDF5 output. float16 keeps about three significant digits and stores values above 65504 as inf, so it is lossy for unnormalised metrics such as covariance and precision. With "tangent", covariance and precision are stored as float32. ',choices=['float32','float16'],default='float32')
+parser.add_argument('--output_compression', help='Compression of the per-bold chunks of the HDF5 output. "blosc" needs the hdf5plugin package. Parallel HDF5 (the mpi backend) writes uncompressed outputs. ',choices=['none','gzip','lzf','blosc'],default='none')
+parser.add_argument('--trace_file', help='Optional path of a Chrome trace (JSON, open in chrome://tracing or ui.perfetto.dev) of the wall time of every stage, per bold and per rank. The timings are always stored in the "timings" table of the HDF5 output. Its max_rss_mb column is the peak memory of the process up to the end of the stage, not the memory of the stage alone. ')
+parser.add_argument('--dynamic_connectivity', help='Sliding-window network matrices of every bold, "correlation" and/or "covariance", stored as dynamic/<network metric> datasets of bolds x windows x upper triangle edges. Windows are updated frame by frame rather than estimated from scratch and never span combined runs. ',choices=['correlation','covariance'],nargs='+')
+parser.add_argument('--window_length', help='Frames per sliding window. ',type=int,default=60)
+parser.add_argument('--window_step', help='Frames between the starts of consecutive sliding windows. ',type=int,default=5)
+parser.add_argument('--window_taper', help='Weighting of the frames within a sliding window: equal weights ("none") or weights decaying exponentially with the distance to the end of the window ("exponential"). ',choices=['none','exponential'],default='none')
+parser.add_argument('--dynamic_states', help='Optional number of connectivity states the sliding windows are clustered into with online k-means, the state of every window is stored as dynamic_states/<network metric>. ',type=int)
+parser.add_argument('--plan_only', help='Print the tasks of the run and their estimated cost, then exit without computing or writing anything. Runs in this process whatever the backend. Choices include "Y/yes" or "N/no".',choices=['Yes','yes','No','no'],default='No')
+parser.add_argument('--num_cpus',help='How many concurrent CPUs to use',default=1)
+parser.add_argument('--resume', help='Continue the most recent HDF5 output in the output folder, computing only bolds and metrics that are not in it yet. Choices include "Y/yes" or "N/no".',choices=['Yes','yes','No','no'],default='No')
+parser.add_argument('--batch_size', help='Number of bolds whose correlation, partial correlation, covariance and precision matrices are estimated together as one stacked array.',type=int,default=1)
+parser.add_argument('--estimator_n_jobs', help='Number of workers used inside one estimator, e.g. the parcel pairs of dynamic time warping. ',type=int,default=1)
+parser.add_argument('--dtw_window', help='Sakoe-Chiba band of dynamic time warping, as a fraction of the number of timepoints. ',type=float,default=0.1)
+parser.add_argument('--sparse_alpha', help='Fixed graphical lasso regularization for the sparse metrics, used for the whole cohort instead of cross-validating every bold. ',type=float)
+parser.add_argument('--backend', help='How work is parallelized. "mpi" runs through mpiexec and parallel HDF5, "processes" and "threads" run a local pool of "--num_cpus" workers, "serial" runs in this process.',choices=['mpi','processes','threads','serial'],default='mpi')
 args = parser.parse_args()
+args_dict = {'--'+key: value for key, value in vars(args).items() if value is not None}
 
-# unparse arguments to feed into main workflow
-kwargs = vars(parser.parse_args())
-unparser = ArgumentUnparser()
-arg_string = unparser.unparse(**kwargs)
-
-#mpiexec -n numprocs python -m mpi4py -m mod [arg] ..
-
-if args.participant_label:
-    if len(args.participant_label) > 1:
-        os.system('mpiexec -n {cpus} python -m mpi4py -m workflow.core {args}'.format(cpus=str(args.num_cpus),args=arg_string))
-    else:
-        print('You specified running an individual participant, but set the "--num_cpus" greater than 1. Reverting back to "--num_cpus"=1...')
-        args.num_cpus=1
-        os.system('mpiexec -n 1 python -m mpi4py -m workflow.core {args}'.format(args=arg_string))
+if args.backend != 'mpi' or args.plan_only in ['Yes','yes']:
+    # local backends run in this process, no mpiexec or MPI-enabled h5py needed
+    from workflow.core import MACCHIATO_setup
+    MACCHIATO_setup(args_dict)
 else:
-    os.system('mpiexec -n {cpus} python -m mpi4py -m workflow.core {args}'.format(cpus=str(args.num_cpus),args=arg_string))
\ No newline at end of file
+    if args.participant_label and len(args.participant_label) == 1:
+        print('You specified running an individual participant, but set the "--num_cpus" greater than 1. Reverting back to "--num_cpus"=1...')
+        args.num_cpus = 1
+    # the parsed arguments reach every rank as a JSON file instead of being unparsed into a command line
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    arguments_file = os.path.join(args.output_dir,'MACCHIATO_arguments.json')
+    with open(arguments_file,'w') as f:
+        json.dump(args_dict,f,indent=2)
+    #mpiexec -n numprocs python -m mpi4py -m mod [arg] ..
+    subprocess.call(['mpiexec','-n',str(args.num_cpus),'python','-m','mpi4py','-m','workflow.core',arguments_file])
\ No newline at end of file
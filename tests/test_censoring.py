@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Network matrices of heavily censored bolds: fewer kept frames than parcels must
+give NaN precision and partial correlation without failing the rest of a batch.
+"""
+from types import SimpleNamespace
+import warnings
+
+import numpy as np
+import pytest
+
+from tools.batch_connectivity import RunningCovariance, batch_network_matrices, batch_precision
+from tools.connectivity_metrics import NetworkIO
+from workflow.core import censored_network_matrices
+
+N_PARCELS = 12
+CENSORED_METRICS = ['correlation','partial_correlation','covariance','precision']
+
+def censored_network_io(frames_kept,seed=0):
+    '''
+    A NetworkIO with only the attributes masked_covariance needs, censored at FD 0.3
+    '''
+    network_io = SimpleNamespace(fmriname='sub-01_task-rest',parcellation=SimpleNamespace(parcel_count=N_PARCELS),
+                                 censored_covariances={},censored_frames={},censored_invertible={})
+    running_covariance = RunningCovariance(N_PARCELS)
+    running_covariance.update(np.random.RandomState(seed).randn(frames_kept,N_PARCELS))
+    NetworkIO.masked_covariance(network_io,0.3,running_covariance)
+    return network_io
+
+def test_batch_precision_singular_scan():
+    random_state = np.random.RandomState(0)
+    timeseries = random_state.randn(200,N_PARCELS)
+    covariance = np.stack([np.cov(timeseries,rowvar=False),np.zeros((N_PARCELS,N_PARCELS))])
+    precision = batch_precision(covariance)
+    assert np.allclose(precision[0],np.linalg.inv(covariance[0]))
+    assert np.isnan(precision[1]).all()
+
+@pytest.mark.parametrize('frames_kept',[0,1,3,5,N_PARCELS])
+def test_heavy_censoring(frames_kept):
+    network_ios = [censored_network_io(160,seed=1),censored_network_io(frames_kept,seed=2)]
+    names = ['censored/fd_0.3/' + network_metric for network_metric in CENSORED_METRICS]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error',RuntimeWarning)
+        matrices = censored_network_matrices(network_ios,names,'NO')
+    assert list(matrices['censored/fd_0.3/frames_kept']) == [160,frames_kept]
+    # the well sampled bold of the batch is unaffected
+    expected = batch_network_matrices(None,CENSORED_METRICS,covariance=network_ios[0].censored_covariances[0.3][None])
+    for network_metric in CENSORED_METRICS:
+        assert np.allclose(matrices['censored/fd_0.3/' + network_metric][0],expected[network_metric][0])
+    off_diagonal = ~np.eye(N_PARCELS,dtype=bool)
+    assert np.isnan(matrices['censored/fd_0.3/precision'][1]).all()
+    assert np.isnan(matrices['censored/fd_0.3/partial_correlation'][1][off_diagonal]).all()
+    correlation = matrices['censored/fd_0.3/correlation'][1][off_diagonal]
+    if frames_kept < 2:
+        assert np.isnan(correlation).all()
+    else:
+        assert (np.abs(correlation) <= 1 + 1e-9).all()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The in-process parcellation against an explicit per-label mean of a small
+synthetic dlabel/dtseries pair, and against wb_command when it is installed.
+"""
+import os
+
+import nibabel
+from nibabel.cifti2 import cifti2_axes
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_data import brain_model_axis
+from tools.cifti_io import CiftiReader
+from tools.parcellation import WORKBENCH_COMMAND, ParcellationIO, compare_with_workbench
+
+N_GRAYORDINATES = 200
+N_TIMEPOINTS = 30
+# key 4 has no grayordinate and is dropped, key 0 is the unlabelled ??? key
+LABEL_KEYS = [1,2,3,4,7]
+
+@pytest.fixture
+def synthetic_cifti(tmp_path):
+    '''
+    Label file with interleaved, unequal parcels and unlabelled grayordinates, and a dtseries
+    '''
+    random_state = np.random.RandomState(0)
+    keys = random_state.choice([0,1,2,3,7],size=N_GRAYORDINATES,p=[0.1,0.4,0.2,0.05,0.25])
+    labels = {0:('???',(0.0,0.0,0.0,0.0))}
+    labels.update((key,('parcel_%d' % key,(1.0,1.0,1.0,1.0))) for key in LABEL_KEYS)
+    label_file = str(tmp_path / 'synthetic.dlabel.nii')
+    nibabel.Cifti2Image(keys[None].astype(np.float32),
+                        (cifti2_axes.LabelAxis(['parcels'],[labels]),brain_model_axis(N_GRAYORDINATES))).to_filename(label_file)
+    dense = random_state.standard_normal((N_TIMEPOINTS,N_GRAYORDINATES)).astype(np.float32)
+    dtseries_file = str(tmp_path / 'synthetic.dtseries.nii')
+    nibabel.Cifti2Image(dense,(cifti2_axes.SeriesAxis(0,0.8,N_TIMEPOINTS,unit='SECOND'),
+                               brain_model_axis(N_GRAYORDINATES))).to_filename(dtseries_file)
+    return label_file, dtseries_file, keys, dense
+
+def test_parcellation_matches_label_means(synthetic_cifti):
+    label_file, dtseries_file, keys, dense = synthetic_cifti
+    parcellation = ParcellationIO(label_file)
+    present = [key for key in LABEL_KEYS if (keys == key).any()]
+    assert parcellation.parcel_labels == ['parcel_%d' % key for key in present]
+    expected = np.stack([dense[:,keys == key].mean(axis=1) for key in present],axis=1)
+    assert np.allclose(parcellation.parcellate(dense),expected,atol=1e-6)
+    # chunked streaming from the file gives the same timeseries
+    assert np.allclose(parcellation.parcellate_reader(CiftiReader(dtseries_file)),expected,atol=1e-6)
+
+@pytest.mark.skipif(not os.path.isfile(WORKBENCH_COMMAND),reason='wb_command is not installed')
+def test_parcellation_matches_workbench(synthetic_cifti,tmp_path):
+    label_file, dtseries_file, keys, dense = synthetic_cifti
+    assert compare_with_workbench(dtseries_file,label_file,str(tmp_path)) < 1e-5
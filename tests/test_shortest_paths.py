@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Node and edge betweenness of tools.shortest_paths against bct on reference matrices.
+"""
+import bct
+import numpy as np
+import pytest
+
+from tools.shortest_paths import betweenness, check_against_bct, proportional_threshold
+
+N_PARCELS = 20
+
+def random_weights(seed=0):
+    random_state = np.random.RandomState(seed)
+    weights = np.abs(random_state.standard_normal((N_PARCELS,N_PARCELS)))
+    weights = (weights + weights.T)/2
+    np.fill_diagonal(weights,0)
+    return weights
+
+def tied_weights():
+    '''
+    Integer weights give integer lengths, so many shortest paths have equal length
+    '''
+    weights = np.random.RandomState(1).randint(1,3,size=(N_PARCELS,N_PARCELS)).astype(float)
+    weights = np.triu(weights,1)
+    return weights + weights.T
+
+def disconnected_weights():
+    '''
+    Two components and an isolated parcel
+    '''
+    weights = random_weights(2)
+    half = N_PARCELS//2
+    weights[:half,half:] = 0
+    weights[half:,:half] = 0
+    weights[-1,:] = 0
+    weights[:,-1] = 0
+    return weights
+
+REFERENCE_MATRICES = [('random',random_weights(),None),
+                      ('ties',tied_weights(),None),
+                      ('disconnected',disconnected_weights(),None),
+                      ('density_0.1',random_weights(3),0.1),
+                      ('density_0.3',random_weights(4),0.3),
+                      ('ties_density_0.2',tied_weights(),0.2)]
+
+@pytest.mark.parametrize('name,network_matrix,density',REFERENCE_MATRICES,ids=[name for name, matrix, density in REFERENCE_MATRICES])
+def test_betweenness_matches_bct(name,network_matrix,density):
+    differences = check_against_bct(network_matrix,density)
+    assert differences['node_betweenness_centrality'] < 1e-8
+    assert differences['edge_betweenness_centrality'] < 1e-8
+
+@pytest.mark.parametrize('name,network_matrix,density',REFERENCE_MATRICES,ids=[name for name, matrix, density in REFERENCE_MATRICES])
+def test_node_betweenness_matches_betweenness_wei(name,network_matrix,density):
+    if density is not None:
+        network_matrix = proportional_threshold(network_matrix,density)
+    lengths = bct.weight_conversion(network_matrix,'lengths')
+    assert np.allclose(betweenness(lengths),bct.betweenness_wei(lengths),atol=1e-8)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched estimation of covariance derived network matrices.
+
+Parcellated timeseries of many scans are stacked into a
+(scans, timepoints, parcels) array, zero padded to the longest scan, and
+covariance, correlation, precision and partial correlation are computed for
+all of them with batched matmul and inverse calls. Padding is masked out, so
+each scan's estimate only uses its own timepoints.
+
+RunningCovariance accumulates the covariance of a concatenation of runs one
+run at a time, so combining runs does not hold all of them in memory.
+"""
+import numpy as np
+
+COVARIANCE_METRICS = ['correlation','partial_correlation','covariance','precision']
+
+def stack_timeseries(timeseries_list):
+    '''
+    Parameters
+    ----------
+    timeseries_list : list of numpy arrays
+        Timepoints x parcels timeseries, possibly of different lengths
+
+    Returns
+    -------
+    stack : numpy array
+        Scans x max timepoints x parcels array, zero padded
+    lengths : numpy array
+        Number of timepoints of every scan
+    '''
+    lengths = np.array([ts.shape[0] for ts in timeseries_list])
+    stack = np.zeros((len(timeseries_list),lengths.max(),timeseries_list[0].shape[1]))
+    for idx, ts in enumerate(timeseries_list):
+        stack[idx,:ts.shape[0],:] = ts
+    return stack, lengths
+
+def zscore(timeseries):
+    '''
+    Timepoints x parcels timeseries with every parcel centered and scaled to unit
+    variance, constant parcels are only centered
+    '''
+    centered = timeseries - timeseries.mean(axis=0)
+    std = centered.std(axis=0)
+    return centered/np.where(std > 0,std,1.0)
+
+class RunningCovariance:
+    def __init__(self,n_parcels):
+        '''
+        Empirical covariance of the concatenation of the timeseries passed to update,
+        merged run by run (Chan et al.), so only parcels x parcels sums are kept.
+
+        Parameters
+        ----------
+        n_parcels : int
+            Number of columns of every timeseries
+        '''
+        self.count = 0
+        self.mean = np.zeros(n_parcels)
+        self.sum_of_squares = np.zeros((n_parcels,n_parcels))
+
+    def update(self,timeseries):
+        '''
+        Adds a timepoints x parcels timeseries
+        '''
+        count = timeseries.shape[0]
+        if count == 0:
+            # e.g. a run with every frame censored
+            return self
+        mean = timeseries.mean(axis=0)
+        centered = timeseries - mean
+        delta = mean - self.mean
+        total = self.count + count
+        self.sum_of_squares += centered.T.dot(centered) + np.outer(delta,delta)*self.count*count/total
+        self.mean += delta*count/total
+        self.count = total
+        return self
+
+    def covariance(self):
+        '''
+        Maximum likelihood covariance, the same estimate as batch_covariance on the concatenation
+        '''
+        return self.sum_of_squares/self.count
+
+def batch_covariance(stack,lengths=None):
+    '''
+    Empirical (maximum likelihood) covariance of every scan in a stack, the same
+    estimate as sklearn's EmpiricalCovariance.
+
+    Parameters
+    ----------
+    stack : numpy array
+        Scans x timepoints x parcels
+    lengths : numpy array
+        Number of valid timepoints of every scan, the rest is padding
+
+    Returns
+    -------
+    numpy array
+        Scans x parcels x parcels
+    '''
+    if lengths is None:
+        lengths = np.full(stack.shape[0],stack.shape[1])
+    mask = (np.arange(stack.shape[1])[None,:] < lengths[:,None])[:,:,None]
+    mean = (stack*mask).sum(axis=1,keepdims=True)/lengths[:,None,None]
+    centered = (stack - mean)*mask
+    return np.matmul(centered.transpose(0,2,1),centered)/lengths[:,None,None]
+
+def batch_cov_to_corr(covariance):
+    '''
+    Scans x parcels x parcels covariance -> correlation, with an exact unit diagonal
+    '''
+    scale = 1.0/np.sqrt(np.diagonal(covariance,axis1=1,axis2=2))
+    correlation = covariance*scale[:,:,None]*scale[:,None,:]
+    diagonal = np.arange(covariance.shape[1])
+    correlation[:,diagonal,diagonal] = 1.0
+    return correlation
+
+def batch_precision(covariance,invertible=None):
+    '''
+    Scans x parcels x parcels inverse covariance. Scans that are not invertible, e.g. estimated
+    from fewer frames than parcels, and singular covariances are NaN, so one scan does not
+    fail the whole batch.
+    '''
+    if invertible is None:
+        invertible = np.ones(covariance.shape[0],dtype=bool)
+    precision = np.full(covariance.shape,np.nan)
+    try:
+        precision[invertible] = np.linalg.inv(covariance[invertible])
+    except np.linalg.LinAlgError:
+        for idx in np.flatnonzero(invertible):
+            try:
+                precision[idx] = np.linalg.inv(covariance[idx])
+            except np.linalg.LinAlgError:
+                pass
+    return precision
+
+def batch_prec_to_partial(precision):
+    partial_correlation = -batch_cov_to_corr(precision)
+    diagonal = np.arange(precision.shape[1])
+    partial_correlation[:,diagonal,diagonal] = 1.0
+    return partial_correlation
+
+def fisher_r_to_z_(matrices):
+    '''
+    In place Fisher r-to-z transform, the unit diagonal becomes inf
+    '''
+    with np.errstate(divide='ignore'):
+        np.arctanh(matrices,out=matrices)
+    return matrices
+
+def batch_network_matrices(stack,network_metrics,fishers_r_to_z_transform='NO',lengths=None,covariance=None,invertible=None):
+    '''
+    Parameters
+    ----------
+    stack : numpy array
+        Scans x timepoints x parcels parcellated timeseries, not used when covariance is given
+    network_metrics : list
+        Any of correlation, partial_correlation, covariance and precision
+    fishers_r_to_z_transform : [YES, NO]
+        Should Fisher's r-to-z transformation be applied to correlations?
+    lengths : numpy array
+        Number of valid timepoints of every scan
+    covariance : numpy array
+        Precomputed scans x parcels x parcels covariance, estimated from stack when None
+    invertible : numpy array
+        Boolean per scan, precision and partial correlation of the other scans are NaN.
+        All scans are inverted when None.
+
+    Returns
+    -------
+    network_matrices : dict
+        Network metric name -> scans x parcels x parcels array
+    '''
+    if covariance is None:
+        covariance = batch_covariance(stack,lengths)
+    network_matrices = {}
+    if 'covariance' in network_metrics:
+        network_matrices['covariance'] = covariance.copy()
+    if 'correlation' in network_metrics:
+        network_matrices['correlation'] = batch_cov_to_corr(covariance)
+        if fishers_r_to_z_transform == 'YES':
+            fisher_r_to_z_(network_matrices['correlation'])
+    if 'precision' in network_metrics or 'partial_correlation' in network_metrics:
+        precision = batch_precision(covariance,invertible)
+        if 'precision' in network_metrics:
+            network_matrices['precision'] = precision
+        if 'partial_correlation' in network_metrics:
+            network_matrices['partial_correlation'] = batch_prec_to_partial(precision)
+    return network_matrices
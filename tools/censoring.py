@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Motion censoring (scrubbing) of bolds before network matrix estimation.
+
+Framewise displacement (Power et al. 2012) is computed from the movement
+regressors stored next to every bold, and DVARS from the dense timeseries
+itself, streamed through tools.cifti_io.CiftiReader. A frame is censored when
+its FD exceeds the threshold, or when its DVARS is an outlier by the boxplot
+rule fsl_motion_outliers uses. Masks for several FD thresholds are derived
+from the same FD trace, so a sweep costs one parcellation per bold and one
+masked covariance per threshold.
+
+This replaces the fsl_motion_outliers calls of the former motion_confounds module.
+Unlike fsl_motion_outliers, DVARS is computed from the grayordinates of the
+dense CIFTI rather than the voxels of the volume timeseries, and FD is compared
+against the given --fd_threshold values rather than the boxplot rule, so the
+censored frames differ from its Movement_dvars.txt and Movement_fd.txt files.
+
+Censored matrices live in the HDF5 output as censored/fd_<threshold>/<network metric>.
+"""
+import numpy as np
+import os
+
+CENSORED_GROUP = 'censored'
+# radius of the sphere rotations are converted to displacements on, in mm
+FD_HEAD_RADIUS = 50.0
+# per-bold number of frames kept at a threshold, censored/fd_<threshold>/frames_kept
+FRAMES_KEPT = 'frames_kept'
+
+def censored_dataset(fd_threshold,network_metric):
+    return '/'.join([CENSORED_GROUP,'fd_%g' % fd_threshold,network_metric])
+
+def is_censored_dataset(name):
+    return name.startswith(CENSORED_GROUP + '/')
+
+def split_censored_dataset(name):
+    '''
+    censored/fd_<threshold>/<network metric> -> (threshold, network metric)
+    '''
+    group, threshold, network_metric = name.split('/')
+    return float(threshold[len('fd_'):]), network_metric
+
+def movement_regressors_file(bold):
+    '''
+    Movement regressors of a bold: Movement_Regressors.txt in the HCP (and ABCD) results
+    folder of the bold, or the fmriprep confounds tsv that shares the bold's entities
+    '''
+    bold_dir = os.path.dirname(bold)
+    hcp_file = os.path.join(bold_dir,'Movement_Regressors.txt')
+    if os.path.isfile(hcp_file):
+        return hcp_file
+    prefix = os.path.basename(bold).split('_space-')[0].split('_desc-')[0]
+    for f in sorted(os.listdir(bold_dir)):
+        if f.startswith(prefix) and 'confounds' in f and f.endswith('.tsv'):
+            return os.path.join(bold_dir,f)
+    raise ValueError('No movement regressors found for %s, censoring needs Movement_Regressors.txt or a fmriprep confounds file' % bold)
+
+def read_movement_regressors(movement_file):
+    '''
+    Returns
+    -------
+    numpy array
+        Timepoints x 6: translations in mm, then rotations in radians. HCP movement
+        regressors store rotations in degrees, fmriprep confounds in radians.
+    '''
+    if movement_file.endswith('.tsv'):
+        import pandas as pd
+        confounds = pd.read_csv(movement_file,sep='\t')
+        return confounds[['trans_x','trans_y','trans_z','rot_x','rot_y','rot_z']].to_numpy(dtype=float)
+    movement = np.loadtxt(movement_file,ndmin=2)[:,:6]
+    return np.hstack([movement[:,:3],np.deg2rad(movement[:,3:])])
+
+def framewise_displacement(movement,radius=FD_HEAD_RADIUS):
+    '''
+    Sum of the absolute frame to frame changes of the translations and of the rotations
+    as arc lengths on a sphere of radius mm, 0 for the first frame
+    '''
+    displacement = np.abs(np.diff(movement,axis=0))
+    displacement[:,3:] *= radius
+    return np.concatenate([[0.0],displacement.sum(axis=1)])
+
+def dvars(cifti_reader):
+    '''
+    Root mean square over grayordinates of the frame to frame signal change, 0 for the
+    first frame, accumulated over grayordinate chunks of a tools.cifti_io.CiftiReader
+    '''
+    squared_change = np.zeros(cifti_reader.n_timepoints-1)
+    for start, stop, chunk in cifti_reader.iter_grayordinate_chunks():
+        squared_change += (np.diff(chunk,axis=0).astype(np.float64)**2).sum(axis=1)
+    return np.concatenate([[0.0],np.sqrt(squared_change/cifti_reader.n_grayordinates)])
+
+def boxplot_outliers(values):
+    '''
+    Frames above the 75th percentile + 1.5 x the interquartile range, fsl_motion_outliers' default
+    '''
+    q1, q3 = np.percentile(values[1:],[25,75])
+    return values > q3 + 1.5*(q3 - q1)
+
+def frame_masks(fd,fd_thresholds,dvars_values=None):
+    '''
+    Parameters
+    ----------
+    fd : numpy array
+        Framewise displacement of every frame
+    fd_thresholds : list
+        FD thresholds in mm
+    dvars_values : numpy array
+        Optional DVARS of every frame, its outliers are censored at every threshold
+
+    Returns
+    -------
+    dict
+        FD threshold -> boolean mask of the frames kept
+    '''
+    outliers = np.zeros(fd.shape[0],dtype=bool)
+    if dvars_values is not None:
+        outliers = boxplot_outliers(dvars_values)
+    return dict((fd_threshold,~(outliers | (fd > fd_threshold))) for fd_threshold in fd_thresholds)
+
+def bold_frame_masks(bold,n_timepoints,fd_thresholds,cifti_reader=None):
+    '''
+    Frame masks of a bold from its movement regressors, and from its DVARS when a
+    CiftiReader of the bold is given
+    '''
+    fd = framewise_displacement(read_movement_regressors(movement_regressors_file(bold)))
+    if fd.shape[0] != n_timepoints:
+        raise ValueError('%s has %d timepoints but its movement regressors have %d' % (bold,n_timepoints,fd.shape[0]))
+    dvars_values = None
+    if cifti_reader is not None:
+        dvars_values = dvars(cifti_reader)
+    return frame_masks(fd,fd_thresholds,dvars_values)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming access to dense CIFTI files.
+
+get_fdata() materializes the whole timepoints x grayordinates array in float64,
+which for concatenated multiband runs is several GB per scan. CiftiReader
+memory-maps the data block instead and hands out float32 chunks whose size is
+bounded by max_chunk_bytes, independent of the run length.
+
+CiftiMetadata describes a file from its header alone (series step, timepoints,
+brain models), so the TR and sizes are known before any data is read and
+without calling wb_command -file-information. It is cached per file.
+"""
+import nibabel.cifti2 as ci
+import numpy as np
+import os
+
+class CiftiMetadata:
+    def __init__(self,cifti_file,cifti_load=None):
+        '''
+        Parameters
+        ----------
+        cifti_file : string
+            Path to a CIFTI file
+        cifti_load : nibabel.cifti2.Cifti2Image
+            The file already loaded by nibabel, to avoid reading its header again
+
+        Attributes
+        ----------
+        shape : tuple
+            Shape of the data block
+        n_timepoints : int
+            Number of rows, the timepoints of a dtseries
+        n_grayordinates : int
+            Number of columns
+        series_step : float
+            Step of the series axis, the TR in seconds of a dtseries. None without a series axis.
+        series_start : float
+            Start of the series axis
+        series_unit : string
+            Unit of the series axis, e.g. SECOND
+        brain_models : nibabel.cifti2.BrainModelAxis
+            Column axis of a dense file, None for other files
+        structures : list of tuples
+            (CIFTI structure name, number of grayordinates) of a dense file
+        '''
+        self.cifti_file = cifti_file
+        if cifti_load is None:
+            cifti_load = ci.load(cifti_file)
+        self.shape = cifti_load.shape
+        self.n_timepoints = self.shape[0]
+        self.n_grayordinates = self.shape[1]
+        series = cifti_load.header.get_axis(0)
+        if isinstance(series,ci.SeriesAxis):
+            self.series_step = float(series.step)
+            self.series_start = float(series.start)
+            self.series_unit = series.unit
+        else:
+            self.series_step = self.series_start = self.series_unit = None
+        brain_models = cifti_load.header.get_axis(1)
+        if isinstance(brain_models,ci.BrainModelAxis):
+            self.brain_models = brain_models
+            self.structures = [(str(name),len(bm)) for name, bm_slice, bm in brain_models.iter_structures()]
+        else:
+            self.brain_models = None
+            self.structures = []
+
+    @property
+    def TR(self):
+        if self.series_step is None or self.series_unit != 'SECOND':
+            raise ValueError('%s has no series axis in seconds, the repetition time is unknown' % self.cifti_file)
+        return self.series_step
+
+# CiftiMetadata per (path, mtime, size), so a rewritten file is described again
+metadata_cache = {}
+
+def cifti_metadata(cifti_file,cifti_load=None):
+    '''
+    Cached CiftiMetadata of cifti_file. Only the header is read, and only once per file.
+    '''
+    stat = os.stat(cifti_file)
+    key = (os.path.realpath(cifti_file),stat.st_mtime,stat.st_size)
+    if not key in metadata_cache:
+        metadata_cache[key] = CiftiMetadata(cifti_file,cifti_load)
+    return metadata_cache[key]
+
+class CiftiReader:
+    def __init__(self,cifti_file,max_chunk_bytes=64*1024**2):
+        '''
+        Parameters
+        ----------
+        cifti_file : string
+            Path to a dense CIFTI file, e.g. a dtseries
+        max_chunk_bytes : int
+            Upper bound on the size of a float32 chunk handed out by the iterators
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.cifti_file = cifti_file
+        self.max_chunk_bytes = max_chunk_bytes
+        # only the header is read here, nibabel keeps the data behind an array proxy
+        self.cifti_load = ci.load(cifti_file)
+        self.metadata = cifti_metadata(cifti_file,self.cifti_load)
+        self.shape = self.cifti_load.shape
+        self.n_timepoints = self.shape[0]
+        self.n_grayordinates = self.shape[1]
+        dataobj = self.cifti_load.dataobj
+        self.scaled = hasattr(dataobj,'slope') and (dataobj.slope != 1 or dataobj.inter != 0)
+        if cifti_file.endswith('.gz') or not hasattr(dataobj,'offset'):
+            # compressed files cannot be memory-mapped, the array proxy reads slices instead
+            self.data = dataobj
+        else:
+            self.data = np.memmap(cifti_file,dtype=dataobj.dtype,mode='r',offset=dataobj.offset,
+                                  shape=self.shape,order=getattr(dataobj,'order','F'))
+            if self.scaled:
+                self.slope = dataobj.slope
+                self.inter = dataobj.inter
+
+    def read(self,index):
+        '''
+        Reads data[index] as a float32 array, applying the NIfTI scaling if present
+        '''
+        chunk = np.asarray(self.data[index],dtype=np.float32)
+        if self.scaled and type(self.data) == np.memmap:
+            chunk *= self.slope
+            chunk += self.inter
+        return chunk
+
+    def iter_grayordinate_chunks(self,chunk_size=None):
+        '''
+        Yields (start, stop, timepoints x chunk float32 array) over blocks of grayordinates.
+        The CIFTI data block stores each grayordinate's timeseries contiguously, so these
+        reads are sequential on disk. Used by per-grayordinate temporal metrics and parcellation.
+        '''
+        if chunk_size is None:
+            chunk_size = max(1,self.max_chunk_bytes//(4*self.n_timepoints))
+        for start in range(0,self.n_grayordinates,chunk_size):
+            stop = min(start+chunk_size,self.n_grayordinates)
+            yield start, stop, self.read((slice(None),slice(start,stop)))
+
+    def iter_time_chunks(self,chunk_size=None):
+        '''
+        Yields (start, stop, chunk x grayordinates float32 array) over blocks of timepoints.
+        '''
+        if chunk_size is None:
+            chunk_size = max(1,self.max_chunk_bytes//(4*self.n_grayordinates))
+        for start in range(0,self.n_timepoints,chunk_size):
+            stop = min(start+chunk_size,self.n_timepoints)
+            yield start, stop, self.read((slice(start,stop),slice(None)))
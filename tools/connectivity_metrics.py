@@ -1,33 +1,58 @@
 #!/opt/Miniconda3/bin/python
-import bct
-import cifti
-import csv
-import fcntl as F
-import nibabel.cifti2 as ci
-from nilearn.connectome import ConnectivityMeasure
 import numpy as np
 import os
-import pandas as pd
-import scipy.linalg as la
-from sklearn.covariance import GraphicalLassoCV,EmpiricalCovariance
+
+from tools.batch_connectivity import COVARIANCE_METRICS, RunningCovariance, batch_covariance, batch_network_matrices, zscore
+from tools.censoring import bold_frame_masks
+from tools.cifti_io import CiftiReader, cifti_metadata
+from tools.parcellation import parcellation_cache, workbench_parcellate
+from tools.shortest_paths import betweenness, proportional_threshold
+from tools.sparse_covariance import SPARSE_METRICS
+from tools.stage_timer import stage_timer
 
 class NetworkIO:
-    def __init__(self,output_dir,cifti_data, parcel_file, parcel_name,network_metric,fishers_r_to_z_transform):
+    def __init__(self,output_dir,cifti_data, parcel_file, parcel_name,network_metric,fishers_r_to_z_transform,parcellation_engine='numpy',parcellation_cache_dir=None,
+                 n_jobs=1,dtw_window=0.1,sparse_alpha=None,warm_alpha=None,fd_thresholds=None,dvars_censoring='NO',
+                 keep_timeseries=False):
         '''
         Parameters
         ----------
         output_dir : string
             Where to output generated data
         cifti_data : string or list
-            Path to inputted cifti file that will be processed
+            Path to inputted cifti file that will be processed, or the runs of a session to
+            combine. Combined runs are z-scored per parcel and concatenated.
         parcel_name : string
             Shorthand name of the CIFTI label file. 
         parcel_file : string
             The CIFTI label file to use or used to parcellate the brain.
         network_metric : [All, correlation, partial_correlation, dynamic_time_warping, covariance, precision, sparse_inverse_precision, sparse_inverse_covariance]
-            What method to employ for network matrix estimation.
+            What method to employ for network matrix estimation. The cohort level tangent metric
+            is estimated with tools.tangent_space.TangentSpace from the covariance matrices.
         fishers_r_to_z_transform : [YES, NO]
             Should Fishe4r's r-to-z transformation be applied?
+        parcellation_engine : [numpy, workbench]
+            Parcellate in-process with a sparse averaging matrix or through wb_command -cifti-parcellate.
+        parcellation_cache_dir : string
+            Optional folder where the parsed parcellation is cached as .npz.
+        n_jobs : int
+            Number of threads within an estimator, dynamic time warping splits parcel pairs and
+            the sparse estimators split cross-validation folds over them.
+        dtw_window : float
+            Sakoe-Chiba band of dynamic time warping as a fraction of the number of timepoints.
+        sparse_alpha : float
+            Fixed graphical lasso regularization for the sparse metrics, skips cross-validation.
+        warm_alpha : float
+            Graphical lasso alpha selected for the cohort so far, cross-validation searches around it.
+        fd_thresholds : list
+            Optional framewise displacement thresholds in mm. Frames above a threshold are
+            censored and the masked covariance of the kept frames is estimated per threshold,
+            see tools.censoring.
+        dvars_censoring : [YES, NO]
+            Also censor DVARS outlier frames at every FD threshold.
+        keep_timeseries : bool
+            Keep the concatenated timeseries of combined runs even when only covariance
+            derived metrics are estimated, e.g. for sliding-window connectivity.
 
         Returns
         -------
@@ -44,42 +69,120 @@ class NetworkIO:
         # shorthand name chosen for parcel file
         self.parcel_name = parcel_name
         self.fishers_r_to_z_transform = fishers_r_to_z_transform
+        self.parcellation_engine = parcellation_engine
+        self.n_jobs = n_jobs
+        self.dtw_window = dtw_window
+        self.sparse_alpha = sparse_alpha
+        self.warm_alpha = warm_alpha
+        self.fd_thresholds = list(fd_thresholds or [])
+        self.dvars_censoring = dvars_censoring
+        self.keep_timeseries = keep_timeseries
+        # one metric or a list of metrics, all estimated from the same parcellated timeseries
         self.network_metric = network_metric
+        if type(network_metric) == str:
+            self.network_metrics = [network_metric]
+        else:
+            self.network_metrics = list(network_metric)
         
         # create output folder if it does not exist
         if not os.path.isdir(self.output_dir):
             os.makedirs(self.output_dir)
-        # determine fmriname
-        self.fmriname = os.path.basename(cifti_data).split('.')[0]
         
-        try:
-            read_parcel_file = cifti.read(self.parcel_file)
-        except TypeError:
-            print('This does not look like a CIFTI parcel file. Must exit')
-        parcel_file_label_tuple = read_parcel_file[1][0][0][1]
-        parcel_labels = []
+        # the label file is parsed once per process, it maps grayordinates to parcels for every scan
+        self.parcellation = parcellation_cache.get(self.parcel_file,cache_dir=parcellation_cache_dir)
+        self.parcel_labels = self.parcellation.parcel_labels
         
-        for value in parcel_file_label_tuple:
-                if not '???' in parcel_file_label_tuple[value][0]:
-                        parcel_labels.append(parcel_file_label_tuple[value][0])
-        self.parcel_labels = [str(r) for r in parcel_labels]
+        # estimates shared between network metrics, filled on first use
+        self.empirical_covariance = None
+        self.selected_sparse_alpha = None
+        self.network_matrices = {}
+        # FD threshold -> masked covariance, number of frames kept and whether the covariance is invertible
+        self.censored_covariances = {}
+        self.censored_frames = {}
+        self.censored_invertible = {}
         
         if type(self.cifti_data) == list:
-            example_cifti_img = ci.load(self.cifti_data[0])
-            self.fmri_data_np_arr = np.zeros((example_cifti_img.shape[0],example_cifti_img.shape[1],len(self.cifti_data)))
-            for idx, fmritcs in self.cifti_data:
-                self.cifti_file = fmritcs
-                self.cifti_tests()
-                normalized_data = ((self.parcellated_cifti_data - self.parcellated_cifti_data .mean())/self.parcellated_cifti_data .std())
-                self.fmri_data_np_arr[:,:,idx] = normalized_data
-            self.df_cifti_load = pd.DataFrame(self.fmri_data_np_arr.mean(axis=2))
-            self.cifti_np_array = self.df_cifti_load.to_numpy()
+            # determine fmriname
+            self.fmriname = os.path.basename(cifti_data[0]).split('.')[0]
+            self.combine_runs()
 
         else:
+            # determine fmriname
+            self.fmriname = os.path.basename(cifti_data).split('.')[0]
             self.cifti_file = self.cifti_data
             self.cifti_tests() # perform tests on inputted cifti file and parcellate timeseries
             self.cifti_np_array = np.array(self.parcellated_cifti_data )
-            self.create_network_matrix()
+            self.run_lengths = [self.cifti_np_array.shape[0]]
+            if self.fd_thresholds:
+                self.censor_frames()
+
+    def combine_runs(self):
+        '''
+        Streams the runs of a session one at a time: each run is parcellated, z-scored per
+        parcel and added to a running covariance. Metrics that need the timeseries itself get
+        the concatenation, preallocated from the run lengths in the CIFTI headers. Metrics
+        derived from the covariance only keep parcels x parcels sums, whatever the number of runs.
+        '''
+        keep_timeseries = self.keep_timeseries or any(not network_metric in COVARIANCE_METRICS for network_metric in self.network_metrics)
+        run_lengths = [cifti_metadata(run).n_timepoints for run in self.cifti_data]
+        self.run_lengths = run_lengths
+        running_covariance = RunningCovariance(self.parcellation.parcel_count)
+        censored_running_covariances = dict((fd_threshold,RunningCovariance(self.parcellation.parcel_count)) for fd_threshold in self.fd_thresholds)
+        self.cifti_np_array = None
+        if keep_timeseries:
+            self.cifti_np_array = np.empty((sum(run_lengths),self.parcellation.parcel_count))
+        start = 0
+        for run, run_length in zip(self.cifti_data,run_lengths):
+            self.cifti_file = run
+            self.cifti_tests()
+            normalized_data = zscore(np.asarray(self.parcellated_cifti_data))
+            running_covariance.update(normalized_data)
+            if self.fd_thresholds:
+                for fd_threshold, kept in self.frame_masks().items():
+                    censored_running_covariances[fd_threshold].update(normalized_data[kept])
+            if keep_timeseries:
+                self.cifti_np_array[start:start+run_length] = normalized_data
+            start += run_length
+            self.parcellated_cifti_data = None
+        self.empirical_covariance = running_covariance.covariance()
+        for fd_threshold, censored_running_covariance in censored_running_covariances.items():
+            self.masked_covariance(fd_threshold,censored_running_covariance)
+
+    def frame_masks(self):
+        '''
+        Frames of the current cifti file kept at every FD threshold
+        '''
+        with stage_timer.stage('censoring',self.cifti_file):
+            return bold_frame_masks(self.cifti_file,self.cifti_reader.n_timepoints,self.fd_thresholds,
+                                    cifti_reader=self.cifti_reader if self.dvars_censoring == 'YES' else None)
+
+    def masked_covariance(self,fd_threshold,running_covariance):
+        '''
+        Stores the covariance of the frames kept at fd_threshold, NaN when fewer than two frames
+        survive censoring. With no more kept frames than parcels the covariance is singular, so
+        precision and partial correlation are NaN while covariance and correlation are kept.
+        '''
+        parcel_count = self.parcellation.parcel_count
+        self.censored_frames[fd_threshold] = running_covariance.count
+        self.censored_invertible[fd_threshold] = running_covariance.count > parcel_count
+        if running_covariance.count < 2:
+            print('rsfMRI_network_metrics.py: fewer than two frames of %s survive censoring' % self.fmriname)
+            self.censored_covariances[fd_threshold] = np.full((parcel_count,parcel_count),np.nan)
+            return
+        if running_covariance.count <= parcel_count:
+            print('rsfMRI_network_metrics.py: %d frames of %s survive censoring at FD %s, no more than the %d parcels, precision and partial correlation are NaN' % (running_covariance.count,self.fmriname,fd_threshold,parcel_count))
+        self.censored_covariances[fd_threshold] = running_covariance.covariance()
+
+    def censor_frames(self):
+        '''
+        Masked covariance of the parcellated timeseries at every FD threshold. The frames are
+        parcellated once, a threshold only costs the covariance of its kept frames.
+        '''
+        for fd_threshold, kept in self.frame_masks().items():
+            running_covariance = RunningCovariance(self.parcellation.parcel_count)
+            running_covariance.update(self.cifti_np_array[kept])
+            self.masked_covariance(fd_threshold,running_covariance)
+
     def cifti_tests(self):
         # does CIFTI file exist?
         try:
@@ -90,135 +193,228 @@ class NetworkIO:
             
         # is entered CIFTI file actually a CIFTI file?
         try:
-            self.cifti_load = ci.load(self.cifti_file)
-        except:
-            print("file does not look like a cifti file")
-        cifti_file_basename = os.path.basename(self.cifti_file)
-        cifti_prefix = cifti_file_basename.split(".")[0]
-        cifti_suffix = '.'.join(cifti_file_basename.split(".")[1:])
-        if cifti_suffix == 'dtseries.nii':
-            self.new_cifti_suffix = '.ptseries.nii'
-        # elif cifti_suffix == 'dscalar.nii':
-        #    self.new_cifti_suffix = '.pscalar.nii'
-        os.system("/opt/workbench/bin_rh_linux64/wb_command -cifti-parcellate %s %s %s %s" 
-                  % (self.cifti_file, 
-                     self.parcel_file, 
-                     "COLUMN", 
-                     os.path.join(self.output_dir,cifti_prefix) + "_"+self.parcel_name + self.new_cifti_suffix))
-        self.parcellated_cifti_file = os.path.join(self.output_dir,cifti_prefix) + "_"+self.parcel_name + self.new_cifti_suffix
-        # does CIFTI file exist?
-        try:
-            read_cifti = open(self.parcellated_cifti_file)
-            read_cifti.close()
-        except IOError:
-            print("file does not exist")    
-        # is entered CIFTI file actually a CIFTI file?
-        try:
-            self.parcellated_cifti_data = ci.load(self.parcellated_cifti_file).get_fdata()
+            with stage_timer.stage('cifti_load',self.cifti_file):
+                self.cifti_reader = CiftiReader(self.cifti_file)
+                self.cifti_load = self.cifti_reader.cifti_load
         except:
             print("file does not look like a cifti file")
+        if self.parcellation_engine == 'numpy':
+            # stream grayordinate chunks through the parcellation, the dense array is never materialized
+            with stage_timer.stage('parcellate',self.cifti_file):
+                self.parcellated_cifti_data = self.parcellation.parcellate_reader(self.cifti_reader)
+        else:
+            cifti_file_basename = os.path.basename(self.cifti_file)
+            cifti_prefix = cifti_file_basename.split(".")[0]
+            cifti_suffix = '.'.join(cifti_file_basename.split(".")[1:])
+            if cifti_suffix == 'dtseries.nii':
+                self.new_cifti_suffix = '.ptseries.nii'
+            # elif cifti_suffix == 'dscalar.nii':
+            #    self.new_cifti_suffix = '.pscalar.nii'
+            self.parcellated_cifti_file = os.path.join(self.output_dir,cifti_prefix) + "_"+self.parcel_name + self.new_cifti_suffix
+            with stage_timer.stage('parcellate',self.cifti_file):
+                self.parcellated_cifti_data = workbench_parcellate(self.cifti_file,self.parcel_file,self.parcellated_cifti_file)
 
-    def create_network_matrix(self):
+    def estimate_empirical_covariance(self):
+        '''
+        Estimates the empirical covariance of the parcellated timeseries once per scan.
+        Correlation, partial correlation, covariance and precision are all derived from it.
+        '''
+        if self.empirical_covariance is None:
+            self.empirical_covariance = batch_covariance(self.cifti_np_array[None])[0]
+        return self.empirical_covariance
+
+    def create_network_matrix(self, network_metric=None):
+        '''
+        Parameters
+        ----------
+        network_metric : string
+            Network metric to estimate. Defaults to the first requested network metric.
+
+        Returns
+        -------
+        network_matrix : numpy array
+            Parcel x parcel network matrix
+        '''
+        if network_metric is None:
+            network_metric = self.network_metrics[0]
+        if network_metric in self.network_matrices:
+            self.network_matrix = self.network_matrices[network_metric]
+            return self.network_matrix
         print('\n')
         print('rsfMRI_network_metrics.py: Create network matrix ')
         print('\t-Output folder: ' + self.output_dir)
-        print('\t-Cifti file: ' + self.cifti_file)
+        print('\t-Cifti file: ' + str(self.cifti_data))
         print('\t-Parcel file: ' + self.parcel_file)
-        print('\t-Network matrix method/type: ' + str(self.network_metric))
-        if self.network_metric == 'correlation':
-            measure = ConnectivityMeasure(kind='correlation',cov_estimator=EmpiricalCovariance())
-        elif self.network_metric == 'covariance':
-            measure = ConnectivityMeasure(kind='covariance',cov_estimator=EmpiricalCovariance())
-        elif self.network_metric == 'partial_correlation':
-            measure = ConnectivityMeasure(kind='partial correlation',cov_estimator=EmpiricalCovariance())
-        elif self.network_metric == 'precision':
-            measure = ConnectivityMeasure(kind='precision',cov_estimator=EmpiricalCovariance())
-        elif 'sparse' in self.network_metric:
-            measure = GraphicalLassoCV()
-            
-        if 'sparse' in self.network_metric:
-            measure.fit(self.cifti_np_array)
-            if 'covariance' in self.network_metric:
-                network_matrix = measure.covariance_
-            elif 'precision' in self.network_metric:
-                network_matrix = measure.precision_
-        else:
-            network_matrix = measure.fit_transform([self.cifti_np_array])[0]
-        if self.network_metric == 'correlation' and self.fishers_r_to_z_transform == 'YES':
-            self.network_matrix = 0.5*(np.log(1+network_matrix)-np.log(1-network_matrix))
-        else:
-            self.network_matrix = network_matrix
+        print('\t-Network matrix method/type: ' + str(network_metric))
+        with stage_timer.stage('estimator/' + network_metric,self.cifti_data):
+            if network_metric in COVARIANCE_METRICS:
+                # same code path as the batch engine, on a stack of one scan
+                covariance = self.estimate_empirical_covariance()
+                network_matrix = batch_network_matrices(None,[network_metric],
+                                                        self.fishers_r_to_z_transform,
+                                                        covariance=covariance[None])[network_metric][0]
+            elif network_metric in SPARSE_METRICS:
+                # one graphical lasso fit fills both sparse metrics
+                from tools.sparse_covariance import fit_graphical_lasso
+                covariance, precision, self.selected_sparse_alpha = fit_graphical_lasso(self.cifti_np_array,alpha=self.sparse_alpha,
+                                                                                        warm_alpha=self.warm_alpha,n_jobs=self.n_jobs)
+                self.network_matrices['sparse_inverse_covariance'] = covariance
+                self.network_matrices['sparse_inverse_precision'] = precision
+                network_matrix = self.network_matrices[network_metric]
+            elif network_metric == 'dynamic_time_warping':
+                from tools.dynamic_time_warping import dtw_distance_matrix
+                network_matrix = dtw_distance_matrix(self.cifti_np_array,window=self.dtw_window,n_jobs=self.n_jobs)
+            elif network_metric == 'tangent':
+                raise ValueError('The tangent metric needs the covariance of every bold in the cohort, estimate it with tools.tangent_space.TangentSpace')
+            else:
+                raise ValueError('Unknown network metric: %s' % network_metric)
+        self.network_matrices[network_metric] = network_matrix
+        self.network_matrix = network_matrix
         return self.network_matrix
+
+    def create_network_matrices(self):
+        '''
+        Estimates every requested network metric from the single parcellated timeseries.
+
+        Returns
+        -------
+        network_matrices : dict
+            Network metric name -> parcel x parcel network matrix
+        '''
+        for network_metric in self.network_metrics:
+            self.create_network_matrix(network_metric)
+        return {network_metric: self.network_matrices[network_metric] for network_metric in self.network_metrics}
         
-class GraphTheoryIO(NetworkIO):
-    def __init__(self,output_dir,cifti_file, parcel_file, parcel_name, network_metric, fishers_r_to_z_transform, graph_theory_metric):
+# graph theory outputs live in the HDF5 output as graph_theory/<network metric>/<graph theory metric>
+GRAPH_THEORY_GROUP = 'graph_theory'
+GRAPH_THEORY_METRICS = ['strength','eigenvector_centrality','clustering_coefficient','local_efficiency',
+                        'node_betweenness_centrality','edge_betweenness_centrality']
+# graph theory metrics that are parcels x parcels instead of one value per parcel
+EDGE_GRAPH_THEORY_METRICS = ['edge_betweenness_centrality']
+
+def graph_theory_dataset(network_metric,graph_theory_metric):
+    return '/'.join([GRAPH_THEORY_GROUP,network_metric,graph_theory_metric])
+
+def is_graph_theory_dataset(name):
+    return name.startswith(GRAPH_THEORY_GROUP + '/')
+
+def split_graph_theory_dataset(name):
+    '''
+    graph_theory/<network metric>/<graph theory metric> -> (network metric, graph theory metric)
+    '''
+    group, network_metric, graph_theory_metric = name.split('/')
+    return network_metric, graph_theory_metric
+
+class GraphTheoryIO:
+    def __init__(self,network_matrix,graph_theory_metrics,density=None):
         '''
         Parameters
         ----------
-        output_dir : TYPE
-            DESCRIPTION.
-        cifti_data : TYPE
-            DESCRIPTION.
-        parcel_file : TYPE
-            DESCRIPTION.
-        parcel_name : TYPE
-            DESCRIPTION.
-        network_metric : TYPE
-            DESCRIPTION.
-        fishers_r_to_z_transform : TYPE
-            DESCRIPTION.
-        graph_theory_metric : TYPE
-            DESCRIPTION.
+        network_matrix : numpy array
+            Parcel x parcel network matrix, either just estimated or read back from the HDF5 output
+        graph_theory_metrics : list
+            Any of strength, eigenvector_centrality, clustering_coefficient, local_efficiency,
+            node_betweenness_centrality and edge_betweenness_centrality
+        density : float
+            Optional fraction of the strongest connections kept (proportional thresholding)
+            before any metric is computed
 
         Returns
         -------
         None.
 
         '''
-        
-        #local efficiency, strength, node betweeness centrality, edge betweenness centrality local density, eigenvector centrality, clustering coefficient
+        self.graph_theory_metrics = list(graph_theory_metrics)
         # ensure that data does not have NaNs or Infs, place diagnonal to zero, and restrict floating point to five decimals for stability
+        network_matrix = np.array(network_matrix,dtype=float)
+        network_matrix[~np.isfinite(network_matrix)] = 0
+        np.fill_diagonal(network_matrix,0)
+        # the weighted undirected measures below are defined for non-negative weights
+        network_matrix[network_matrix < 0] = 0
+        network_matrix = np.around(network_matrix, decimals=5)
+        if density is not None and density < 1:
+            network_matrix = proportional_threshold(network_matrix,density)
+        self.network_matrix = network_matrix
+        # conversions shared between metrics, filled on first use
+        self.normalized_network_matrix = None
+        self.lengths_network_matrix = None
+        self.graph_theory_vectors = {}
 
-        # execute parent class NetworkIO to produce connectivity matrix
-        super().__init__(output_dir,cifti_data, parcel_file, parcel_name,network_metric,fishers_r_to_z_transform)
-        pdb.set_trace()
-        self.graph_theory_metric = graph_theory_metric
-
-        self.network_matrix[np.where(np.isinf(self.network_matrix))] = 0
-        self.network_matrix[np.where(np.isnan(self.network_matrix))] = 0
-        self.network_matrix[np.triu_indices(self.network_matrix.shape[0],k=1)]
-        self.network_matrix = np.around(self.network_matrix, decimals=5)
-        
-        # separate metrics based on whether they include distances
-        if graph_theory_metric == 'node_betweenness_centrality' or graph_theory_metric == 'edge_betweenness_centrality':
-            # convert matrix to lengths
-            lengths_network_matrix = bct.weight_conversion(self.network_matrix,'lengths')
-            num_nodes = self.network_matrix.shape[0]
-            if graph_theory_metric == 'node_betweenness_centrality':
-                # node betweeness centrality
-                self.graph_theory_connection_matrix,self.graph_theory_vector = bct.centrality.betweenness_wei(lengths_network_matrix)
-            elif graph_theory_metric == 'edge_betweenness_centrality':
-                # edge betweeness centrality
-                self.graph_theory_vector = bct.centrality.edge_betweenness_wei(lengths_network_matrix)
-        else:
-            if graph_theory_metric == 'eigenvector_centrality':
-                # eigenvector centrality
-                self.graph_theory_vector = bct.eigenvector_centrality_und(self.network_matrix)
-            elif graph_theory_metric == 'local_efficiency':
-                #local efficiency
-                self.graph_theory_vector = bct.efficiency_wei(self.network_matrix,local=True)
-            elif graph_theory_metric == 'strength':        
-                #node strength
-                self.graph_theory_vector = bct.strengths_und(self.network_matrix)
-            elif graph_theory_metric ==  'clustering_coefficient':
-                #clustering coefficent
-                self.graph_theory_vector = bct.clustering_coef_wu(self.network_matrix)
-        return self.graph_theory_vector # TODO will likely need to wrap some logic into this return
-
-
-
+    def normalized(self):
+        '''
+        Weights scaled to [0, 1], as clustering coefficient and local efficiency expect
+        '''
+        import bct
+        if self.normalized_network_matrix is None:
+            self.normalized_network_matrix = bct.weight_conversion(self.network_matrix,'normalize')
+        return self.normalized_network_matrix
 
+    def lengths(self):
+        '''
+        Connection lengths (inverse weights) that shortest path measures run on
+        '''
+        import bct
+        if self.lengths_network_matrix is None:
+            self.lengths_network_matrix = bct.weight_conversion(self.network_matrix,'lengths')
+        return self.lengths_network_matrix
 
+    def create_graph_theory_vectors(self):
+        '''
+        Computes every requested graph theory metric in one pass over the network matrix
 
+        Returns
+        -------
+        graph_theory_vectors : dict
+            Graph theory metric -> parcels vector (parcels x parcels for edge betweenness)
+        '''
+        import bct
+        for graph_theory_metric in self.graph_theory_metrics:
+            if graph_theory_metric in self.graph_theory_vectors:
+                continue
+            if graph_theory_metric in ['node_betweenness_centrality','edge_betweenness_centrality']:
+                if 'edge_betweenness_centrality' in self.graph_theory_metrics:
+                    # one set of shortest paths gives both edge and node betweenness
+                    node_betweenness, edge_betweenness = betweenness(self.lengths(),edges=True)
+                    self.graph_theory_vectors['edge_betweenness_centrality'] = edge_betweenness
+                    self.graph_theory_vectors['node_betweenness_centrality'] = node_betweenness
+                else:
+                    self.graph_theory_vectors['node_betweenness_centrality'] = betweenness(self.lengths())
+            elif graph_theory_metric == 'eigenvector_centrality':
+                self.graph_theory_vectors[graph_theory_metric] = bct.eigenvector_centrality_und(self.network_matrix)
+            elif graph_theory_metric == 'local_efficiency':
+                self.graph_theory_vectors[graph_theory_metric] = bct.efficiency_wei(self.normalized(),local=True)
+            elif graph_theory_metric == 'strength':
+                self.graph_theory_vectors[graph_theory_metric] = bct.strengths_und(self.network_matrix)
+            elif graph_theory_metric == 'clustering_coefficient':
+                self.graph_theory_vectors[graph_theory_metric] = bct.clustering_coef_wu(self.normalized())
+            else:
+                raise ValueError('Unknown graph theory metric: %s' % graph_theory_metric)
+        return {graph_theory_metric: self.graph_theory_vectors[graph_theory_metric] for graph_theory_metric in self.graph_theory_metrics}
 
+def create_graph_theory_datasets(graph_theory_datasets,network_matrices,density=None):
+    '''
+    Parameters
+    ----------
+    graph_theory_datasets : list
+        graph_theory/<network metric>/<graph theory metric> names to compute
+    network_matrices : dict
+        Network metric -> bolds x parcels x parcels array
+    density : float
+        Optional fraction of the strongest connections kept before computing metrics
 
+    Returns
+    -------
+    dict
+        Graph theory dataset name -> bolds x parcels (x parcels) array, ordered like network_matrices
+    '''
+    graph_theory_metrics = {}
+    for name in graph_theory_datasets:
+        network_metric, graph_theory_metric = split_graph_theory_dataset(name)
+        graph_theory_metrics.setdefault(network_metric,[]).append(graph_theory_metric)
+    graph_theory_vectors = {}
+    for network_metric, metrics in graph_theory_metrics.items():
+        print('rsfMRI_network_metrics.py: Create %s graph theory metrics of %s matrices' % (metrics,network_metric))
+        for network_matrix in network_matrices[network_metric]:
+            for graph_theory_metric, vector in GraphTheoryIO(network_matrix,metrics,density).create_graph_theory_vectors().items():
+                graph_theory_vectors.setdefault(graph_theory_dataset(network_metric,graph_theory_metric),[]).append(vector)
+    return {name: np.stack(vectors) for name, vectors in graph_theory_vectors.items()}
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sliding-window (dynamic) connectivity of parcellated timeseries.
+
+Windows slide over the timeseries by updating weighted sums: frames entering
+the window are added and frames leaving it are removed, so every frame costs
+two low rank updates of a parcels x parcels sum instead of every window paying
+for a full covariance. With the exponential taper, frame t of a window ending
+at frame e weighs exp(-(e - t)/theta), theta a third of the window; scaling the
+sums by exp(-step/theta) at every step keeps the same update exact.
+
+Windowed matrices live in the HDF5 output as dynamic/<network metric>,
+bolds x windows x edges (upper triangles, diagonal included), NaN past the
+last window of shorter bolds. Windows never span the boundary of combined runs.
+WindowStates clusters the windows into connectivity states with online
+mini-batch k-means while they are written, so the windows of the cohort are
+never held together; labels and centroids go to dynamic_states/<network metric>.
+"""
+import numpy as np
+
+from tools.batch_connectivity import batch_network_matrices
+
+DYNAMIC_GROUP = 'dynamic'
+DYNAMIC_STATES_GROUP = 'dynamic_states'
+DYNAMIC_METRICS = ['correlation','covariance']
+WINDOW_TAPERS = ['none','exponential']
+# windows turned into network matrices at once
+WINDOW_CHUNK = 32
+# weighted k-means iterations merging the states of MPI ranks
+STATE_MERGE_ITERATIONS = 20
+
+def dynamic_dataset(network_metric):
+    return '/'.join([DYNAMIC_GROUP,network_metric])
+
+def is_dynamic_dataset(name):
+    return name.startswith(DYNAMIC_GROUP + '/')
+
+def split_dynamic_dataset(name):
+    '''
+    dynamic/<network metric> -> network metric
+    '''
+    return name.split('/')[1]
+
+def dynamic_states_dataset(network_metric):
+    return '/'.join([DYNAMIC_STATES_GROUP,network_metric])
+
+def window_count(n_timepoints,window_length,window_step):
+    '''
+    Number of windows of window_length frames, window_step frames apart, that fit in n_timepoints
+    '''
+    if n_timepoints < window_length:
+        return 0
+    return (n_timepoints - window_length)//window_step + 1
+
+def window_decay(window_length,taper):
+    '''
+    Factor a frame's weight is scaled by per frame it lies before the end of the window
+    '''
+    if taper == 'none':
+        return 1.0
+    if taper == 'exponential':
+        return np.exp(-3.0/window_length)
+    raise ValueError('Unknown window taper "%s", choose from %s' % (taper,WINDOW_TAPERS))
+
+def sliding_window_covariances(timeseries,window_length,window_step=1,taper='none'):
+    '''
+    Weighted maximum likelihood covariance of every window, the same estimate as
+    batch_covariance of the window's frames without a taper
+
+    Parameters
+    ----------
+    timeseries : numpy array
+        Timepoints x parcels
+    window_length : int
+        Frames per window
+    window_step : int
+        Frames between the starts of consecutive windows
+    taper : [none, exponential]
+        Weighting of the frames within a window
+
+    Yields
+    ------
+    numpy array
+        Parcels x parcels covariance of every window, in order
+    '''
+    n_windows = window_count(timeseries.shape[0],window_length,window_step)
+    # centering the whole run keeps the running sums small relative to the covariances
+    centered = np.asarray(timeseries,dtype=float) - np.mean(timeseries,axis=0)
+    decay = window_decay(window_length,taper)
+    weights = decay**np.arange(window_length-1,-1,-1)
+    total = weights.sum()
+    sum_of_products = None
+    for window in range(n_windows):
+        start = window*window_step
+        end = start + window_length
+        if sum_of_products is None or window_step >= window_length:
+            frames = centered[start:end]
+            sum_of_products = (frames*weights[:,None]).T.dot(frames)
+            frame_sum = weights.dot(frames)
+        else:
+            scale = decay**window_step
+            sum_of_products *= scale
+            frame_sum *= scale
+            # frames leaving the window carry the weight they had before scaling times scale
+            leaving = centered[start-window_step:start]
+            leaving_weights = decay**np.arange(end-start+window_step-1,end-start-1,-1)
+            entering = centered[end-window_step:end]
+            entering_weights = weights[-window_step:]
+            sum_of_products += (entering*entering_weights[:,None]).T.dot(entering) - (leaving*leaving_weights[:,None]).T.dot(leaving)
+            frame_sum += entering_weights.dot(entering) - leaving_weights.dot(leaving)
+        mean = frame_sum/total
+        yield sum_of_products/total - np.outer(mean,mean)
+
+def sliding_window_matrices(timeseries,network_metrics,window_length,window_step=1,taper='none',
+                            fishers_r_to_z_transform='NO',run_lengths=None,n_windows=None):
+    '''
+    Windowed network matrices of one bold, as upper triangles
+
+    Parameters
+    ----------
+    network_metrics : list
+        Any of DYNAMIC_METRICS
+    run_lengths : list
+        Frames of every combined run in timeseries, windows stay within a run
+    n_windows : int
+        Rows of the output, windows past the bold's last one are NaN
+
+    Returns
+    -------
+    dict
+        Network metric -> windows x edges float32 array
+    '''
+    if run_lengths is None:
+        run_lengths = [timeseries.shape[0]]
+    run_windows = [window_count(run_length,window_length,window_step) for run_length in run_lengths]
+    if n_windows is None:
+        n_windows = sum(run_windows)
+    n_parcels = timeseries.shape[1]
+    rows, columns = np.triu_indices(n_parcels)
+    windowed = dict((network_metric,np.full((n_windows,rows.shape[0]),np.nan,dtype=np.float32)) for network_metric in network_metrics)
+    written = 0
+    chunk = []
+    start = 0
+    for run_length in run_lengths:
+        for covariance in sliding_window_covariances(timeseries[start:start+run_length],window_length,window_step,taper):
+            chunk.append(covariance)
+            if len(chunk) == WINDOW_CHUNK:
+                matrices = batch_network_matrices(None,network_metrics,fishers_r_to_z_transform,covariance=np.stack(chunk))
+                for network_metric, metric_data in matrices.items():
+                    windowed[network_metric][written:written+len(chunk)] = metric_data[:,rows,columns]
+                written += len(chunk)
+                chunk = []
+        start += run_length
+    if chunk:
+        matrices = batch_network_matrices(None,network_metrics,fishers_r_to_z_transform,covariance=np.stack(chunk))
+        for network_metric, metric_data in matrices.items():
+            windowed[network_metric][written:written+len(chunk)] = metric_data[:,rows,columns]
+    return windowed
+
+class WindowStates:
+    def __init__(self,n_states,n_parcels,seed=0):
+        '''
+        Online mini-batch k-means (Sculley 2010) of windowed network matrices into
+        connectivity states. Every centroid is the running mean of the windows assigned
+        to it, so a batch of windows updates the centroids and is dropped.
+
+        Parameters
+        ----------
+        n_states : int
+            Number of connectivity states
+        n_parcels : int
+            Parcels of the windowed matrices
+        seed : int
+            Seed of the k-means++ initialization, e.g. the MPI rank
+        '''
+        self.n_states = n_states
+        self.n_parcels = n_parcels
+        self.random_state = np.random.RandomState(seed)
+        # off-diagonal edges of the stored upper triangles, the Fisher z diagonal is infinite
+        rows, columns = np.triu_indices(n_parcels)
+        self.off_diagonal = np.flatnonzero(rows != columns)
+        self.centroids = None
+        self.counts = np.zeros(n_states)
+        # windows seen before there are enough to initialize the centroids
+        self.pending = []
+
+    def features(self,windows):
+        '''
+        Off-diagonal edges of the finite windows among windows x edges upper triangles
+        '''
+        windows = np.asarray(windows,dtype=float).reshape(-1,self.n_parcels*(self.n_parcels+1)//2)[:,self.off_diagonal]
+        return windows[np.isfinite(windows).all(axis=1)]
+
+    def initialize(self,features):
+        '''
+        k-means++ seeding from the first windows
+        '''
+        centroids = [features[self.random_state.randint(features.shape[0])]]
+        for state in range(1,self.n_states):
+            distances = ((features[:,None,:] - np.array(centroids)[None])**2).sum(axis=2).min(axis=1)
+            if distances.sum() > 0:
+                centroids.append(features[self.random_state.choice(features.shape[0],p=distances/distances.sum())])
+            else:
+                centroids.append(features[self.random_state.randint(features.shape[0])])
+        self.centroids = np.array(centroids)
+
+    def nearest(self,features):
+        distances = (features**2).sum(axis=1)[:,None] - 2*features.dot(self.centroids.T) + (self.centroids**2).sum(axis=1)[None]
+        return distances.argmin(axis=1)
+
+    def partial_fit(self,windows):
+        '''
+        Adds windows x edges upper triangles (any leading shape), skipping NaN padding
+        '''
+        features = self.features(windows)
+        if self.centroids is None:
+            self.pending.append(features)
+            features = np.concatenate(self.pending)
+            if features.shape[0] < self.n_states:
+                return self
+            self.pending = []
+            self.initialize(features)
+        labels = self.nearest(features)
+        for state in np.unique(labels):
+            assigned = features[labels == state]
+            self.counts[state] += assigned.shape[0]
+            self.centroids[state] += assigned.shape[0]/self.counts[state]*(assigned.mean(axis=0) - self.centroids[state])
+        return self
+
+    def predict(self,windows):
+        '''
+        State of every window of windows x edges upper triangles, NaN for padding
+        '''
+        windows = np.asarray(windows,dtype=float)
+        features = windows[...,self.off_diagonal]
+        finite = np.isfinite(features).all(axis=-1)
+        labels = np.full(finite.shape,np.nan)
+        if self.centroids is not None and finite.any():
+            labels[finite] = self.nearest(features[finite])
+        return labels
+
+    def centroid_matrices(self):
+        '''
+        States x parcels x parcels centroids, NaN diagonal
+        '''
+        rows, columns = np.triu_indices(self.n_parcels,1)
+        matrices = np.full((self.n_states,self.n_parcels,self.n_parcels),np.nan)
+        if self.centroids is not None:
+            matrices[:,rows,columns] = self.centroids
+            matrices[:,columns,rows] = self.centroids
+        return matrices
+
+    def merge_centroids(self,centroids,counts):
+        '''
+        Weighted k-means of the centroids of several ranks, started from the centroids of
+        the rank that saw the most windows
+        '''
+        sets = [(c, n) for c, n in zip(centroids,counts) if c is not None and n.sum() > 0]
+        if not sets:
+            return
+        points = np.concatenate([c for c, n in sets])
+        weights = np.concatenate([n for c, n in sets])
+        self.centroids = max(sets,key=lambda pair: pair[1].sum())[0].copy()
+        for iteration in range(STATE_MERGE_ITERATIONS):
+            labels = self.nearest(points)
+            for state in range(self.n_states):
+                assigned = labels == state
+                if weights[assigned].sum() > 0:
+                    self.centroids[state] = np.average(points[assigned],axis=0,weights=weights[assigned])
+        labels = self.nearest(points)
+        self.counts = np.array([weights[labels == state].sum() for state in range(self.n_states)])
+
+    def seed_pending(self):
+        '''
+        Seeds the centroids from the windows seen so far when there were fewer than n_states,
+        states then share windows
+        '''
+        if self.centroids is None and self.pending:
+            features = np.concatenate(self.pending)
+            self.pending = []
+            if features.shape[0]:
+                self.centroids = features[self.random_state.randint(features.shape[0],size=self.n_states)]
+                self.partial_fit(features)
+        return self
+
+    def reduce(self,comm):
+        '''
+        Merges the states of every rank, every rank gets the merged centroids. Collective.
+        '''
+        self.seed_pending()
+        gathered = comm.gather((self.centroids,self.counts),root=0)
+        if comm.rank == 0:
+            self.merge_centroids([c for c, n in gathered],[n for c, n in gathered])
+        self.centroids, self.counts = comm.bcast((self.centroids,self.counts),root=0)
+        return self
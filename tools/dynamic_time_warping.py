@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pairwise dynamic time warping distances between parcel timeseries.
+
+Distances are computed for many parcel pairs at once inside a Sakoe-Chiba band.
+Each row of the cost matrix is filled in one vectorized step: the within-row
+recurrence D[i,j] = min(m[j], c[j] + D[i,j-1]) is solved with a cumulative sum
+and a running minimum, so the python loop only runs over timepoints. Chunks of
+parcel pairs are spread over joblib worker threads.
+"""
+from joblib import Parallel, delayed
+import numpy as np
+
+from tools.batch_connectivity import zscore
+
+def banded_dtw(a,b,band):
+    '''
+    Parameters
+    ----------
+    a, b : numpy array
+        Timepoints x pairs, the two series of every pair
+    band : int
+        Sakoe-Chiba band half width in timepoints
+
+    Returns
+    -------
+    numpy array
+        Cumulative DTW distance of every pair
+    '''
+    n_timepoints, n_pairs = a.shape
+    previous = np.full((n_timepoints+1,n_pairs),np.inf)
+    previous[0] = 0.0
+    current = np.empty_like(previous)
+    for i in range(1,n_timepoints+1):
+        lo = max(1,i-band)
+        hi = min(n_timepoints,i+band)
+        # the next row only reads columns lo-1 .. hi+1 of this one
+        current[lo-1] = np.inf
+        if hi < n_timepoints:
+            current[hi+1] = np.inf
+        cost = np.abs(a[i-1][None,:] - b[lo-1:hi])
+        # best predecessor from the previous row, then the in-row recurrence
+        # D[j] = min(m[j], cost[j] + D[j-1]) == S[j] + min_{k<=j}(m[k] - S[k]) with S = cumsum(cost)
+        from_previous = cost + np.minimum(previous[lo:hi+1],previous[lo-1:hi])
+        cumulative_cost = np.cumsum(cost,axis=0)
+        current[lo:hi+1] = cumulative_cost + np.minimum.accumulate(from_previous - cumulative_cost,axis=0)
+        previous, current = current, previous
+    return previous[n_timepoints].copy()
+
+def dtw_distance_matrix(timeseries,window=0.1,n_jobs=1,chunk_size=256):
+    '''
+    Parameters
+    ----------
+    timeseries : numpy array
+        Timepoints x parcels parcellated timeseries
+    window : float
+        Band half width as a fraction of the number of timepoints
+    n_jobs : int
+        Number of joblib threads sharing the parcel pairs
+    chunk_size : int
+        Parcel pairs per vectorized call
+
+    Returns
+    -------
+    numpy array
+        Parcels x parcels DTW distances between z-scored parcel timeseries,
+        divided by the number of timepoints. Constant parcels are only centered,
+        so their distances are to a flat line.
+    '''
+    n_timepoints, n_parcels = timeseries.shape
+    zscored = zscore(timeseries)
+    band = max(1,int(np.ceil(window*n_timepoints)))
+    rows, cols = np.triu_indices(n_parcels,k=1)
+    chunks = [slice(start,start+chunk_size) for start in range(0,len(rows),chunk_size)]
+    # threads, numpy releases the GIL on the band arrays and nested worker processes
+    # are not safe inside MPI ranks or process pool workers
+    distances = Parallel(n_jobs=n_jobs,prefer='threads')(delayed(banded_dtw)(zscored[:,rows[chunk]],zscored[:,cols[chunk]],band) for chunk in chunks)
+    network_matrix = np.zeros((n_parcels,n_parcels))
+    if distances:
+        network_matrix[rows,cols] = np.concatenate(distances)/n_timepoints
+    network_matrix[cols,rows] = network_matrix[rows,cols]
+    return network_matrix
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming group summaries of the network matrices of a cohort.
+
+Matrices are added as they are estimated, so a summary holds a fixed number of
+parcels x parcels arrays whatever the cohort size:
+
+- edge-wise mean and variance, Welford updates merged batch by batch (Chan et
+  al.), with a per-edge count so non-finite values (e.g. the Fisher z diagonal
+  or fully censored bolds) are skipped
+- edge-wise percentiles from a reservoir sample of whole matrices (Vitter's
+  algorithm R), merged across ranks with a hypergeometric draw so the merged
+  reservoir is still a uniform sample of the cohort
+- a consensus matrix, the fraction of matrices in which an edge is among the
+  strongest density fraction of connections
+
+Under MPI every rank accumulates the matrices it computes and reduce merges
+them into rank 0: counts, sums and squared deviations through comm.Allreduce
+and comm.Reduce, reservoirs sent to rank 0 one rank at a time.
+"""
+import numpy as np
+import warnings
+
+from tools.shortest_paths import proportional_threshold
+
+GROUP_PERCENTILES = [5,25,50,75,95]
+# matrices kept in the reservoir the percentiles are computed from
+GROUP_RESERVOIR_SIZE = 100
+# fraction of the strongest connections counted by the consensus matrix
+GROUP_CONSENSUS_DENSITY = 0.1
+
+def consensus_edges(network_matrix,density):
+    '''
+    Boolean matrix of the strongest density fraction of the positive, finite, off-diagonal connections
+    '''
+    network_matrix = np.array(network_matrix,dtype=float)
+    network_matrix[~np.isfinite(network_matrix)] = 0
+    np.fill_diagonal(network_matrix,0)
+    network_matrix[network_matrix < 0] = 0
+    return proportional_threshold(network_matrix,density) > 0
+
+class GroupAccumulator:
+    def __init__(self,shape,reservoir_size=GROUP_RESERVOIR_SIZE,density=GROUP_CONSENSUS_DENSITY,seed=0):
+        '''
+        Parameters
+        ----------
+        shape : tuple
+            Shape of one network matrix, parcels x parcels
+        reservoir_size : int
+            Number of matrices sampled for the percentiles
+        density : float
+            Fraction of the strongest connections counted by the consensus matrix
+        seed : int
+            Seed of the reservoir sampling, e.g. the MPI rank
+        '''
+        self.shape = tuple(shape)
+        self.reservoir_size = reservoir_size
+        self.density = density
+        self.random_state = np.random.RandomState(seed)
+        # per edge number of finite values, their mean and sum of squared deviations
+        self.count = np.zeros(self.shape)
+        self.mean = np.zeros(self.shape)
+        self.sum_of_squares = np.zeros(self.shape)
+        self.consensus_count = np.zeros(self.shape)
+        self.n_matrices = 0
+        self.reservoir = np.empty((reservoir_size,)+self.shape,dtype=np.float32)
+
+    def merge_moments(self,count,mean,sum_of_squares):
+        total = self.count + count
+        delta = mean - self.mean
+        weight = np.divide(count,total,out=np.zeros(self.shape),where=total > 0)
+        self.sum_of_squares += sum_of_squares + delta**2*self.count*weight
+        self.mean += delta*weight
+        self.count = total
+
+    def update(self,network_matrices):
+        '''
+        Adds a stack of network matrices
+        '''
+        network_matrices = np.asarray(network_matrices,dtype=float)
+        finite = np.isfinite(network_matrices)
+        count = finite.sum(axis=0).astype(float)
+        values = np.where(finite,network_matrices,0)
+        mean = np.divide(values.sum(axis=0),count,out=np.zeros(self.shape),where=count > 0)
+        sum_of_squares = (np.where(finite,network_matrices - mean,0)**2).sum(axis=0)
+        self.merge_moments(count,mean,sum_of_squares)
+        for network_matrix in network_matrices:
+            self.consensus_count += consensus_edges(network_matrix,self.density)
+            # algorithm R
+            if self.n_matrices < self.reservoir_size:
+                self.reservoir[self.n_matrices] = network_matrix
+            else:
+                slot = self.random_state.randint(0,self.n_matrices+1)
+                if slot < self.reservoir_size:
+                    self.reservoir[slot] = network_matrix
+            self.n_matrices += 1
+        return self
+
+    def merge_reservoir(self,reservoir,n_matrices):
+        '''
+        Merges the reservoir of n_matrices other matrices: the number kept from each side is
+        hypergeometric, so every matrix of both sides is equally likely to be kept
+        '''
+        kept = min(self.reservoir_size,self.n_matrices + n_matrices)
+        own_sample = self.reservoir[:min(self.n_matrices,self.reservoir_size)]
+        other_sample = reservoir[:min(n_matrices,self.reservoir_size)]
+        if self.n_matrices and n_matrices:
+            n_own = self.random_state.hypergeometric(self.n_matrices,n_matrices,kept)
+        else:
+            n_own = kept if self.n_matrices else 0
+        merged = np.concatenate([own_sample[self.random_state.permutation(own_sample.shape[0])[:n_own]],
+                                 other_sample[self.random_state.permutation(other_sample.shape[0])[:kept - n_own]]])
+        self.reservoir[:kept] = merged
+        self.n_matrices += n_matrices
+
+    def merge(self,other):
+        '''
+        Merges another accumulator of the same shape into this one
+        '''
+        self.merge_moments(other.count,other.mean,other.sum_of_squares)
+        self.consensus_count += other.consensus_count
+        self.merge_reservoir(other.reservoir,other.n_matrices)
+        return self
+
+    def reduce(self,comm):
+        '''
+        Merges the accumulators of every rank into rank 0's. Collective.
+        '''
+        from mpi4py import MPI
+        count = np.zeros(self.shape)
+        comm.Allreduce(self.count,count,op=MPI.SUM)
+        total = np.zeros(self.shape)
+        comm.Allreduce(self.count*self.mean,total,op=MPI.SUM)
+        mean = np.divide(total,count,out=np.zeros(self.shape),where=count > 0)
+        # squared deviations about the group mean, summed over ranks
+        sum_of_squares = np.zeros(self.shape)
+        comm.Reduce(self.sum_of_squares + self.count*(self.mean - mean)**2,sum_of_squares,op=MPI.SUM,root=0)
+        consensus_count = np.zeros(self.shape)
+        comm.Reduce(self.consensus_count,consensus_count,op=MPI.SUM,root=0)
+        # one reservoir in flight at a time, rank 0 never holds more than two
+        for source in range(1,comm.size):
+            if comm.rank == source:
+                comm.send(self.n_matrices,dest=0,tag=source)
+                comm.Send(self.reservoir,dest=0,tag=source)
+            elif comm.rank == 0:
+                n_matrices = comm.recv(source=source,tag=source)
+                reservoir = np.empty_like(self.reservoir)
+                comm.Recv(reservoir,source=source,tag=source)
+                self.merge_reservoir(reservoir,n_matrices)
+        if comm.rank == 0:
+            self.count, self.mean, self.sum_of_squares, self.consensus_count = count, mean, sum_of_squares, consensus_count
+        return self
+
+    def statistics(self):
+        '''
+        Returns
+        -------
+        dict
+            count, mean and (unbiased) variance per edge, GROUP_PERCENTILES x parcels x parcels
+            percentiles of the reservoir and the consensus fraction of every edge
+        '''
+        sample = self.reservoir[:min(self.n_matrices,self.reservoir_size)].astype(float)
+        sample[~np.isfinite(sample)] = np.nan
+        with np.errstate(invalid='ignore',divide='ignore'):
+            variance = np.where(self.count > 1,self.sum_of_squares/(self.count - 1),np.nan)
+            mean = np.where(self.count > 0,self.mean,np.nan)
+            consensus = self.consensus_count/self.n_matrices if self.n_matrices else np.full(self.shape,np.nan)
+        if sample.shape[0]:
+            with warnings.catch_warnings():
+                # edges that are never finite, e.g. the Fisher z diagonal, stay NaN
+                warnings.simplefilter('ignore',RuntimeWarning)
+                percentiles = np.nanpercentile(sample,GROUP_PERCENTILES,axis=0)
+        else:
+            percentiles = np.full((len(GROUP_PERCENTILES),)+self.shape,np.nan)
+        return {'count':self.count,'mean':mean,'variance':variance,'percentiles':percentiles,'consensus':consensus}
+
+    def statistic_shapes(self):
+        return {'count':self.shape,'mean':self.shape,'variance':self.shape,
+                'percentiles':(len(GROUP_PERCENTILES),)+self.shape,'consensus':self.shape}
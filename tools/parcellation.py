@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parcellation of dense CIFTI timeseries without leaving the python process.
+
+A CIFTI label file is read once and turned into a sparse parcel x grayordinate
+averaging matrix, so parcellating a dense timeseries is a single sparse matrix
+multiply. The wb_command -cifti-parcellate route is kept for comparison.
+
+Parsing a large label file is slow, so parcellations are cached per process in
+parcellation_cache, keyed by the content hash of the label file, and can be
+persisted as .npz files that other processes load instead of the CIFTI file.
+"""
+from collections import OrderedDict
+import hashlib
+import nibabel.cifti2 as ci
+import numpy as np
+import os
+import scipy.sparse as sp
+
+from tools.cifti_io import CiftiReader
+
+# wb_command of the Singularity image, only used by the workbench engine and compare_with_workbench
+WORKBENCH_COMMAND = '/opt/workbench/bin_rh_linux64/wb_command'
+
+class ParcellationIO:
+    def __init__(self,parcel_file):
+        '''
+        Parameters
+        ----------
+        parcel_file : string
+            The CIFTI label file to use or used to parcellate the brain.
+
+        Returns
+        -------
+        None.
+
+        Attributes
+        ----------
+        parcel_labels : list
+            Parcel names ordered by ascending label key, as wb_command -cifti-parcellate orders them
+        parcel_keys : numpy array
+            Label key of every parcel
+        parcel_count : int
+            Number of parcels with at least one grayordinate
+        grayordinate_index : numpy array
+            Parcel index of every grayordinate, -1 for grayordinates outside of any parcel
+        operator : scipy.sparse.csr_matrix
+            Parcel x grayordinate matrix that averages grayordinates within each parcel
+        '''
+        self.parcel_file = parcel_file
+        import cifti
+        try:
+            read_parcel_file = cifti.read(self.parcel_file)
+        except TypeError:
+            raise TypeError('%s does not look like a CIFTI parcel file.' % self.parcel_file)
+        parcel_file_label_tuple = read_parcel_file[1][0][0][1]
+        grayordinate_keys = np.asarray(read_parcel_file[0][0]).astype(int)
+
+        # labels without any grayordinate are dropped, matching wb_command's default behaviour
+        present_keys = set(np.unique(grayordinate_keys))
+        parcel_keys = []
+        parcel_labels = []
+        for value in sorted(parcel_file_label_tuple):
+            if '???' in parcel_file_label_tuple[value][0] or not value in present_keys:
+                continue
+            parcel_keys.append(value)
+            parcel_labels.append(str(parcel_file_label_tuple[value][0]))
+        self.parcel_keys = np.array(parcel_keys,dtype=int)
+        self.parcel_labels = parcel_labels
+        self.parcel_count = len(parcel_labels)
+        self.grayordinate_count = grayordinate_keys.shape[0]
+
+        # map every grayordinate to its parcel index
+        key_to_index = dict(zip(parcel_keys,range(self.parcel_count)))
+        self.grayordinate_index = np.array([key_to_index.get(key,-1) for key in grayordinate_keys],dtype=int)
+        self.build_operator()
+
+    @classmethod
+    def from_npz(cls,parcel_file,npz_file):
+        '''
+        Restores a parcellation saved with save_npz without reading the CIFTI label file
+        '''
+        parcellation = cls.__new__(cls)
+        parcellation.parcel_file = parcel_file
+        with np.load(npz_file) as cached:
+            parcellation.parcel_labels = [str(label) for label in cached['parcel_labels']]
+            parcellation.parcel_keys = cached['parcel_keys']
+            parcellation.grayordinate_index = cached['grayordinate_index']
+        parcellation.parcel_count = len(parcellation.parcel_labels)
+        parcellation.grayordinate_count = parcellation.grayordinate_index.shape[0]
+        parcellation.build_operator()
+        return parcellation
+
+    def save_npz(self,npz_file):
+        '''
+        Writes the label list, parcel keys and grayordinate -> parcel index to npz_file.
+        The file is written under a temporary name and moved into place so concurrent
+        readers never see a partial file.
+        '''
+        tmp_file = npz_file + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_file,
+                 parcel_labels=np.array(self.parcel_labels),
+                 parcel_keys=self.parcel_keys,
+                 grayordinate_index=self.grayordinate_index)
+        os.replace(tmp_file,npz_file)
+
+    def build_operator(self):
+        '''
+        Builds the sparse parcel x grayordinate averaging matrix from grayordinate_index
+        '''
+        labelled = np.where(self.grayordinate_index >= 0)[0]
+        rows = self.grayordinate_index[labelled]
+        counts = np.bincount(rows,minlength=self.parcel_count).astype(float)
+        self.operator = sp.csr_matrix((1.0/counts[rows],(rows,labelled)),
+                                      shape=(self.parcel_count,self.grayordinate_count))
+
+    def parcellate(self,dense_data):
+        '''
+        Parameters
+        ----------
+        dense_data : numpy array
+            Timepoints x grayordinates dense timeseries
+
+        Returns
+        -------
+        numpy array
+            Timepoints x parcels timeseries, the mean of each parcel's grayordinates
+        '''
+        if dense_data.shape[-1] != self.grayordinate_count:
+            raise ValueError('Dense data has %d grayordinates but %s has %d'
+                             % (dense_data.shape[-1],self.parcel_file,self.grayordinate_count))
+        return np.asarray(self.operator.dot(dense_data.T).T)
+
+    def parcellate_reader(self,cifti_reader):
+        '''
+        Parcellates a dense timeseries by accumulating over grayordinate chunks of a
+        tools.cifti_io.CiftiReader, so the full dense array is never held in memory.
+
+        Returns
+        -------
+        numpy array
+            Timepoints x parcels timeseries
+        '''
+        if cifti_reader.n_grayordinates != self.grayordinate_count:
+            raise ValueError('%s has %d grayordinates but %s has %d'
+                             % (cifti_reader.cifti_file,cifti_reader.n_grayordinates,self.parcel_file,self.grayordinate_count))
+        operator_columns = self.operator.tocsc()
+        parcellated = np.zeros((cifti_reader.n_timepoints,self.parcel_count))
+        for start, stop, chunk in cifti_reader.iter_grayordinate_chunks():
+            parcellated += operator_columns[:,start:stop].dot(chunk.T).T
+        return parcellated
+
+def file_hash(path,block_size=1<<20):
+    '''
+    SHA1 of a file's content, read in blocks
+    '''
+    sha1 = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class ParcellationCache:
+    def __init__(self,maxsize=4):
+        '''
+        Least recently used cache of ParcellationIO objects keyed by label file content hash.
+
+        Parameters
+        ----------
+        maxsize : int
+            Number of parcellations kept in memory before the least recently used one is evicted.
+        '''
+        self.maxsize = maxsize
+        self.parcellations = OrderedDict()
+        # content hashes memoized by (path, mtime, size) so a label file is hashed once
+        self.hashes = {}
+
+    def atlas_hash(self,parcel_file):
+        stat = os.stat(parcel_file)
+        hash_key = (os.path.realpath(parcel_file),stat.st_mtime,stat.st_size)
+        if not hash_key in self.hashes:
+            self.hashes[hash_key] = file_hash(parcel_file)
+        return self.hashes[hash_key]
+
+    def get(self,parcel_file,cache_dir=None):
+        '''
+        Parameters
+        ----------
+        parcel_file : string
+            The CIFTI label file to use or used to parcellate the brain.
+        cache_dir : string
+            Optional folder holding parcellation_<hash>.npz files. A cached file is loaded
+            when present, otherwise it is written after the label file has been parsed.
+
+        Returns
+        -------
+        ParcellationIO
+        '''
+        atlas_hash = self.atlas_hash(parcel_file)
+        if atlas_hash in self.parcellations:
+            self.parcellations.move_to_end(atlas_hash)
+            return self.parcellations[atlas_hash]
+        npz_file = None
+        if cache_dir:
+            npz_file = os.path.join(cache_dir,'parcellation_' + atlas_hash + '.npz')
+        if npz_file and os.path.isfile(npz_file):
+            parcellation = ParcellationIO.from_npz(parcel_file,npz_file)
+        else:
+            parcellation = ParcellationIO(parcel_file)
+            if npz_file:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                parcellation.save_npz(npz_file)
+        parcellation.atlas_hash = atlas_hash
+        self.parcellations[atlas_hash] = parcellation
+        while len(self.parcellations) > self.maxsize:
+            self.parcellations.popitem(last=False)
+        return parcellation
+
+# module level cache shared by every NetworkIO instance in a process
+parcellation_cache = ParcellationCache()
+
+def workbench_parcellate(cifti_file,parcel_file,parcellated_cifti_file):
+    '''
+    Parcellates a dense timeseries with wb_command -cifti-parcellate and loads the result.
+
+    Parameters
+    ----------
+    cifti_file : string
+        Path to the dense timeseries
+    parcel_file : string
+        The CIFTI label file to use or used to parcellate the brain.
+    parcellated_cifti_file : string
+        Where wb_command writes the parcellated timeseries
+
+    Returns
+    -------
+    numpy array
+        Timepoints x parcels timeseries
+    '''
+    os.system("%s -cifti-parcellate %s %s %s %s"
+              % (WORKBENCH_COMMAND,
+                 cifti_file,
+                 parcel_file,
+                 "COLUMN",
+                 parcellated_cifti_file))
+    # does CIFTI file exist?
+    try:
+        read_cifti = open(parcellated_cifti_file)
+        read_cifti.close()
+    except IOError:
+        print("file does not exist")
+    # is entered CIFTI file actually a CIFTI file?
+    try:
+        return ci.load(parcellated_cifti_file).get_fdata()
+    except:
+        print("file does not look like a cifti file")
+
+def compare_with_workbench(cifti_file,parcel_file,output_dir):
+    '''
+    Numerically checks the in-process parcellation against wb_command output.
+
+    Parameters
+    ----------
+    cifti_file : string
+        Path to the dense timeseries
+    parcel_file : string
+        The CIFTI label file to use or used to parcellate the brain.
+    output_dir : string
+        Where the wb_command parcellated timeseries is written
+
+    Returns
+    -------
+    float
+        Maximum absolute difference between the two parcellated timeseries
+    '''
+    parcellation = ParcellationIO(parcel_file)
+    numpy_parcellated = parcellation.parcellate_reader(CiftiReader(cifti_file))
+    parcellated_cifti_file = os.path.join(output_dir,os.path.basename(cifti_file).split('.')[0]) + '_workbench_check.ptseries.nii'
+    workbench_parcellated = workbench_parcellate(cifti_file,parcel_file,parcellated_cifti_file)
+    # align parcels by name, wb_command writes them into the ptseries parcels axis
+    workbench_labels = list(ci.load(parcellated_cifti_file).header.get_axis(1).name)
+    if sorted(workbench_labels) != sorted(parcellation.parcel_labels):
+        raise ValueError('Parcels produced by wb_command do not match the parcels in %s' % parcel_file)
+    order = [workbench_labels.index(label) for label in parcellation.parcel_labels]
+    return float(np.max(np.abs(numpy_parcellated - workbench_parcellated[:,order])))
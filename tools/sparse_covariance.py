@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Graphical lasso fits for the sparse_inverse_* network metrics.
+
+One fit per scan gives both the sparse covariance and the sparse precision.
+The regularization is either fixed for the whole cohort, or cross-validated
+on a narrow grid around the alpha already selected for the rest of the cohort.
+The full GraphicalLassoCV search only runs when there is no cohort alpha yet,
+or when the cohort alpha turns out to be a poor fit for a scan, i.e. the
+selected alpha lands on the edge of the narrow grid. Cross-validation folds run
+on joblib threads, because the coordinate descent solver releases the GIL and
+worker processes are not safe inside MPI ranks or process pool workers.
+"""
+import numpy as np
+
+SPARSE_METRICS = ['sparse_inverse_covariance','sparse_inverse_precision']
+
+# narrow grid around the cohort alpha: WARM_GRID_SIZE alphas from alpha/WARM_GRID_RANGE to alpha*WARM_GRID_RANGE
+WARM_GRID_SIZE = 5
+WARM_GRID_RANGE = 3.0
+
+def sparse_alpha_grid(alpha):
+    '''
+    Decreasing geometric grid of alphas centered on alpha
+    '''
+    return list(alpha*np.logspace(np.log10(WARM_GRID_RANGE),-np.log10(WARM_GRID_RANGE),WARM_GRID_SIZE))
+
+def fit_graphical_lasso(timeseries,alpha=None,warm_alpha=None,n_jobs=1):
+    '''
+    Parameters
+    ----------
+    timeseries : numpy array
+        Timepoints x parcels parcellated timeseries
+    alpha : float
+        Fixed regularization, skips cross-validation
+    warm_alpha : float
+        Alpha selected for the cohort so far, cross-validation only searches around it
+    n_jobs : int
+        Number of threads the cross-validation folds run on
+
+    Returns
+    -------
+    covariance : numpy array
+        Parcels x parcels sparse covariance
+    precision : numpy array
+        Parcels x parcels sparse precision
+    alpha : float
+        The regularization used
+    '''
+    # scikit-learn is only loaded by ranks that fit a sparse metric
+    from joblib import parallel_backend
+    from sklearn.covariance import GraphicalLasso, GraphicalLassoCV
+    with parallel_backend('threading',n_jobs=n_jobs):
+        if alpha is not None:
+            estimator = GraphicalLasso(alpha=alpha).fit(timeseries)
+            return estimator.covariance_, estimator.precision_, alpha
+        if warm_alpha is not None:
+            alphas = sparse_alpha_grid(warm_alpha)
+            estimator = GraphicalLassoCV(alphas=alphas,n_jobs=n_jobs).fit(timeseries)
+            if not np.isclose(estimator.alpha_,alphas[0]) and not np.isclose(estimator.alpha_,alphas[-1]):
+                return estimator.covariance_, estimator.precision_, estimator.alpha_
+        estimator = GraphicalLassoCV(n_jobs=n_jobs).fit(timeseries)
+    return estimator.covariance_, estimator.precision_, estimator.alpha_
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Wall time, CPU time and peak memory of the stages of a MACCHIATO run.
+
+Stages are timed with the process-wide stage_timer, e.g.
+
+    with stage_timer.stage('parcellate',cifti_file):
+        ...
+
+Records stay in the process that made them. Pool workers return theirs with
+every task (drain), MPI ranks gather them to rank 0 (gather), which stores them
+as the timings table of the HDF5 output and optionally as a Chrome trace file
+(chrome://tracing or https://ui.perfetto.dev) with one row per rank.
+"""
+from contextlib import contextmanager
+import json
+import numpy as np
+import os
+import resource
+import sys
+import threading
+import time
+
+# one row of the timings table, max_rss_mb is the peak memory of the process up to the end of
+# the stage, not of the stage alone
+TIMING_DTYPE = np.dtype([('rank','i4'),('pid','i8'),('stage','S64'),('bold','S1024'),('start','f8'),
+                         ('wall_seconds','f8'),('cpu_seconds','f8'),('max_rss_mb','f8')])
+
+def max_rss_mb():
+    '''
+    Peak resident memory of this process so far, ru_maxrss is in kB on Linux and bytes on macOS
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/1024.0**2
+    return peak/1024.0
+
+class StageTimer:
+    def __init__(self):
+        '''
+        Collects (rank, pid, stage, bold, start, wall_seconds, cpu_seconds, max_rss_mb) records.
+        CPU time is the process's, so it includes other threads of a threads backend. max_rss_mb
+        is the high-water mark of the process when the stage ends: it only grows, and a stage
+        that stays below an earlier peak reports that peak.
+        '''
+        self.rank = 0
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self,name,bold=''):
+        '''
+        Times the enclosed block as stage name of bold, a path, a list of combined runs or a batch_label
+        '''
+        start = time.time()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = (self.rank,os.getpid(),name,bold_label(bold),start,time.perf_counter() - wall_start,
+                      time.process_time() - cpu_start,max_rss_mb())
+            with self.lock:
+                self.records.append(record)
+
+    def drain(self):
+        '''
+        Returns and forgets the records made so far
+        '''
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+    def extend(self,records):
+        with self.lock:
+            self.records.extend(records)
+
+    def gather(self,comm):
+        '''
+        Drains the records of every rank to rank 0. Collective.
+
+        Returns
+        -------
+        list
+            Records of all ranks on rank 0, an empty list on the other ranks
+        '''
+        gathered = comm.gather(self.drain(),root=0)
+        if comm.rank != 0:
+            return []
+        return [record for records in gathered for record in records]
+
+def bold_label(bold):
+    '''
+    A bold path, combined runs joined with ";" like the bold_path of the output
+    '''
+    if type(bold) == list:
+        return ';'.join(bold)
+    return bold
+
+def batch_label(bolds):
+    '''
+    The bolds of a batch joined with "|"
+    '''
+    return '|'.join(bold_label(bold) for bold in bolds)
+
+def timing_table(records):
+    '''
+    Records as a TIMING_DTYPE array, stage and bold names are truncated to fit
+    '''
+    table = np.zeros(len(records),dtype=TIMING_DTYPE)
+    for row, (rank, pid, name, bold, start, wall_seconds, cpu_seconds, rss) in enumerate(records):
+        table[row] = (rank,pid,name.encode('utf-8')[:64],bold.encode('utf-8')[:1024],start,wall_seconds,cpu_seconds,rss)
+    return table
+
+def write_trace(trace_file,records):
+    '''
+    Writes records as Chrome trace events: one process row per rank, one thread row per worker process
+    '''
+    if not records:
+        return
+    origin = min(record[4] for record in records)
+    events = [{'name':name,'ph':'X','ts':(start-origin)*1e6,'dur':wall_seconds*1e6,'pid':rank,'tid':pid,
+               'args':{'bold':bold,'cpu_seconds':cpu_seconds,'max_rss_mb':rss}}
+              for rank, pid, name, bold, start, wall_seconds, cpu_seconds, rss in records]
+    with open(trace_file,'w') as trace:
+        json.dump({'traceEvents':events,'displayTimeUnit':'ms'},trace)
+
+# timer of this process, the rank is set once MPI is initialized
+stage_timer = StageTimer()
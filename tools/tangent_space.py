@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tangent space embedding of a cohort of covariance matrices.
+
+The tangent embedding needs a group reference, the geometric (Riemannian) mean
+of every scan's covariance, so it is computed in two passes over the cohort:
+pass one estimates the covariances (the regular covariance task), pass two
+fits the geometric mean and projects each covariance into the tangent space at
+that mean. Covariances are streamed in chunks and matrix functions are applied
+with batched eigendecompositions. The sums of each mean iteration go through a
+reduce callable, so MPI ranks can each stream their own share of the cohort.
+
+This follows nilearn's ConnectivityMeasure(kind='tangent') with an empirical
+covariance estimator.
+"""
+import numpy as np
+
+def batch_map_eigenvalues(function,matrices):
+    '''
+    Applies function to the eigenvalues of every symmetric matrix in a stack
+    '''
+    eigenvalues, eigenvectors = np.linalg.eigh(matrices)
+    return np.matmul(eigenvectors*function(eigenvalues)[...,None,:],np.swapaxes(eigenvectors,-1,-2))
+
+def map_eigenvalues(function,matrix):
+    return batch_map_eigenvalues(function,matrix[None])[0]
+
+class TangentSpace:
+    def __init__(self,max_iter=30,tol=1e-7):
+        '''
+        Parameters
+        ----------
+        max_iter : int
+            Maximum number of gradient steps of the geometric mean
+        tol : float
+            Stops when the norm of the mean log step per matrix entry falls below tol
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.max_iter = max_iter
+        self.tol = tol
+        self.reference = None
+        self.whitening = None
+        self.count = 0
+
+    def fit(self,covariance_chunks,reduce=None):
+        '''
+        Estimates the geometric mean of the cohort.
+
+        Parameters
+        ----------
+        covariance_chunks : callable
+            Returns a fresh iterator over scans x parcels x parcels chunks of covariances.
+            It is called once per iteration.
+        reduce : callable
+            Sums a (count, array) pair over processes, e.g. an MPI allreduce. None when
+            this process sees the whole cohort.
+
+        Returns
+        -------
+        self
+        '''
+        if reduce is None:
+            reduce = lambda value: value
+        # the arithmetic mean is the starting point
+        count, total = reduce(self.chunk_sum(covariance_chunks(),lambda chunk: chunk))
+        if count == 0:
+            raise ValueError('The tangent space reference needs at least one covariance matrix')
+        self.count = count
+        reference = total/count
+        step = 1.0
+        previous_norm = np.inf
+        for iteration in range(self.max_iter):
+            eigenvalues, eigenvectors = np.linalg.eigh(reference)
+            inverse_sqrt = (eigenvectors/np.sqrt(eigenvalues)).dot(eigenvectors.T)
+            sqrt = (eigenvectors*np.sqrt(eigenvalues)).dot(eigenvectors.T)
+            whiten_log = lambda chunk: batch_map_eigenvalues(np.log,np.matmul(np.matmul(inverse_sqrt,chunk),inverse_sqrt))
+            count, log_sum = reduce(self.chunk_sum(covariance_chunks(),whiten_log))
+            log_mean = log_sum/count
+            if np.any(np.isnan(log_mean)):
+                raise FloatingPointError('The tangent space reference diverged, are all covariances positive definite?')
+            norm = np.linalg.norm(log_mean)
+            # move along the geodesic towards the mean of the logs
+            reference = sqrt.dot(map_eigenvalues(np.exp,step*log_mean)).dot(sqrt)
+            if norm < previous_norm:
+                previous_norm = norm
+            elif norm > previous_norm:
+                # overshoot, take smaller steps from now on
+                step /= 2.0
+                norm = previous_norm
+            if norm/log_mean.size < self.tol:
+                break
+        self.reference = reference
+        self.whitening = map_eigenvalues(lambda x: 1.0/np.sqrt(x),reference)
+        return self
+
+    @staticmethod
+    def chunk_sum(chunks,function):
+        count = 0
+        total = 0.0
+        for chunk in chunks:
+            if len(chunk):
+                count += len(chunk)
+                total = total + function(np.asarray(chunk,dtype=float)).sum(axis=0)
+        return count, total
+
+    def transform(self,covariance):
+        '''
+        Parameters
+        ----------
+        covariance : numpy array
+            Scans x parcels x parcels covariances
+
+        Returns
+        -------
+        numpy array
+            Scans x parcels x parcels tangent space embedding, logm(W C W) with W the
+            inverse square root of the reference
+        '''
+        whitened = np.matmul(np.matmul(self.whitening,np.asarray(covariance,dtype=float)),self.whitening)
+        return batch_map_eigenvalues(np.log,whitened)
@@ -6,25 +6,336 @@ Created on Thu May  7 17:56:52 2020
 @author: timothy
 """
 
-from scipy.signal import butter,filtfilt,periodogram
-from entropy import sample_entropy
-import pywt
-import nibabel
+import nibabel.cifti2 as ci
 import numpy as np
-from subprocess import Popen, PIPE
-import subprocess
+import os
+
+from tools.batch_connectivity import batch_network_matrices
+from tools.cifti_io import CiftiReader
 # alff, entropy, wavelet,
 
+# metrics computed from one spectrum
+ALFF_METRICS = ['alff','falff']
+# sample entropy is multiscale entropy at scale 1, both come from one computation
+ENTROPY_METRICS = ['sample_entropy','multiscale_entropy']
+# one value (per scale) for every parcel or grayordinate, written as scalar CIFTI files
+SCALAR_METRICS = ALFF_METRICS + ENTROPY_METRICS
+TIME_SERIES_METRICS = SCALAR_METRICS + ['wavelet']
+# low frequency band of ALFF and fALFF in Hz
+ALFF_BAND = (0.01,0.08)
+# working set of one chunk of grayordinates in the ALFF spectra
+ALFF_CHUNK_BYTES = 32*1024**2
+# maximal overlap DWT of the wavelet metric, Daubechies least asymmetric 8 (la8)
+WAVELET = 'sym4'
+# scale j covers 1/(2**(j+1)*TR) to 1/(2**j*TR) Hz
+WAVELET_SCALES = 6
+# template length m, tolerance r as a fraction of the standard deviation, coarse graining scales
+ENTROPY_ORDER = 2
+ENTROPY_TOLERANCE = 0.2
+ENTROPY_SCALES = 5
+# series whose templates are matched together
+ENTROPY_CHUNK = 16
+
+def modified_daniell_kernel(spans):
+    '''
+    Weights of R's kernel("modified.daniell", spans %/% 2): one modified Daniell
+    kernel per span, convolved together
+    '''
+    weights = np.ones(1)
+    for span in spans:
+        m = span//2
+        if m < 1:
+            continue
+        daniell = np.full(2*m+1,1.0/(2*m))
+        daniell[0] = daniell[-1] = 1.0/(4*m)
+        weights = np.convolve(weights,daniell)
+    return weights
+
+def periodograms(timeseries,taper=0.1):
+    '''
+    Raw periodograms of every column of timeseries, computed like R's spec.pgram with
+    detrend=TRUE and fast=TRUE: linear detrend, split cosine bell taper and zero padding
+    to a 2/3/5-smooth length. float32 input stays in single precision.
+
+    Returns
+    -------
+    periodogram : numpy array
+        (n_fft//2 + 1) x series, frequencies k/n_fft for k = 0..n_fft//2 cycles per timepoint
+    n_fft : int
+        Padded length
+    '''
+    n_timepoints = timeseries.shape[0]
+    x = np.asarray(timeseries,dtype=np.result_type(timeseries.dtype,np.float32))
+    # linear detrend, spec.pgram's detrend=TRUE
+    t = (np.arange(1,n_timepoints+1) - (n_timepoints+1)/2.0).astype(x.dtype)
+    sumt2 = n_timepoints*(n_timepoints**2 - 1)/12.0
+    x = x - x.mean(axis=0) - np.outer(t,t.dot(x)/sumt2).astype(x.dtype)
+    # split cosine bell over taper of each end
+    m = int(np.floor(n_timepoints*taper))
+    if m > 0:
+        w = 0.5*(1 - np.cos(np.pi*np.arange(1,2*m,2)/(2*m)))
+        bell = np.ones(n_timepoints,dtype=x.dtype)
+        bell[:m] = w
+        bell[-m:] = w[::-1]
+        x *= bell[:,None]
+    from scipy.fftpack import next_fast_len
+    import scipy.fft
+    n_fft = next_fast_len(n_timepoints)
+    spectrum = scipy.fft.rfft(x,n=n_fft,axis=0)
+    periodogram = spectrum.real**2 + spectrum.imag**2
+    periodogram /= n_timepoints
+    # spec.pgram replaces the zero frequency by the mean of its two neighbours, p[1] == p[n_fft - 1]
+    periodogram[0] = periodogram[1]
+    return periodogram, n_fft
+
+def circular_kernel(kernel,n_fft):
+    '''
+    Symmetric smoothing kernel laid out for a circular convolution of length n_fft
+    '''
+    radius = len(kernel)//2
+    circular = np.zeros(n_fft)
+    circular[:radius+1] = kernel[radius:]
+    if radius:
+        circular[-radius:] = kernel[:radius]
+    return circular
+
+def smooth_periodogram(periodogram,n_fft,kernel):
+    '''
+    Circular kernel smoothing (R's kernapply(circular=TRUE)) of the full, symmetric
+    periodogram given by its first n_fft//2 + 1 frequencies. The convolution is a product
+    in the autocovariance domain, where the periodogram and the kernel are both real.
+    '''
+    import scipy.fft
+    kernel_transform = np.fft.fft(circular_kernel(kernel,n_fft)).real.astype(periodogram.dtype)
+    autocovariance = scipy.fft.irfft(periodogram,n=n_fft,axis=0)
+    autocovariance *= kernel_transform[:,None]
+    return scipy.fft.rfft(autocovariance,axis=0).real
+
+def smoothing_matrix(kernel,n_fft,frequencies):
+    '''
+    Matrix that maps the first n_fft//2 + 1 frequencies of a periodogram to its circularly
+    smoothed values at the given frequency indices. Used when only a band is needed.
+    '''
+    radius = len(kernel)//2
+    matrix = np.zeros((len(frequencies),n_fft//2+1))
+    for row, frequency in enumerate(frequencies):
+        # fold the circular neighbours k of the full periodogram onto k or n_fft - k
+        neighbours = np.arange(frequency-radius,frequency+radius+1) % n_fft
+        neighbours = np.minimum(neighbours,n_fft-neighbours)
+        np.add.at(matrix[row],neighbours,kernel)
+    return matrix
+
+def alff_falff(timeseries,TR,band=ALFF_BAND,spans=None):
+    '''
+    ALFF and fALFF of every column of timeseries, following alff.R: spec.pgram
+    periodograms smoothed by modified Daniell kernels of spans floor(.12*n/2)*rep(1,2),
+    ALFF is the mean square root power in band of the band-pass filtered (2nd order
+    Butterworth) series, fALFF the summed square root power in band over the total, on
+    the unfiltered series.
+
+    The Butterworth filter is applied as its squared magnitude response on the periodogram,
+    and frequencies are in Hz (k/(n_fft*TR)); alff.R scales spec.pgram's cycles per timepoint
+    by 1/(2*TR), which puts the band at half the intended frequencies.
+
+    Parameters
+    ----------
+    timeseries : numpy array
+        Timepoints x series, e.g. a chunk of grayordinates or a parcellated timeseries
+    TR : float
+        Repetition time in seconds
+    band : tuple
+        Low and high end of the band in Hz
+
+    Returns
+    -------
+    alff, falff : numpy array
+        One value per series
+    '''
+    n_timepoints = timeseries.shape[0]
+    if spans is None:
+        spans = [int(np.floor(.12*n_timepoints/2))]*2
+    # spec.pgram's taper=0.1 inflates the spectrum by 1/u2
+    u2 = 1 - (5.0/8.0)*0.1*2
+    periodogram, n_fft = periodograms(timeseries)
+    kernel = modified_daniell_kernel(spans)
+    hertz = np.arange(n_fft//2+1)/(n_fft*TR)
+    # spec.pgram drops the zero frequency
+    in_band = np.flatnonzero((hertz >= band[0]) & (hertz <= band[1]) & (hertz > 0))
+    from scipy.signal import butter,freqz
+    bf_b, bf_a = butter(N=2,Wn=np.array(band)/(1/TR/2),btype="bandpass") # 2nd order butterworth filter with band pass 0.01-0.08 Hz
+    w, h = freqz(bf_b,bf_a,worN=2*np.pi*np.arange(n_fft//2+1)/n_fft)
+    power_response = np.abs(h)**2
+    # the zero frequency of the filtered periodogram is patched like the raw one
+    power_response[0] = power_response[1]
+    # filtered spectrum in band only: smoothing of |H|^2 x periodogram as one matrix product
+    band_matrix = smoothing_matrix(kernel,n_fft,in_band)*power_response[None,:]
+    filtered_amplitude = np.sqrt(band_matrix.astype(periodogram.dtype).dot(periodogram)/u2)
+    alff = filtered_amplitude.mean(axis=0)
+    amplitude = np.sqrt(np.maximum(smooth_periodogram(periodogram,n_fft,kernel)[1:n_fft//2+1],0)/u2)
+    falff = amplitude[in_band-1].sum(axis=0)/amplitude.sum(axis=0)
+    return alff, falff
+
+def wavelet_details(timeseries,wavelet=WAVELET,scales=WAVELET_SCALES):
+    '''
+    Maximal overlap (stationary) wavelet transform of every column of timeseries,
+    computed in one pywt.swt call along time. The series is extended symmetrically to a
+    multiple of 2**levels and the coefficients are cut back to the original length.
+
+    Returns
+    -------
+    numpy array
+        Levels x timepoints x series detail coefficients of scales 1..levels, where levels
+        is at most scales and limited by the number of timepoints
+    '''
+    import pywt
+    n_timepoints = timeseries.shape[0]
+    levels = min(scales,pywt.dwt_max_level(n_timepoints,pywt.Wavelet(wavelet).dec_len))
+    padded_length = -(-n_timepoints//2**levels)*2**levels
+    padded = np.pad(np.asarray(timeseries,dtype=np.float64),((0,padded_length-n_timepoints),(0,0)),mode='symmetric')
+    # [approximation at levels, details at levels, ..., details at 1], energy preserving like the MODWT
+    coefficients = pywt.swt(padded,wavelet,level=levels,axis=0,trim_approx=True,norm=True)
+    return np.stack(coefficients[:0:-1])[:,:n_timepoints,:]
+
+def wavelet_correlations(timeseries,fishers_r_to_z_transform='NO',wavelet=WAVELET,scales=WAVELET_SCALES):
+    '''
+    Scale specific correlation matrices: the timeseries is decomposed once and the
+    correlations of all scales are computed as one batch.
+
+    Returns
+    -------
+    numpy array
+        Scales x parcels x parcels, NaN for scales the timeseries is too short for
+    '''
+    details = wavelet_details(timeseries,wavelet,scales)
+    correlations = np.full((scales,timeseries.shape[1],timeseries.shape[1]),np.nan)
+    correlations[:details.shape[0]] = batch_network_matrices(details,['correlation'],fishers_r_to_z_transform)['correlation']
+    return correlations
+
+def template_matches(scaled,order):
+    '''
+    Counts the ordered pairs of distinct templates of length order (B) and order + 1 (A)
+    within Chebyshev distance 1 of every series, over the first n - order templates.
+    Templates are sorted by their first value, so the candidates of a template are the
+    contiguous window of templates whose first value is within 1. The windows of all
+    series are searched at once by offsetting every series along one sorted axis, and
+    the candidate pairs are checked on the remaining values in one vectorized pass.
+
+    Parameters
+    ----------
+    scaled : numpy array
+        Timepoints x series, divided by the tolerance of each series
+
+    Returns
+    -------
+    A, B : numpy array
+        Matching pairs of every series
+    '''
+    n_series = scaled.shape[1]
+    n_templates = scaled.shape[0] - order
+    order_by_first = np.argsort(scaled[:n_templates],axis=0,kind='stable')
+    # every value of every template in sorted order, series after series
+    values = [np.take_along_axis(scaled[k:k+n_templates],order_by_first,0).T.ravel() for k in range(order+1)]
+    span = values[0].max() - values[0].min() + 3.0
+    first_values = values[0] + np.repeat(np.arange(n_series)*span,n_templates)
+    window_end = np.searchsorted(first_values,first_values+1.0,side='right')
+    n_candidates = window_end - np.arange(first_values.size) - 1
+    first = np.repeat(np.arange(first_values.size),n_candidates)
+    second = np.arange(n_candidates.sum()) - np.repeat(np.cumsum(n_candidates)-n_candidates,n_candidates) + first + 1
+    matched = np.ones(first.size,dtype=bool)
+    for k in range(1,order):
+        matched &= np.abs(values[k][first] - values[k][second]) <= 1.0
+    first = first[matched]
+    second = second[matched]
+    extended = np.abs(values[order][first] - values[order][second]) <= 1.0
+    series = first//n_templates
+    B = 2*np.bincount(series,minlength=n_series)
+    A = 2*np.bincount(series[extended],minlength=n_series)
+    return A, B
+
+def multiscale_entropy(timeseries,scales=ENTROPY_SCALES,order=ENTROPY_ORDER,tolerance=ENTROPY_TOLERANCE):
+    '''
+    Sample entropy (Richman & Moorman) of every column of timeseries at coarse graining
+    scales 1..scales (Costa et al.), with a tolerance of tolerance x the standard deviation
+    of the original series. Scale 1 is the sample entropy.
+
+    Returns
+    -------
+    numpy array
+        Scales x series, NaN for constant series or when no templates match
+    '''
+    timeseries = np.asarray(timeseries,dtype=np.float64)
+    r = tolerance*timeseries.std(axis=0)
+    constant = r == 0
+    scaled = timeseries/np.where(constant,1.0,r)
+    entropy = np.full((scales,timeseries.shape[1]),np.nan)
+    for scale in range(1,scales+1):
+        n_coarse = timeseries.shape[0]//scale
+        if n_coarse <= order + 1:
+            break
+        # non-overlapping means of scale timepoints, for all series at once
+        coarse = scaled[:n_coarse*scale].reshape(n_coarse,scale,-1).mean(axis=1)
+        A, B = template_matches(coarse,order)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            entropy[scale-1] = np.where((A > 0) & (B > 0),-np.log(A/np.maximum(B,1)),np.nan)
+    entropy[:,constant] = np.nan
+    return entropy
+
+def multiscale_entropy_chunks(timeseries,scales=ENTROPY_SCALES,n_jobs=1,chunk_size=ENTROPY_CHUNK):
+    '''
+    multiscale_entropy over chunks of series on n_jobs joblib threads, which bounds the
+    number of candidate pairs held at once
+    '''
+    from joblib import Parallel, delayed
+    chunks = range(0,timeseries.shape[1],chunk_size)
+    entropies = Parallel(n_jobs=n_jobs,prefer='threads')(delayed(multiscale_entropy)(timeseries[:,start:start+chunk_size],scales) for start in chunks)
+    return np.concatenate(entropies,axis=1)
+
 class TimeSeriesIO:
-    def __init__(self,output_dir,cifti_file,time_series_metric):
+    def __init__(self,output_dir,cifti_file,time_series_metric,parcellation=None,parcel_name=None,
+                 time_series_space='parcels',fishers_r_to_z_transform='NO',n_jobs=1):
         '''
         Class initialization for timeseries processing. The primary purpose of this class is to:
         1) Performs tests on inputted arguments are in the expected format
         2) Generates new timeseries based on specified method
+
+        Parameters
+        ----------
+        output_dir : string
+            Where the scalar CIFTI files are written
+        cifti_file : string
+            Path to a dense timeseries
+        time_series_metric : string or list
+            Time series metric/s to compute, e.g. ['alff','falff','wavelet']
+        parcellation : tools.parcellation.ParcellationIO
+            Parcellation of the parcels space, and of the wavelet correlations
+        parcel_name : string
+            Shorthand name of the CIFTI label file, part of the pscalar file names
+        time_series_space : [parcels, grayordinates]
+            ALFF and fALFF are computed from the parcellated timeseries and written as pscalar
+            files, or per grayordinate and written as dscalar files
+        fishers_r_to_z_transform : [YES, NO]
+            Should Fisher's r-to-z transformation be applied to the wavelet correlations?
+        n_jobs : int
+            Number of threads the entropy template matching runs on
+
+        Attributes
+        ----------
+        time_series_data : dict
+            Time series metric -> parcels or grayordinates vector for ALFF, fALFF and sample
+            entropy, scales x parcels or grayordinates for multiscale entropy and
+            scales x parcels x parcels correlations for wavelet
         '''
         self.output_dir = output_dir
         self.cifti_file = cifti_file
+        if type(time_series_metric) != list:
+            time_series_metric = [time_series_metric]
         self.time_series_metric = time_series_metric
+        self.parcellation = parcellation
+        self.parcel_name = parcel_name
+        self.time_series_space = time_series_space
+        self.fishers_r_to_z_transform = fishers_r_to_z_transform
+        self.n_jobs = n_jobs
+        self.parcellated_timeseries = None
         
         # perform tests on inputted cifti file
         self.cifti_tests()
@@ -42,36 +353,76 @@ class TimeSeriesIO:
             
         # is entered CIFTI file actually a CIFTI file?
         try:
-            self.cifti_load_np_array = np.array(nibabel.cifti2.cifti2.load(self.cifti_file).get_fdata())
+            # memory-mapped reader, the grayordinate x time array is only read chunk by chunk
+            self.cifti_reader = CiftiReader(self.cifti_file)
         except:
             print("file does not look like a cifti file")
-            
+
+    def parcellated(self):
+        # parcellated once and shared by every metric of the bold
+        if self.parcellated_timeseries is None:
+            self.parcellated_timeseries = self.parcellation.parcellate_reader(self.cifti_reader)
+        return self.parcellated_timeseries
+
     def create_new_timeseries(self):
-        # retreive TR
-        command = '/opt/workbench/bin_rh_linux64/wb_command -file-information %s' %self.cifti_file
-        process = Popen(command, stdout=PIPE, stderr=subprocess.STDOUT,
-                    shell=True)
-        output = process.stdout.readlines()
-        for out in output:
-            out = out.decode('utf-8')
-            if 'Map Interval Step:' in out:
-                TR = float(out.split(' ')[-1].strip())
-        tps = self.cifti_load_np_array.shape[0]
-        if self.time_series_metric == 'wavelet':
+        # the series step of the CIFTI header
+        TR = self.cifti_reader.metadata.TR
+        self.time_series_data = {}
+        if 'wavelet' in self.time_series_metric:
             #Which includes functional connectivity range scales: Scale 1 (0.23-0.45 Hz), Scale 2 (0.11-0.23 Hz), Scale 3 (0.06-0.11 Hz), Scale 4 (0.03-0.06 Hz), Scale 5 (0.01-0.03 Hz), Scale 6 (0.007-0.01 Hz).
-            pass
-        elif self.time_series_metric == 'entropy':
-            # sample entropy
-            pass
-        elif self.time_series_metric == 'alff' or self.timeseries == 'falff':
+            self.time_series_data['wavelet'] = wavelet_correlations(self.parcellated(),self.fishers_r_to_z_transform)
+        if 'sample_entropy' in self.time_series_metric or 'multiscale_entropy' in self.time_series_metric:
+            # sample entropy and multiscale entropy
+            if self.time_series_space == 'parcels':
+                entropy = multiscale_entropy_chunks(self.parcellated(),n_jobs=self.n_jobs)
+            else:
+                entropy = np.empty((ENTROPY_SCALES,self.cifti_reader.n_grayordinates))
+                for start, stop, cifti_chunk in self.cifti_reader.iter_grayordinate_chunks():
+                    entropy[:,start:stop] = multiscale_entropy_chunks(cifti_chunk,n_jobs=self.n_jobs)
+            if 'sample_entropy' in self.time_series_metric:
+                self.time_series_data['sample_entropy'] = entropy[0]
+            if 'multiscale_entropy' in self.time_series_metric:
+                self.time_series_data['multiscale_entropy'] = entropy
+        if 'alff' in self.time_series_metric or 'falff' in self.time_series_metric:
             # alff and f/alff
-            bf_b, bf_a = butter(N=2,Wn=np.array([0.01,0.08])/(1/TR/2),btype="bandpass") # 2nd order butterworth filter with band pass 0.01-0.08 Hz
-            ar=np.array([1,0.5])
-            ma=np.array([1])
-            bp_filtered_cifti_timeseries = filtfilt(b=bf_b,a=bf_a,x=self.cifti_load_np_array)
-            power_spectra_bp_filtered_cifti_timeseries_f, power_spectra_bp_filtered_cifti_timeseries_pxx = periodogram(x=bp_filtered_cifti_timeseries,detrend='constant',fs=TR)
-            hertz=(1/TR/2)*power_spectra_bp_filtered_cifti_timeseries_f
-            pass
-        
-        
+            if self.time_series_space == 'parcels':
+                alff, falff = alff_falff(self.parcellated(),TR)
+            else:
+                alff = np.empty(self.cifti_reader.n_grayordinates)
+                falff = np.empty(self.cifti_reader.n_grayordinates)
+                # each grayordinate's spectrum is independent, one rFFT per chunk of grayordinates
+                from scipy.fftpack import next_fast_len
+                chunk_size = max(1,ALFF_CHUNK_BYTES//(8*next_fast_len(self.cifti_reader.n_timepoints)))
+                for start, stop, cifti_chunk in self.cifti_reader.iter_grayordinate_chunks(chunk_size):
+                    alff[start:stop], falff[start:stop] = alff_falff(cifti_chunk,TR)
+            for time_series_metric, vector in (('alff',alff),('falff',falff)):
+                if time_series_metric in self.time_series_metric:
+                    self.time_series_data[time_series_metric] = vector
+        self.write_scalar_ciftis()
+
+    def scalar_cifti_file(self,time_series_metric):
+        cifti_prefix = os.path.join(self.output_dir,os.path.basename(self.cifti_file).split('.')[0])
+        if self.time_series_space == 'parcels':
+            return cifti_prefix + '_' + self.parcel_name + '_' + time_series_metric + '.pscalar.nii'
+        return cifti_prefix + '_' + time_series_metric + '.dscalar.nii'
 
+    def write_scalar_ciftis(self):
+        '''
+        Writes ALFF, fALFF and entropies as pscalar (parcels) or dscalar (grayordinates)
+        files, multiscale entropy with one map per scale
+        '''
+        brain_models = self.cifti_reader.metadata.brain_models
+        if self.time_series_space == 'parcels':
+            brain_models = ci.ParcelsAxis.from_brain_models(
+                [(label,brain_models[self.parcellation.grayordinate_index == i])
+                 for i, label in enumerate(self.parcellation.parcel_labels)])
+        for time_series_metric, maps in self.time_series_data.items():
+            if not time_series_metric in SCALAR_METRICS:
+                continue
+            if maps.ndim == 1:
+                maps = maps[None,:]
+                map_names = [time_series_metric]
+            else:
+                map_names = [time_series_metric + '_scale_' + str(scale) for scale in range(1,maps.shape[0]+1)]
+            header = ci.Cifti2Header.from_axes((ci.ScalarAxis(map_names),brain_models))
+            ci.save(ci.Cifti2Image(maps.astype(np.float32),header),self.scalar_cifti_file(time_series_metric))
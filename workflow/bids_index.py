@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the files in a BIDS derivatives folder.
+
+Indexing a large derivatives tree with BIDSLayout takes minutes, and every
+MPI rank used to do it. BIDSIndex builds the index once, stores it as a SQLite
+file invalidated by the folder's directory modification times, and on MPI
+runs rank 0 loads or builds it and broadcasts the rows to the other ranks.
+Every rank then answers bold queries from an in-memory SQLite table.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+
+ENTITY_COLUMNS = ['subject','session','type','task','run']
+COLUMNS = ['filename','parent'] + ENTITY_COLUMNS
+INDEX_VERSION = '1'
+
+def directory_signature(input_dir):
+    '''
+    Hash of every directory path and modification time below input_dir. Adding,
+    removing or renaming a file changes its directory's mtime and so the signature.
+    '''
+    sha1 = hashlib.sha1(INDEX_VERSION.encode('utf-8'))
+    for dirpath, dirnames, filenames in os.walk(input_dir,followlinks=True):
+        dirnames.sort()
+        sha1.update(('%s %r\n' % (dirpath,os.stat(dirpath).st_mtime)).encode('utf-8'))
+    return sha1.hexdigest()
+
+def bold_mtime(bold):
+    '''
+    Modification time of a bold, the most recent one for a list of combined runs
+    '''
+    if type(bold) == list:
+        return max(os.path.getmtime(run) for run in bold)
+    return os.path.getmtime(bold)
+
+def layout_rows(input_dir):
+    '''
+    Indexes input_dir with BIDSLayout and returns one row per file
+    '''
+    from bids.grabbids import BIDSLayout
+    layout = BIDSLayout(os.path.join(input_dir))
+    rows = []
+    for f in layout.get():
+        row = [f.filename, os.path.basename(os.path.dirname(f.filename))]
+        for entity in ENTITY_COLUMNS:
+            value = getattr(f,entity,None)
+            row.append(None if value is None else str(value))
+        rows.append(tuple(row))
+    return rows
+
+class BIDSIndex:
+    def __init__(self,input_dir,index_file=None,comm=None):
+        '''
+        Parameters
+        ----------
+        input_dir : string
+            The directory where the preprocessed derivative needed live
+        index_file : string
+            Optional SQLite file the index is persisted to and reloaded from
+        comm : mpi4py.MPI.Comm
+            When given, only rank 0 touches the file system and the rows are broadcast
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.input_dir = input_dir
+        self.index_file = index_file
+        rank = comm.rank if comm is not None else 0
+        rows = None
+        error = None
+        if rank == 0:
+            try:
+                rows = self.load_or_build()
+            except Exception as e:
+                error = e
+        if comm is not None:
+            rows, error = comm.bcast((rows,error),root=0)
+        if error is not None:
+            raise error
+        self.connection = sqlite3.connect(':memory:')
+        self.create_table(self.connection)
+        self.connection.executemany('INSERT INTO files VALUES (%s)' % ','.join('?'*len(COLUMNS)),rows)
+
+    @staticmethod
+    def create_table(connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS files (%s)' % ','.join(c + ' TEXT' for c in COLUMNS))
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        for column in ['subject','session','type']:
+            connection.execute('CREATE INDEX IF NOT EXISTS files_%s ON files (%s)' % (column,column))
+
+    def load_or_build(self):
+        '''
+        Returns the rows of the persisted index when its directory signature still matches,
+        otherwise re-indexes input_dir and persists the result.
+        '''
+        if not os.path.isdir(self.input_dir):
+            raise TypeError('{input_dir} is not a path to a folder'.format(input_dir=self.input_dir))
+        signature = directory_signature(self.input_dir)
+        if self.index_file and os.path.isfile(self.index_file):
+            connection = sqlite3.connect(self.index_file)
+            try:
+                stored = connection.execute("SELECT value FROM meta WHERE key='signature'").fetchone()
+                if stored is not None and stored[0] == signature:
+                    return connection.execute('SELECT %s FROM files' % ','.join(COLUMNS)).fetchall()
+            except sqlite3.DatabaseError:
+                pass
+            finally:
+                connection.close()
+        print('Indexing BIDS folder %s' % self.input_dir)
+        rows = layout_rows(self.input_dir)
+        if self.index_file:
+            self.save(rows,signature)
+        return rows
+
+    def save(self,rows,signature):
+        index_dir = os.path.dirname(self.index_file)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        tmp_file = self.index_file + '.%d.tmp' % os.getpid()
+        connection = sqlite3.connect(tmp_file)
+        self.create_table(connection)
+        connection.executemany('INSERT INTO files VALUES (%s)' % ','.join('?'*len(COLUMNS)),rows)
+        connection.execute("INSERT INTO meta VALUES ('signature',?)",(signature,))
+        connection.commit()
+        connection.close()
+        os.replace(tmp_file,self.index_file)
+
+    def where(self,subject=None,session=None,type=None,extension=None,
+              include=(),exclude=(),parent_include=()):
+        clauses = []
+        params = []
+        for column, value in [('subject',subject),('session',session),('type',type)]:
+            if value is None:
+                continue
+            values = value if isinstance(value,(list,tuple)) else [value]
+            clauses.append('%s IN (%s)' % (column,','.join('?'*len(values))))
+            params.extend(str(v) for v in values)
+        if extension:
+            # same as grabbit's extensions filter: the filename ends with the extension
+            clauses.append('substr(filename,-?) = ?')
+            params.extend([len(extension)+1,'.'+extension])
+        # substring tests are case sensitive, like the python "in" tests they replace
+        for text in include:
+            clauses.append('instr(filename,?) > 0')
+            params.append(text)
+        for text in exclude:
+            clauses.append('instr(filename,?) = 0')
+            params.append(text)
+        for text in parent_include:
+            clauses.append('instr(parent,?) > 0')
+            params.append(text)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def get(self,**filters):
+        '''
+        Filenames matching every filter, sorted
+
+        Parameters
+        ----------
+        subject, session, type : string or list
+            Entity values, a list matches any of its values
+        extension : string
+            e.g. "dtseries.nii"
+        include, exclude : list of strings
+            Substrings the full filename must or must not contain
+        parent_include : list of strings
+            Substrings the name of the file's folder must contain
+        '''
+        where, params = self.where(**filters)
+        return [row[0] for row in self.connection.execute('SELECT filename FROM files' + where + ' ORDER BY filename',params)]
+
+    def get_groups(self,**filters):
+        '''
+        Filenames matching every filter grouped by (subject, session), in one query.
+        Files without a session are grouped per subject under session None.
+
+        Returns
+        -------
+        OrderedDict
+            (subject, session) -> sorted filenames, ordered by subject and session
+        '''
+        where, params = self.where(**filters)
+        where = where + (' AND ' if where else ' WHERE ') + 'subject IS NOT NULL'
+        groups = OrderedDict()
+        for filename, subject, session in self.connection.execute('SELECT filename, subject, session FROM files' + where + ' ORDER BY subject, session, filename',params):
+            groups.setdefault((subject,session),[]).append(filename)
+        return groups
+
+    def get_subjects(self,**filters):
+        where, params = self.where(**filters)
+        where = where + (' AND ' if where else ' WHERE ') + 'subject IS NOT NULL'
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT subject FROM files' + where + ' ORDER BY subject',params)]
+
+    def get_sessions(self,**filters):
+        where, params = self.where(**filters)
+        where = where + (' AND ' if where else ' WHERE ') + 'session IS NOT NULL'
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT session FROM files' + where + ' ORDER BY session',params)]
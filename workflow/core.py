@@ -6,26 +6,247 @@ Created on Thu May  7 17:22:55 2020
 @author: timothy
 """
 from __future__ import print_function
-import argparse
-from bids.grabbids import BIDSLayout
-import cifti
+import ast
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import date
-from functools import partial
-import h5py
-from mpi4py import MPI
-import nibabel
+import json
 import numpy as np
 import os
 from pprint import pprint
-import pandas as pd
-from subprocess import Popen, PIPE
 import sys
 
 sys.path.append('../')
-from tools.connectivity_metrics import NetworkIO, GraphTheoryIO
+from tools.batch_connectivity import COVARIANCE_METRICS, batch_network_matrices, stack_timeseries
+from tools.censoring import FRAMES_KEPT, censored_dataset, is_censored_dataset, split_censored_dataset
+from tools.cifti_io import cifti_metadata
+from tools.connectivity_metrics import NetworkIO, GRAPH_THEORY_METRICS, EDGE_GRAPH_THEORY_METRICS, create_graph_theory_datasets, is_graph_theory_dataset, split_graph_theory_dataset
+from tools.dynamic_connectivity import WindowStates, dynamic_dataset, dynamic_states_dataset, is_dynamic_dataset, sliding_window_matrices, split_dynamic_dataset, window_count
+from tools.group_statistics import GROUP_CONSENSUS_DENSITY, GROUP_PERCENTILES, GroupAccumulator
+from tools.parcellation import parcellation_cache
+from tools.sparse_covariance import SPARSE_METRICS
+from tools.stage_timer import batch_label, stage_timer, write_trace
+from tools.tangent_space import TangentSpace
+from tools.timeseries_metrics import TimeSeriesIO, ENTROPY_SCALES, SCALAR_METRICS, TIME_SERIES_METRICS, WAVELET_SCALES
+from workflow.bids_index import BIDSIndex, bold_mtime
+from workflow.scheduler import batch_tasks, estimate_task_cost, group_network_metrics
+
+# covariance matrices read at once by the tangent space pass
+TANGENT_CHUNK = 64
+# network matrices read at once when group summaries catch up on rows of earlier runs
+GROUP_CHUNK = 16
 
 # specify arguments that MACCHIATO accepts
 
+def compute_network_task(bolds,network_metrics,output_dir,parcellation_file,parcellation_name,
+                         fishers_r_to_z_transform,parcellation_engine,estimator_options=None,stored_matrices=None,
+                         graph_theory_density=None,time_series_space='parcels',dynamic_options=None):
+    '''
+    Parcellates every bold of a task once and estimates the task's network metrics.
+    Covariance derived metrics of a batch of bolds are estimated together by the batch
+    connectivity engine. Graph theory datasets of the task are computed from the
+    matrices just estimated, or from stored_matrices when those were written by an
+    earlier run. Kept at module level so process pools can pickle it.
+
+    Parameters
+    ----------
+    network_metrics : tuple
+        Network metrics, graph_theory/<network metric>/<graph theory metric> datasets,
+        censored/fd_<threshold>/<network metric> datasets, dynamic/<network metric>
+        sliding-window datasets and time series metrics
+    estimator_options : dict
+        Keyword arguments for NetworkIO: n_jobs, dtw_window, sparse_alpha, warm_alpha, dvars_censoring
+    stored_matrices : dict
+        Network metric -> bolds x parcels x parcels array read back from the output
+    graph_theory_density : float
+        Fraction of the strongest connections kept before graph theory metrics are computed
+    time_series_space : [parcels, grayordinates]
+        Whether time series metrics are computed per parcel or per grayordinate
+    dynamic_options : dict
+        window_length, window_step, taper and n_windows of the sliding-window datasets
+
+    Returns
+    -------
+    network_matrices : dict
+        Network metric name -> bolds x parcels x parcels array, ordered like bolds.
+        Sparse tasks also return the selected graphical lasso alpha of every bold as sparse_alpha.
+        Time series metrics map to bolds x parcels (or grayordinates) arrays. Censored tasks
+        also return the frames kept of every bold at every FD threshold. Sliding-window
+        datasets map to bolds x windows x edges upper triangles.
+    '''
+    if estimator_options is None:
+        estimator_options = {}
+    graph_theory_datasets = [m for m in network_metrics if is_graph_theory_dataset(m)]
+    censored_datasets = [m for m in network_metrics if is_censored_dataset(m)]
+    dynamic_datasets = [m for m in network_metrics if is_dynamic_dataset(m)]
+    time_series_metrics = [m for m in network_metrics if m in TIME_SERIES_METRICS]
+    network_metrics = [m for m in network_metrics if not is_graph_theory_dataset(m) and not is_censored_dataset(m)
+                       and not is_dynamic_dataset(m) and not m in TIME_SERIES_METRICS]
+    fd_thresholds = sorted(set(split_censored_dataset(m)[0] for m in censored_datasets))
+    network_matrices = {}
+    if network_metrics or censored_datasets or dynamic_datasets:
+        network_metric_inits = [NetworkIO(output_dir=output_dir, 
+                                          cifti_data=bold, 
+                                          parcel_file=parcellation_file, 
+                                          parcel_name=parcellation_name, 
+                                          network_metric=network_metrics,
+                                          fishers_r_to_z_transform=fishers_r_to_z_transform,
+                                          parcellation_engine=parcellation_engine,
+                                          parcellation_cache_dir=output_dir,
+                                          fd_thresholds=fd_thresholds,
+                                          keep_timeseries=bool(dynamic_datasets),
+                                          **estimator_options) for bold in bolds]
+    if network_metrics and all(m in COVARIANCE_METRICS for m in network_metrics):
+        print('rsfMRI_network_metrics.py: Create %s network matrices for %d bolds' % (network_metrics,len(bolds)))
+        if any(type(bold) == list for bold in bolds):
+            # combined runs arrive as the covariance of their concatenation
+            with stage_timer.stage('estimator/batch_covariance_family',batch_label(bolds)):
+                covariance = np.stack([network_metric_init.estimate_empirical_covariance() for network_metric_init in network_metric_inits])
+                network_matrices = batch_network_matrices(None,network_metrics,fishers_r_to_z_transform,covariance=covariance)
+        else:
+            with stage_timer.stage('estimator/batch_covariance_family',batch_label(bolds)):
+                stack, lengths = stack_timeseries([network_metric_init.cifti_np_array for network_metric_init in network_metric_inits])
+                network_matrices = batch_network_matrices(stack,network_metrics,fishers_r_to_z_transform,lengths=lengths)
+    elif network_metrics:
+        for network_metric_init in network_metric_inits:
+            for network_metric, metric_data in network_metric_init.create_network_matrices().items():
+                network_matrices.setdefault(network_metric,[]).append(metric_data)
+            if network_metric_init.selected_sparse_alpha is not None:
+                network_matrices.setdefault('sparse_alpha',[]).append(network_metric_init.selected_sparse_alpha)
+        network_matrices = {network_metric: np.stack(metric_data) for network_metric, metric_data in network_matrices.items()}
+    if censored_datasets:
+        with stage_timer.stage('estimator/censored',batch_label(bolds)):
+            network_matrices.update(censored_network_matrices(network_metric_inits,censored_datasets,fishers_r_to_z_transform))
+    if dynamic_datasets:
+        with stage_timer.stage('dynamic_connectivity',batch_label(bolds)):
+            network_matrices.update(dynamic_network_matrices(network_metric_inits,dynamic_datasets,fishers_r_to_z_transform,
+                                                             **dynamic_options))
+    if graph_theory_datasets:
+        source_matrices = dict(stored_matrices or {})
+        source_matrices.update(network_matrices)
+        with stage_timer.stage('graph_theory',batch_label(bolds)):
+            network_matrices.update(create_graph_theory_datasets(graph_theory_datasets,source_matrices,graph_theory_density))
+    if time_series_metrics:
+        network_matrices.update(compute_time_series_metrics(bolds,time_series_metrics,output_dir,parcellation_file,
+                                                            parcellation_name,time_series_space,fishers_r_to_z_transform,
+                                                            estimator_options.get('n_jobs',1)))
+    return network_matrices
+
+def timed_network_task(*args):
+    '''
+    compute_network_task in a pool worker process, returns its network matrices and the
+    stage timings the worker recorded so the parent can store them
+    '''
+    network_matrices = compute_network_task(*args)
+    return network_matrices, stage_timer.drain()
+
+def clear_inherited_timings():
+    '''
+    Pool worker initializer: forked workers start with a copy of the parent's stage
+    timings, which the parent stores itself
+    '''
+    stage_timer.drain()
+
+def censored_network_matrices(network_metric_inits,censored_datasets,fishers_r_to_z_transform):
+    '''
+    Covariance family matrices of every FD threshold, from the masked covariances
+    NetworkIO estimated while the bolds were parcellated
+
+    Returns
+    -------
+    dict
+        censored/fd_<threshold>/<network metric> -> bolds x parcels x parcels array and
+        censored/fd_<threshold>/frames_kept -> bolds vector
+    '''
+    censored_matrices = {}
+    for fd_threshold in sorted(set(split_censored_dataset(m)[0] for m in censored_datasets)):
+        names = [m for m in censored_datasets if split_censored_dataset(m)[0] == fd_threshold]
+        print('rsfMRI_network_metrics.py: Create %s network matrices for %d bolds' % (names,len(network_metric_inits)))
+        covariance = np.stack([network_metric_init.censored_covariances[fd_threshold] for network_metric_init in network_metric_inits])
+        invertible = np.array([network_metric_init.censored_invertible[fd_threshold] for network_metric_init in network_metric_inits])
+        matrices = batch_network_matrices(None,[split_censored_dataset(m)[1] for m in names],fishers_r_to_z_transform,
+                                          covariance=covariance,invertible=invertible)
+        for name in names:
+            censored_matrices[name] = matrices[split_censored_dataset(name)[1]]
+        censored_matrices[censored_dataset(fd_threshold,FRAMES_KEPT)] = np.array([network_metric_init.censored_frames[fd_threshold]
+                                                                                  for network_metric_init in network_metric_inits])
+    return censored_matrices
+
+def dynamic_network_matrices(network_metric_inits,dynamic_datasets,fishers_r_to_z_transform,window_length,
+                             window_step,taper,n_windows):
+    '''
+    Sliding-window matrices of every bold, from the parcellated timeseries NetworkIO holds
+
+    Returns
+    -------
+    dict
+        dynamic/<network metric> -> bolds x n_windows x edges array of upper triangles,
+        NaN past the last window of a bold
+    '''
+    print('rsfMRI_network_metrics.py: Create %s network matrices for %d bolds' % (dynamic_datasets,len(network_metric_inits)))
+    network_metrics = [split_dynamic_dataset(m) for m in dynamic_datasets]
+    windowed = [sliding_window_matrices(network_metric_init.cifti_np_array,network_metrics,window_length,window_step,taper,
+                                        fishers_r_to_z_transform,network_metric_init.run_lengths,n_windows)
+                for network_metric_init in network_metric_inits]
+    return dict((dynamic_dataset(network_metric),np.stack([w[network_metric] for w in windowed])) for network_metric in network_metrics)
+
+def compute_time_series_metrics(bolds,time_series_metrics,output_dir,parcellation_file,parcellation_name,time_series_space,
+                                fishers_r_to_z_transform='NO',n_jobs=1):
+    '''
+    Time series metrics of every bold. ALFF, fALFF and entropies are also written as
+    scalar CIFTI files to output_dir. Combined runs get the mean of their per-run values.
+
+    Returns
+    -------
+    dict
+        Time series metric -> bolds x parcels (or grayordinates) array for ALFF, fALFF and
+        sample entropy, bolds x scales x parcels (or grayordinates) for multiscale entropy,
+        bolds x scales x parcels x parcels for wavelet, ordered like bolds
+    '''
+    parcellation = None
+    if time_series_space == 'parcels' or 'wavelet' in time_series_metrics:
+        parcellation = parcellation_cache.get(parcellation_file,cache_dir=output_dir)
+    time_series_data = {}
+    for bold in bolds:
+        runs = bold if type(bold) == list else [bold]
+        print('rsfMRI_network_metrics.py: Create %s for %s' % (time_series_metrics,runs))
+        run_data = []
+        for run in runs:
+            with stage_timer.stage('time_series',run):
+                run_data.append(TimeSeriesIO(output_dir,run,time_series_metrics,parcellation,parcellation_name,
+                                             time_series_space,fishers_r_to_z_transform,n_jobs).time_series_data)
+        for time_series_metric in time_series_metrics:
+            time_series_data.setdefault(time_series_metric,[]).append(np.mean([d[time_series_metric] for d in run_data],axis=0))
+    return {time_series_metric: np.stack(data) for time_series_metric, data in time_series_data.items()}
+
+def stored_network_metrics(network_metrics):
+    '''
+    Network metrics whose matrices a task reads back from the output: the ones its
+    graph theory datasets are computed from but that the task does not estimate itself
+    '''
+    estimated = [m for m in network_metrics if not is_graph_theory_dataset(m)]
+    stored = []
+    for m in network_metrics:
+        if is_graph_theory_dataset(m):
+            network_metric = split_graph_theory_dataset(m)[0]
+            if not network_metric in estimated and not network_metric in stored:
+                stored.append(network_metric)
+    return stored
+
+def parse_list_argument(value):
+    '''
+    Converts an argument that may be a list, a string representation of a list
+    or a single string into a list of strings.
+    Returns None when no value is given.
+    '''
+    if value is None:
+        return None
+    if type(value) == list:
+        return value
+    value = value.strip()
+    if value.startswith('['):
+        return [str(v) for v in ast.literal_eval(value)]
+    return value.split()
+
 class MACCHIATO_setup:
     def __init__(self,args_dict):
 
@@ -36,8 +257,9 @@ class MACCHIATO_setup:
             The directory where the preprocessed derivative needed live
         output_dir : string
             The directory where the outputs from MACCHIATO will be placed
-        analysis_level : [participant]
-            Run participant by participant (part of BIDS specification) 
+        analysis_level : [participant, group]
+            Run participant by participant (part of BIDS specification). group also writes
+            streaming cohort summaries of every network metric, see tools.group_statistics.
         preprocessing_type : [HCP, fmriprep]
             BIDS-apps preprocessing pipeline run on data. Choices include "HCP" and "fmriprep". 
         denoised_outputs : [Yes, yes, No, no]
@@ -52,8 +274,58 @@ class MACCHIATO_setup:
             What type of registration do you want to use? Choices are "MSMAll_2_d40_WRN" and "NONE"'
         fishers_r_to_z_transform : [Yes, YES, yes, No, NO, no]
             Should Fisher's r-to-z transformation be applied?
-        network_matrix_calculation : [All, all, correlation, partial_correlation, dynamic_time_warping, covariance, precision, sparse_inverse_precision, sparse_inverse_covariance]
+        network_matrix_calculation : [All, all, correlation, partial_correlation, dynamic_time_warping, tangent, covariance, precision, sparse_inverse_precision, sparse_inverse_covariance]
             What method to employ for network matrix estimation.
+        parcellation_engine : [numpy, workbench]
+            Parcellate in-process or through wb_command -cifti-parcellate.
+        backend : [mpi, processes, threads, serial]
+            Run tasks over MPI ranks or in a local pool of num_cpus workers.
+        num_cpus : int
+            Number of workers for the processes and threads backends.
+        resume : [Yes, yes, No, no]
+            Continue the latest HDF5 output, skipping bolds and metrics already computed.
+        batch_size : int
+            Number of bolds whose covariance derived matrices are estimated together.
+        estimator_n_jobs : int
+            Number of workers within one estimator, e.g. dynamic time warping parcel pairs.
+        dtw_window : float
+            Sakoe-Chiba band of dynamic time warping as a fraction of the number of timepoints.
+        sparse_alpha : float
+            Fixed graphical lasso regularization for the sparse metrics, skips cross-validation.
+        graph_theory_metric : [All, strength, eigenvector_centrality, clustering_coefficient, local_efficiency, node_betweenness_centrality, edge_betweenness_centrality]
+            Graph theory metrics computed from every network matrix.
+        graph_theory_density : float
+            Fraction of the strongest connections kept before graph theory metrics are computed.
+        time_series_metric : [alff, falff, wavelet, sample_entropy, multiscale_entropy]
+            Time series metrics computed from every bold. ALFF, fALFF and entropies are also written as scalar CIFTI files.
+        time_series_space : [parcels, grayordinates]
+            Compute ALFF, fALFF and entropies per parcel (pscalar) or per grayordinate (dscalar).
+        fd_threshold : list
+            Framewise displacement thresholds in mm. Covariance derived matrices are also estimated
+            from the frames kept at every threshold.
+        dvars_censoring : [Yes, yes, No, no]
+            Also censor DVARS outlier frames at every FD threshold.
+        output_layout : [full, upper_triangle]
+            Store parcels x parcels matrices whole or as their upper triangle.
+        output_dtype : [float32, float16]
+            Precision of the stored outputs. float16 is lossy and overflows above 65504, covariance
+            and precision stay float32 when tangent is computed.
+        output_compression : [none, gzip, lzf, blosc]
+            Compression of the per-bold HDF5 chunks, blosc needs hdf5plugin.
+        trace_file : string
+            Optional Chrome trace (JSON) of the stage timings of every rank, also stored as the timings table of the output.
+        dynamic_connectivity : [correlation, covariance]
+            Sliding-window network matrices of every bold, stored as dynamic/<network metric>.
+        window_length : int
+            Frames per sliding window.
+        window_step : int
+            Frames between the starts of consecutive windows.
+        window_taper : [none, exponential]
+            Weighting of the frames within a window.
+        dynamic_states : int
+            Optional number of connectivity states the windows are clustered into.
+        plan_only : [Yes, yes, No, no]
+            Print the tasks and their estimated cost without computing anything.
 
 
         Raises
@@ -65,7 +337,7 @@ class MACCHIATO_setup:
 
         Returns a dictionary with keys and values labeled below
         -------
-        layout : bids.grabbids.BIDSLayout object describing BIDS dataset
+        bids_index : workflow.bids_index.BIDSIndex describing BIDS dataset
         denoised_outputs : TYPE
             Parsed denoised_outputs string
         network_matrix_calculation : string or list
@@ -97,12 +369,42 @@ class MACCHIATO_setup:
         self.analysis_level = args_dict.get('--analysis_level')
         self.preprocessing_type = args_dict.get('--preprocessing_type')
         self.denoised_outputs = args_dict.get('--use_denoised_outputs')
-        self.combine_resting_scans = args_dict.get('--combine_resting_scan')
+        self.combine_resting_scans = args_dict.get('--combine_resting_scans','No')
         self.parcellation_file = args_dict.get('--parcellation_file')
         self.parcellation_name = args_dict.get('--parcellation_name')
         self.selected_reg_name = args_dict.get('--reg_name')
         self.apply_Fishers_r_to_z_transform = args_dict.get('--apply_Fishers_r_to_z_transform')
         self.network_matrix_calculation = args_dict.get('--network_matrix_calculation')
+        self.parcellation_engine = args_dict.get('--parcellation_engine','numpy')
+        self.backend = args_dict.get('--backend','mpi')
+        self.num_cpus = int(args_dict.get('--num_cpus',1))
+        self.resume = args_dict.get('--resume','No')
+        self.batch_size = int(args_dict.get('--batch_size',1))
+        self.estimator_n_jobs = int(args_dict.get('--estimator_n_jobs',1))
+        self.dtw_window = float(args_dict.get('--dtw_window',0.1))
+        self.sparse_alpha = args_dict.get('--sparse_alpha')
+        if self.sparse_alpha is not None:
+            self.sparse_alpha = float(self.sparse_alpha)
+        self.graph_theory_metric = args_dict.get('--graph_theory_metric')
+        self.graph_theory_density = args_dict.get('--graph_theory_density')
+        if self.graph_theory_density is not None:
+            self.graph_theory_density = float(self.graph_theory_density)
+        self.time_series_metric = args_dict.get('--time_series_metric')
+        self.time_series_space = args_dict.get('--time_series_space','parcels')
+        self.fd_threshold = args_dict.get('--fd_threshold')
+        self.dvars_censoring = args_dict.get('--dvars_censoring','No')
+        self.output_layout = args_dict.get('--output_layout','full')
+        self.output_dtype = args_dict.get('--output_dtype','float32')
+        self.output_compression = args_dict.get('--output_compression','none')
+        self.trace_file = args_dict.get('--trace_file')
+        self.dynamic_connectivity = args_dict.get('--dynamic_connectivity')
+        self.window_length = int(args_dict.get('--window_length',60))
+        self.window_step = int(args_dict.get('--window_step',5))
+        self.window_taper = args_dict.get('--window_taper','none')
+        self.dynamic_states = args_dict.get('--dynamic_states')
+        if self.dynamic_states is not None:
+            self.dynamic_states = int(self.dynamic_states)
+        self.plan_only = args_dict.get('--plan_only','No')
         self.msm_all_reg_name="MSMAll_2_d40_WRN"
         if '--participant_label' in args_dict:
             self.participant_label = args_dict.get('--participant_label')
@@ -116,8 +418,11 @@ class MACCHIATO_setup:
         # run workflow logger
         self.workflow_logger()
         
-        # create bold lists
-        self.create_bold_lists()
+        # rank 0 selects the bolds and estimates the tasks, the other ranks receive the plan
+        self.create_plan()
+        if self.plan_only == 'YES':
+            self.print_plan()
+            return
 
         # generate HDF5 outputs
         self.execute_MACCHIATO_instances()
@@ -127,25 +432,62 @@ class MACCHIATO_setup:
         Ensures arguments specified to MACCHIATO are parsed correctly
         Prints specified arguments to standard output (STDOUT)
         '''
-        try:
-            self.layout = BIDSLayout(os.path.join(self.input_dir))
-        except: 
-            raise TypeError('Input folder: {input_dir} does not look like a BIDS folder or {input_dir} is not a path to a folder. '.format(input_dir=self.input_dir))
+        if self.plan_only == 'Yes' or self.plan_only == 'yes':
+            self.plan_only = 'YES'
+        else:
+            self.plan_only = 'NO'
+        # a plan is printed by a single process, without MPI
+        self.comm = None
+        if self.backend == 'mpi' and self.plan_only == 'NO':
+            from mpi4py import MPI
+            self.comm = MPI.COMM_WORLD
+            stage_timer.rank = self.comm.rank
         if self.combine_resting_scans == 'Yes' or self.combine_resting_scans == 'yes':
             self.combine_resting_scans = 'YES'
         elif self.combine_resting_scans == 'No' or self.combine_resting_scans == 'no':
             self.combine_resting_scans = 'NO'
         
+        if self.dvars_censoring == 'Yes' or self.dvars_censoring == 'yes':
+            self.dvars_censoring = 'YES'
+        else:
+            self.dvars_censoring = 'NO'
+
+        if self.resume == 'Yes' or self.resume == 'yes':
+            self.resume = 'YES'
+        else:
+            self.resume = 'NO'
+        
          # use ICA outputs
         if self.denoised_outputs == 'yes' or self.denoised_outputs == 'Yes':
             self.denoised_outputs = 'YES'
         else:
             self.denoised_outputs = 'NO'
                 
-        if self.network_matrix_calculation == 'All':
+        # list arguments may also arrive as strings, e.g. "['correlation', 'covariance']"
+        self.network_matrix_calculation = parse_list_argument(self.network_matrix_calculation)
+        self.participant_label = parse_list_argument(self.participant_label)
+        self.session_label = parse_list_argument(self.session_label)
+        self.graph_theory_metric = parse_list_argument(self.graph_theory_metric) or []
+        self.time_series_metric = parse_list_argument(self.time_series_metric) or []
+        self.fd_threshold = [float(t) for t in parse_list_argument(self.fd_threshold) or []]
+        self.dynamic_connectivity = parse_list_argument(self.dynamic_connectivity) or []
+        if 'All' in self.graph_theory_metric:
+            self.graph_theory_metric = list(GRAPH_THEORY_METRICS)
+        if 'All' in self.network_matrix_calculation:
             self.network_matrix_calculation = ['correlation','partial_correlation','dynamic_time_warping',
                                                'tangent','covariance', 'precision',
                                                'sparse_inverse_precision','sparse_inverse_covariance']
+        if 'tangent' in self.network_matrix_calculation and not 'covariance' in self.network_matrix_calculation:
+            # the tangent space is estimated from the stored covariance matrices
+            print('The tangent metric is estimated from covariance matrices, covariance will be computed as well')
+            self.network_matrix_calculation.append('covariance')
+        # datasets that are read back or not normalised lose too much at half precision
+        self.float32_datasets = []
+        if 'tangent' in self.network_matrix_calculation and self.output_dtype == 'float16':
+            self.float32_datasets = [m for m in ['covariance','precision'] if m in self.network_matrix_calculation]
+            print('The tangent metric is estimated from the stored covariance matrices, %s will be stored as float32' % self.float32_datasets)
+        if self.comm is not None and self.comm.rank != 0:
+            return
         print("Running MACCHIATO ")
         print('\t-Level that MACCHIATO will run on: %s' %(str(self.analysis_level)))
         if self.participant_label:
@@ -154,7 +496,27 @@ class MACCHIATO_setup:
             print('\t-Session ID: %s' %str(self.session_label))
         print('\t-Parcellation file to be used to parcellate outputs: %s' %str(self.parcellation_file))
         print('\t-Short hand parcellation name to be used: %s' %str(self.parcellation_name))
+        print('\t-Parcellation engine: %s' %str(self.parcellation_engine))
+        print('\t-Execution backend: %s' %str(self.backend))
+        print('\t-Resume previous output: %s' %str(self.resume))
+        print('\t-Bolds per estimation batch: %s' %str(self.batch_size))
+        print('\t-Output layout: %s %s matrices, %s compression' %(self.output_dtype,self.output_layout,self.output_compression))
+        if any(m in SPARSE_METRICS for m in self.network_matrix_calculation):
+            print('\t-Sparse estimator alpha: %s' %('cross-validated' if self.sparse_alpha is None else str(self.sparse_alpha)))
         print('\t-Network matrix metric/s to compute: %s' %(self.network_matrix_calculation))
+        if self.graph_theory_metric:
+            print('\t-Graph theory metric/s to compute: %s' %(self.graph_theory_metric))
+            print('\t-Graph density kept before graph theory metrics: %s' %('all connections' if self.graph_theory_density is None else str(self.graph_theory_density)))
+        if self.time_series_metric:
+            print('\t-Time series metric/s to compute: %s per %s' %(self.time_series_metric,self.time_series_space[:-1]))
+        if self.fd_threshold:
+            print('\t-Framewise displacement censoring threshold/s: %s mm' %(self.fd_threshold))
+            print('\t-Censor DVARS outlier frames: %s' %(self.dvars_censoring))
+        if self.dynamic_connectivity:
+            print('\t-Sliding-window metric/s to compute: %s, %d frame windows every %d frames, %s taper'
+                  %(self.dynamic_connectivity,self.window_length,self.window_step,self.window_taper))
+            if self.dynamic_states:
+                print('\t-Connectivity states the windows are clustered into: %d' %(self.dynamic_states))
         print("\t-Whether or not to compute Fisher's r-to-z transform to network matrices: %s" %(self.apply_Fishers_r_to_z_transform))
 
         print('\t-Input registration file to be used: %s' %str(self.selected_reg_name))
@@ -163,6 +525,104 @@ class MACCHIATO_setup:
         print('\t-Combine matrices/timeseries from resting state pairs within the same session: %s' %str(self.combine_resting_scans))
         print('\n')
         
+    def create_plan(self):
+        '''
+        Indexes the BIDS folder, selects the bolds, parses the label file and estimates the
+        cost of every task. Under MPI only rank 0 touches the file system and the other ranks
+        receive the plan, tasks share their metric tuples so it pickles compactly.
+        '''
+        plan = None
+        error = None
+        if self.comm is None or self.comm.rank == 0:
+            try:
+                try:
+                    with stage_timer.stage('bids_index',self.input_dir):
+                        self.bids_index = BIDSIndex(self.input_dir,index_file=os.path.join(self.output_dir,'MACCHIATO_bids_index.sqlite'))
+                except:
+                    raise TypeError('Input folder: {input_dir} does not look like a BIDS folder or {input_dir} is not a path to a folder. '.format(input_dir=self.input_dir))
+                self.create_bold_lists()
+                # the label file is parsed and cached next to the outputs before the other ranks load it
+                parcellation = parcellation_cache.get(self.parcellation_file,cache_dir=self.output_dir)
+                tasks, costs = self.create_task_list(parcellation.parcel_count)
+                plan = {'bolds':self.bolds,
+                        'bold_timepoints':self.bold_timepoints,
+                        'bold_windows':self.bold_windows,
+                        'bold_mtimes':[bold_mtime(bold) for bold in self.bolds],
+                        'tasks':tasks,
+                        'costs':costs,
+                        'output_file':self.output_file()}
+            except Exception as e:
+                error = e
+        if self.comm is not None:
+            plan, error = self.comm.bcast((plan,error),root=0)
+        if error is not None:
+            raise error
+        self.plan = plan
+        self.bolds = plan['bolds']
+        self.bold_timepoints = plan['bold_timepoints']
+        self.bold_windows = plan['bold_windows']
+
+    def print_plan(self):
+        '''
+        Prints the tasks batched as they would run, most expensive first, and their estimated
+        cost. A resumed run would skip the tasks its output already holds.
+        '''
+        tasks, costs = batch_tasks(self.plan['tasks'],self.plan['costs'],self.bold_timepoints,self.batch_size)
+        order = sorted(range(len(tasks)),key=lambda k: -costs[k])
+        print('%14s  %-60s  %s' % ('estimated cost','metrics','bolds'))
+        for k in order:
+            indices, network_metrics = tasks[k]
+            print('%14.4g  %-60s  %s' % (costs[k],','.join(network_metrics),batch_label([self.bolds[i] for i in indices])))
+        workers = max(1,self.num_cpus)
+        print('\n%d bolds, %d tasks, total estimated cost %.4g (%.4g per worker over %d workers, longest task %.4g)'
+              % (len(self.bolds),len(tasks),sum(costs),sum(costs)/workers,workers,max(costs or [0])))
+        print('Output file: %s' % self.plan['output_file'])
+
+    def bold_selection_rules(self):
+        '''
+        Index query filters that select resting state bolds for the chosen preprocessing
+        pipeline, registration and denoising. Alternatives are tried in order until one
+        returns bolds.
+
+        Returns
+        -------
+        ICA_string : string
+            Suffix describing the denoising of the selected bolds
+        rules : list of dict
+            Keyword arguments for BIDSIndex.get
+        '''
+        if self.preprocessing_type == 'HCP':
+            if self.selected_reg_name == self.msm_all_reg_name:
+                reg_include, reg_exclude = [self.msm_all_reg_name + '_hp2000'], []
+            else:
+                reg_include, reg_exclude = ['_hp2000'], [self.msm_all_reg_name]
+            # use ICA outputs
+            if self.denoised_outputs == 'YES':
+                return "_FIXclean", [dict(type='clean',extension="dtseries.nii",
+                                          include=[reg_include[0]+'_clean','task-rest'],exclude=reg_exclude)]
+            # do not use ICA outputs
+            return "", [dict(extension="dtseries.nii",include=reg_include+['task-rest'],exclude=reg_exclude+['clean'])]
+        elif self.preprocessing_type == 'fmriprep':
+            #use ICA outputs
+            if self.denoised_outputs == 'YES':
+                return "_AROMAclean", [dict(type='bold',include=['smoothAROMAnonaggr','task-rest'])]
+            # do not use ICA outputs
+            return "", [dict(type='bold',include=['preproc','task-rest'])]
+        elif self.preprocessing_type == 'ABCD':
+            # use filered outputs
+            if self.denoised_outputs == 'YES':
+                return "_filtered", [dict(extension="dtseries.nii",type='Atlas',include=['task-rest','DCANBOLDProc'],parent_include=['DCANBOLDProc']), # traditional outputs
+                                     dict(extension="dtseries.nii",type='timeseries',include=['desc-filtered','task-rest'])]
+            return "", [dict(extension="dtseries.nii",type='timeseries',include=['task-rest','run'])] # truncated outputs generated for NDA sumbission
+        raise ValueError('Unknown preprocessing type: %s' % self.preprocessing_type)
+
+    def query_bolds(self,rules,subject=None,session=None):
+        for rule in rules:
+            bolds = self.bids_index.get(subject=subject,session=session,**rule)
+            if bolds:
+                return bolds
+        return []
+
     def create_bold_lists(self):
         
         '''
@@ -173,274 +633,448 @@ class MACCHIATO_setup:
         TYPE list
             Paths to bold timeseries
         '''
-        # TODO need to incorporate the instances in which participant label and session label BOTH exist
+        self.ICA_string, rules = self.bold_selection_rules()
         if self.combine_resting_scans == 'NO':
-            if self.preprocessing_type == 'HCP':
-                # use ICA outputs
-                if self.denoised_outputs == 'YES':
-                    self.ICA_string="_FIXclean"
-                    if self.selected_reg_name == self.msm_all_reg_name:
-                        if not self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(type='clean',extensions="dtseries.nii") if self.msm_all_reg_name+'_hp2000_clean' in f.filename and 'task-rest' in f.filename]
-                        elif self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,type='clean',extensions="dtseries.nii") if self.msm_all_reg_name+'_hp2000_clean' in f.filename and 'task-rest' in f.filename] 
-                        elif not self.participant_label and self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(session=self.session_label,type='clean',extensions="dtseries.nii") if self.msm_all_reg_name+'_hp2000_clean' in f.filename and 'task-rest' in f.filename]
-                        else:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,type='clean',extensions="dtseries.nii") if self.msm_all_reg_name+'_hp2000_clean' in f.filename and 'task-rest' in f.filename]
-                    else:
-                        if not self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(type='clean',extensions="dtseries.nii") if '_hp2000_clean' in f.filename and 'task-rest' in f.filename and not self.msm_all_reg_name in f.filename]
-                        elif self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,type='clean',extensions="dtseries.nii") if '_hp2000_clean' in f.filename and 'task-rest' in f.filename and not self.msm_all_reg_name in f.filename]
-                        elif not self.participant_label and self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(session=self.session_label,type='clean',extensions="dtseries.nii",) if self.msm_all_reg_name+'_hp2000_clean' in f.filename and 'task-rest' in f.filename]
-                        else:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,type='clean',extensions="dtseries.nii") if self.msm_all_reg_name+'_hp2000_clean' in f.filename and 'task-rest' in f.filename]
-
-                # do not use ICA outputs
-                else:
-                    self.ICA_string=""
-                    if self.selected_reg_name == self.msm_all_reg_name:
-                        if not self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii") if self.msm_all_reg_name + '_hp2000' in f.filename and 'task-rest' in f.filename and not 'clean' in f.filename]
-                        elif self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,extensions="dtseries.nii") if self.msm_all_reg_name + '_hp2000' in f.filename and 'task-rest' in f.filename and not 'clean' in f.filename]
-                        elif not self.participant_label and self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(session=self.session_label,extensions="dtseries.nii") if self.msm_all_reg_name + '_hp2000' in f.filename and 'task-rest' in f.filename and not 'clean' in f.filename]
-                        else:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,extensions="dtseries.nii") if self.msm_all_reg_name + '_hp2000' in f.filename and 'task-rest' in f.filename and not 'clean' in f.filename]
-                    else:
-                        if not self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii") if '_hp2000' in f.filename and not 'clean' in f.filename and 'task-rest' in f.filename and not self.msm_all_reg_name in f.filename]
-                        elif self.participant_label and not self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,extensions="dtseries.nii") if '_hp2000' in f.filename and 'task-rest' in f.filename and not 'clean' in f.filename and not self.msm_all_reg_name in f.filename]
-                        elif not self.participant_label and self.session_label:
-                            self.bolds = [f.filename for f in self.layout.get(session=self.session_label,extensions="dtseries.nii") if '_hp2000' in f.filename and 'task-rest' in f.filename and not 'clean' in f.filename and not self.msm_all_reg_name in f.filename]
-                        else:
-                            self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,extensions="dtseries.nii") if '_hp2000' in f.filename and 'task-rest' in f.filename and not 'clean' in f.filename and not self.msm_all_reg_name in f.filename]
-            elif self.preprocessing_type == 'fmriprep':
-                #use ICA outputs
-                if self.denoised_outputs == 'YES':
-                    self.ICA_string="_AROMAclean"
-                    if not self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(type='bold') if 'smoothAROMAnonaggr' in f.filename]
-                    elif self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,type='bold') if 'smoothAROMAnonaggr' in f.filename and 'task-rest' in f.filename]
-                    elif not self.participant_label and self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(session=self.session_label,type='bold') if 'smoothAROMAnonaggr' in f.filename and 'task-rest' in f.filename]
-                    else:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,type='bold') if 'smoothAROMAnonaggr' in f.filename and 'task-rest' in f.filename]
-                # do not use ICA outputs
+            self.bolds = self.query_bolds(rules,subject=self.participant_label,session=self.session_label)
+        else:
+            # will combine within one scanning session no matter how many resting state scans collected,
+            # datasets without sessions combine all of a subject's runs
+            session_runs = {}
+            for rule in rules:
+                # a rule only fills the sessions that earlier rules found no bolds for
+                for scanning_session, runs in self.bids_index.get_groups(subject=self.participant_label,session=self.session_label,**rule).items():
+                    if not scanning_session in session_runs:
+                        session_runs[scanning_session] = runs
+            self.combined_bolds_list = [session_runs[scanning_session] for scanning_session in
+                                        sorted(session_runs,key=lambda key: (key[0],key[1] or ''))]
+            self.bolds = self.combined_bolds_list
+        if self.preprocessing_type == 'fmriprep':
+            self.bolds_ref = self.bids_index.get(type='boldref')
+    
+    def create_task_list(self,parcel_count):
+        '''
+        Splits the run into (bold index, network metrics) tasks and estimates the cost of each
+        from the bold's number of timepoints, the number of parcels and the estimators involved.
+
+        Returns
+        -------
+        tasks : list of tuples
+            (index into self.bolds, tuple of network metrics)
+        costs : list
+            Estimated cost of every task
+        '''
+        tasks = []
+        costs = []
+        self.bold_timepoints = []
+        self.bold_windows = []
+        metric_groups = group_network_metrics(self.network_matrix_calculation,self.graph_theory_metric,self.time_series_metric,
+                                              self.fd_threshold,self.dynamic_connectivity)
+        time_series_units = self.time_series_units(parcel_count)
+        for i, bold in enumerate(self.bolds):
+            # only the CIFTI header is read to count timepoints, windows stay within a run
+            run_timepoints = [cifti_metadata(run).n_timepoints for run in (bold if type(bold) == list else [bold])]
+            n_timepoints = sum(run_timepoints)
+            self.bold_timepoints.append(n_timepoints)
+            self.bold_windows.append(sum(window_count(t,self.window_length,self.window_step) for t in run_timepoints))
+            for metric_group in metric_groups:
+                tasks.append((i,metric_group))
+                if all(m in SCALAR_METRICS for m in metric_group):
+                    costs.append(estimate_task_cost(n_timepoints,time_series_units,metric_group))
                 else:
-                    self.ICA_string=""
-                    if not self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(type='bold') if 'preproc' in f.filename]
-                    elif self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,type='bold') if 'preproc' in f.filename and 'task-rest' in f.filename]
-                    elif not self.participant_label and self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(session =self.session_label,type='bold') if 'preproc' in f.filename and 'task-rest' in f.filename]
-                    else:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session =self.session_label,type='bold') if 'preproc' in f.filename and 'task-rest' in f.filename]
-                self.bolds_ref = [f.filename for f in self.layout.get(type='boldref')]
-            elif self.preprocessing_type == 'ABCD':
-                 # use filered outputs
-                if self.denoised_outputs == 'YES':
-                    self.ICA_string="_filtered"
-                    if not self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii",type='Atlas') if 'task-rest' in f.filename and 'DCANBOLDProc' in f.filename if 'DCANBOLDProc' in os.path.basename(os.path.dirname(f.filename))] # traditional outputs
-                        #if not self.bolds > 0:
-                        #    self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii",type='timeseries') if 'task-rest' and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #    filtered = 'NO' 
-                        #else:
-                        #filtered = 'YES'
-                    elif self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,extensions="dtseries.nii",type='Atlas') if 'task-rest' in f.filename and 'DCANBOLDProc' in f.filename if 'DCANBOLDProc' in os.path.basename(os.path.dirname(f.filename))] # traditional outputs
-                        #if not self.bolds > 0:
-                        #    self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,extensions="dtseries.nii",type='timeseries') if 'task-rest' and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #    filtered = 'NO' 
-                        #else:
-                        #filtered = 'YES'
-                    elif not self.participant_label and self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(session=self.session_label,extensions="dtseries.nii",type='Atlas') if 'task-rest' in f.filename and 'DCANBOLDProc' in f.filename if 'DCANBOLDProc' in os.path.basename(os.path.dirname(f.filename))] # traditional outputs
-                        #if not self.bolds > 0:
-                        #    self.bolds = [f.filename for f in self.layout.get(session=self.session_label,extensions="dtseries.nii",type='timeseries') if 'task-rest' and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #    filtered = 'NO' 
-                        #else:
-                        #filtered = 'YES'
-                    else:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,extensions="dtseries.nii",type='Atlas') if 'task-rest' in f.filename and 'DCANBOLDProc' in f.filename if 'DCANBOLDProc' in os.path.basename(os.path.dirname(f.filename))] # traditional outputs
-                        #if not self.bolds > 0:
-                        #    self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,extensions="dtseries.nii",type='timeseries') if 'task-rest' and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #    filtered = 'NO'
-                        #else:
-                        #filtered = 'YES'
-                    #if filtered == 'NO':
-                    #    raise NotImplementedError # TODO: will need to add this, however, the use cases in which they may happen are limited
-                        
-                else: 
-                    if not self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii",type='timeseries') if 'task-rest' in f.filename and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #filtered = 'NO'
-                    elif self.participant_label and not self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,extensions="dtseries.nii",type='timeseries') if 'task-rest' in f.filename and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #filtered = 'NO' 
-                    elif not self.participant_label and self.session_label:
-                        self.bolds = [f.filename for f in self.layout.get(session=self.session_label,extensions="dtseries.nii",type='timeseries') if 'task-rest' in f.filename and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #filtered = 'NO' 
+                    costs.append(estimate_task_cost(n_timepoints,parcel_count,metric_group))
+        return tasks, costs
+
+    def output_file(self):
+        '''
+        Path of the HDF5 output. A resumed run continues the most recent MACCHIATO output
+        in the output folder, otherwise a file named after today's date is used.
+        '''
+        if self.resume == 'YES':
+            existing = [os.path.join(self.output_dir,f) for f in os.listdir(self.output_dir)
+                        if f.startswith('MACCHIATO_output_') and f.endswith('.hdf5')]
+            if existing:
+                return max(existing,key=os.path.getmtime)
+        today=date.today()
+        pretty_today=today.strftime("%b-%d-%Y")
+        return os.path.join(self.output_dir,'MACCHIATO_output_'+pretty_today+'.hdf5')
+
+    def compute_task(self,task,output):
+        indices, network_metrics = task
+        return compute_network_task([self.bolds[i] for i in indices],network_metrics,self.output_dir,
+                                    self.parcellation_file,self.parcellation_name,
+                                    self.apply_Fishers_r_to_z_transform,self.parcellation_engine,
+                                    self.estimator_options(),self.stored_matrices(output,task),
+                                    self.graph_theory_density,self.time_series_space,self.dynamic_options())
+
+    def stored_matrices(self,output,task):
+        '''
+        Matrices written by an earlier run that the task's graph theory datasets need
+        '''
+        indices, network_metrics = task
+        return {network_metric: output.read_network_matrices(indices,network_metric)
+                for network_metric in stored_network_metrics(network_metrics)}
+
+    def graph_theory_datasets(self,parcel_count):
+        '''
+        graph_theory/<network metric>/<graph theory metric> name -> per-bold shape. Cohort
+        metrics are written after the task loop and get no graph theory metrics.
+        '''
+        graph_theory_datasets = {}
+        for group in group_network_metrics(self.network_matrix_calculation,self.graph_theory_metric):
+            for name in group:
+                if is_graph_theory_dataset(name):
+                    if split_graph_theory_dataset(name)[1] in EDGE_GRAPH_THEORY_METRICS:
+                        graph_theory_datasets[name] = (parcel_count,parcel_count)
                     else:
-                        self.bolds = [f.filename for f in self.layout.get(subject=self.participant_label,session=self.session_label,extensions="dtseries.nii",type='timeseries') if 'task-rest' in f.filename and 'run' in f.filename] # truncated outputs generated for NDA sumbission
-                        #filtered = 'NO'
-        else:
-            self.combined_bolds_list = [] # will combine within one scanning session no matter how many resting state scans collected
-            if len(self.layout.get_sessions()) > 0:
-                # retreive sessions data based on inputted (or not) participant and session labels
-                if not self.participant_label and not self.session_label:
-                    scanning_sessions = self.layout.get_sessions()
-                elif self.participant_label and not self.session_label:
-                    scanning_sessions = self.layout.get_sessions(subject=self.participant_label)
-                elif not self.participant_label and self.session_label:
-                    scanning_sessions = self.layout.get_sessions(session=self.session_label)
+                        graph_theory_datasets[name] = (parcel_count,)
+        return graph_theory_datasets
+
+    def censored_datasets(self,parcel_count):
+        '''
+        censored/fd_<threshold>/<network metric> name -> per-bold shape, for the covariance
+        derived metrics at every FD threshold
+        '''
+        return dict((censored_dataset(fd_threshold,network_metric),(parcel_count,parcel_count))
+                    for fd_threshold in self.fd_threshold for network_metric in self.network_matrix_calculation
+                    if network_metric in COVARIANCE_METRICS)
+
+    def dynamic_options(self):
+        '''
+        Sliding-window settings of compute_network_task, every bold gets as many window rows
+        as the longest one
+        '''
+        return {'window_length':self.window_length,
+                'window_step':self.window_step,
+                'taper':self.window_taper,
+                'n_windows':max(self.bold_windows or [0])}
+
+    def dynamic_datasets(self,parcel_count):
+        '''
+        dynamic/<network metric> name -> per-bold shape, windows x parcels x parcels, and
+        dynamic_states/<network metric> -> windows when windows are clustered into states
+        '''
+        n_windows = self.dynamic_options()['n_windows']
+        dynamic_datasets = dict((dynamic_dataset(network_metric),(n_windows,parcel_count,parcel_count))
+                                for network_metric in self.dynamic_connectivity)
+        if self.dynamic_states:
+            dynamic_datasets.update((dynamic_states_dataset(network_metric),(n_windows,)) for network_metric in self.dynamic_connectivity)
+        return dynamic_datasets
+
+    def time_series_units(self,parcel_count):
+        '''
+        Length of the time series metric vectors: the number of parcels, or of grayordinates
+        read from the header of the first bold
+        '''
+        if self.time_series_space == 'parcels' or not self.bolds:
+            return parcel_count
+        first_bold = self.bolds[0][0] if type(self.bolds[0]) == list else self.bolds[0]
+        return cifti_metadata(first_bold).n_grayordinates
+
+    def time_series_datasets(self,parcel_count):
+        '''
+        Time series metric -> per-bold shape. Wavelet correlations are always between parcels.
+        '''
+        time_series_datasets = {}
+        for time_series_metric in self.time_series_metric:
+            if time_series_metric == 'multiscale_entropy':
+                time_series_datasets[time_series_metric] = (ENTROPY_SCALES,self.time_series_units(parcel_count))
+            elif time_series_metric in SCALAR_METRICS:
+                time_series_datasets[time_series_metric] = (self.time_series_units(parcel_count),)
+            elif time_series_metric == 'wavelet':
+                time_series_datasets[time_series_metric] = (WAVELET_SCALES,parcel_count,parcel_count)
+        return time_series_datasets
+
+    def scalar_datasets(self):
+        '''
+        Per-bold values stored next to the network matrices
+        '''
+        scalar_datasets = []
+        if any(m in SPARSE_METRICS for m in self.network_matrix_calculation):
+            scalar_datasets.append('sparse_alpha')
+        if any(m in COVARIANCE_METRICS for m in self.network_matrix_calculation):
+            scalar_datasets.extend(censored_dataset(fd_threshold,FRAMES_KEPT) for fd_threshold in self.fd_threshold)
+        return scalar_datasets
+
+    def estimator_options(self):
+        '''
+        Keyword arguments for NetworkIO. The sparse estimators are warm started from the
+        median alpha selected so far for the cohort, by earlier runs into the same output
+        and by the tasks this process has already written.
+        '''
+        warm_alpha = None
+        if self.cohort_alphas:
+            warm_alpha = float(np.median(self.cohort_alphas))
+        return {'n_jobs':self.estimator_n_jobs,
+                'dtw_window':self.dtw_window,
+                'sparse_alpha':self.sparse_alpha,
+                'warm_alpha':warm_alpha,
+                'dvars_censoring':self.dvars_censoring}
+
+    def write_task(self,output,task,network_matrices):
+        with stage_timer.stage('hdf5_write',batch_label([self.bolds[i] for i in task[0]])):
+            output.write_network_matrices(task[0],network_matrices)
+        if 'sparse_alpha' in network_matrices:
+            self.cohort_alphas.extend(network_matrices['sparse_alpha'])
+        # group summaries take the matrices while they are in memory
+        for network_metric, accumulator in self.group_accumulators.items():
+            if network_metric in network_matrices:
+                accumulator.update(network_matrices[network_metric])
+                self.accumulated.update((i,network_metric) for i in task[0])
+        # so do the connectivity states, the windows of the cohort are never held together
+        for name, window_states in self.window_states.items():
+            if name in network_matrices:
+                window_states.partial_fit(network_matrices[name])
+                self.accumulated.update((i,name) for i in task[0])
+
+    def create_group_accumulators(self,parcel_count,seed=0):
+        '''
+        One streaming group summary per network metric for group analyses, none otherwise
+        '''
+        self.accumulated = set()
+        if self.analysis_level != 'group':
+            return {}
+        density = GROUP_CONSENSUS_DENSITY if self.graph_theory_density is None else self.graph_theory_density
+        return dict((network_metric,GroupAccumulator((parcel_count,parcel_count),density=density,seed=seed))
+                    for network_metric in self.network_matrix_calculation)
+
+    def compute_group_metrics(self,output,comm=None):
+        '''
+        Completes the group summaries with the matrices this run did not compute, tangent
+        matrices and bolds written by an earlier run, streamed back in chunks of GROUP_CHUNK
+        rows, then merges the summaries of every rank and writes them. Collective under MPI.
+        '''
+        if not self.group_accumulators:
+            return
+        output.hdf5.flush()
+        for network_metric, accumulator in self.group_accumulators.items():
+            with stage_timer.stage('group/' + network_metric):
+                # the tangent pass writes a row for every bold with a covariance
+                completed = output.completed_indices('covariance' if network_metric == 'tangent' else network_metric)
+                accumulated = set(i for i, m in self.accumulated if m == network_metric)
+                if comm is not None:
+                    accumulated = set().union(*comm.allgather(accumulated))
+                remaining = [i for i in completed if not i in accumulated]
+                if comm is not None:
+                    remaining = remaining[comm.rank::comm.size]
+                rows = sorted(output.rows[i] for i in remaining)
+                for start in range(0,len(rows),GROUP_CHUNK):
+                    accumulator.update(output.read_rows(network_metric,rows[start:start+GROUP_CHUNK]))
+                if comm is not None:
+                    accumulator.reduce(comm)
+                statistics = None
+                if comm is None or comm.rank == 0:
+                    statistics = accumulator.statistics()
+                    pprint(" Group summaries of %d %s matrices" % (accumulator.n_matrices,network_metric))
+                output.write_group_statistics(network_metric,statistics,accumulator.statistic_shapes())
+                output.hdf5['group/%s/percentiles' % network_metric].attrs['percentiles'] = GROUP_PERCENTILES
+
+    def create_window_states(self,parcel_count,seed=0):
+        '''
+        Online k-means of the windows of every sliding-window dataset when states are asked for
+        '''
+        if not self.dynamic_states:
+            return {}
+        return dict((dynamic_dataset(network_metric),WindowStates(self.dynamic_states,parcel_count,seed=seed))
+                    for network_metric in self.dynamic_connectivity)
+
+    def compute_dynamic_states(self,output,comm=None):
+        '''
+        Completes the connectivity states with the windows of bolds written by an earlier run,
+        merges the states of every rank, then labels the windows of every bold of this run
+        with their nearest state, streaming one bold's windows at a time. Collective under MPI.
+        '''
+        if not self.window_states:
+            return
+        from workflow.hdf5_output import NetworkMatrixReader
+        output.hdf5.flush()
+        for name, window_states in self.window_states.items():
+            network_metric = split_dynamic_dataset(name)
+            with stage_timer.stage('dynamic_states/' + network_metric):
+                completed = output.completed_indices(name)
+                accumulated = set(i for i, m in self.accumulated if m == name)
+                if comm is not None:
+                    accumulated = set().union(*comm.allgather(accumulated))
+                remaining = [i for i in completed if not i in accumulated]
+                if comm is not None:
+                    remaining = remaining[comm.rank::comm.size]
+                reader = NetworkMatrixReader(output.network_matrix_dsets[name])
+                for row in sorted(output.rows[i] for i in remaining):
+                    window_states.partial_fit(reader.edges(row))
+                if comm is not None:
+                    window_states.reduce(comm)
                 else:
-                    scanning_sessions = self.layout.get_sessions(session=self.session_label, subject=self.participant_label)
-                for subject in self.layout.get_subjects(session=scanning_sessions):
-                    for scanning_session in self.layout.get_sessions(subject=subject):
-                        if self.preprocessing_type == 'HCP':
-                            # use ICA outputs
-                            if self.denoised_outputs == 'YES':
-                                self.ICA_string="_FIXclean"
-                                if self.selected_reg_name == self.msm_all_reg_name:
-                                    self.bolds = [f.filename for f in self.layout.get(type='clean',extensions="dtseries.nii",subject=subject,session=scanning_session) if self.msm_all_reg_name+'_hp2000_clean' in f.filename]
-                                else:
-                                    self.bolds = [f.filename for f in self.layout.get(type='clean',extensions="dtseries.nii",subject=subject,session=scanning_session) if '_hp2000_clean' in f.filename and not self.msm_all_reg_name in f.filename]
-                            # do not use ICA outputs
-                            else:
-                                self.ICA_string=""
-                                if self.selected_reg_name == self.msm_all_reg_name:
-                                    self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii",subject=subject,session=scanning_session) if self.msm_all_reg_name + '_hp2000' in f.filename and not 'clean' in f.filename]
-                                else:
-                                    self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii",subject=subject,session=scanning_session) if '_hp2000' in f.filename and not 'clean' in f.filename and not self.msm_all_reg_name in f.filename]
-                        elif self.preprocessing_type == 'fmriprep':
-                            #use ICA outputs
-                            if self.denoised_outputs == 'YES':
-                                self.ICA_string="_AROMAclean"
-                                self.bolds = [f.filename for f in self.layout.get(type='bold',subject=subject,session=scanning_session) if 'smoothAROMAnonaggr' in f.filename]
-                            # do not use ICA outputs
-                            else:
-                                self.ICA_string=""
-                                self.bolds = [f.filename for f in self.layout.get(type='bold') if 'preproc' in f.filename]
-                            self.bolds_ref = [f.filename for f in self.layout.get(type='boldref')]
-                        elif self.preprocessing_type == 'ABCD':    
-                            if self.denoised_outputs == 'YES':
-                                self.ICA_string='_filtered'
-                                self.bolds = [f.filename for f in self.layout.get(subject=subject,session=scanning_session,type='timeseries',extensions="dtseries.nii") if 'desc-filtered' in f.filename and 'task-rest' in f.filename]
-                                if not len(self.bolds) > 0:
-                                    self.bolds = [f.filename for f in self.layout.get(subject=subject,session=scanning_session,type='Atlas',extensions="dtseries.nii") if 'DCANBOLDProc' in f.filename and 'task-rest' in f.filename if not 'DCANBOLDProc' in os.path.basename(os.path.dirname(f.filename))]
-                            else:
-                                self.ICA_string=''
-                                self.bolds = [f.filename for f in self.layout.get(subject=subject,session=scanning_session,extensions="dtseries.nii",type='timeseries') if 'task-rest' in f.filename and 'run' in f.filename] # truncated outputs generated for NDA sumbission    
-                        self.combined_bolds_list.append(self.bolds)
-            else:
-                # retreive subject data based on inputted (or not) participant label
-                if not self.participant_label:
-                    scanning_sessions = self.layout.get_subjects()
-                elif self.participant_label:
-                    scanning_sessions = self.layout.get_subjects(subject=self.participant_label)
-                for scanning_session in scanning_sessions:
-                    if self.preprocessing_type == 'HCP':
-                        # use ICA outputs
-                        if self.denoised_outputs == 'YES':
-                            self.ICA_string="_FIXclean"
-                            if self.selected_reg_name == self.msm_all_reg_name:
-                                self.bolds = [f.filename for f in self.layout.get(type='clean',extensions="dtseries.nii",subject=scanning_session) if self.msm_all_reg_name+'_hp2000_clean' in f.filename]
-                            else:
-                                self.bolds = [f.filename for f in self.layout.get(type='clean',extensions="dtseries.nii",subject=scanning_session) if '_hp2000_clean' in f.filename and not self.msm_all_reg_name in f.filename]
-                        # do not use ICA outputs
-                        else:
-                            self.ICA_string=""
-                            if self.selected_reg_name == self.msm_all_reg_name:
-                                self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii",subject=scanning_session) if self.msm_all_reg_name + '_hp2000' in f.filename and not 'clean' in f.filename]
-                            else:
-                                self.bolds = [f.filename for f in self.layout.get(extensions="dtseries.nii",subject=scanning_session) if '_hp2000' in f.filename and not 'clean' in f.filename and not self.msm_all_reg_name in f.filename]
-                    elif self.preprocessing_type == 'fmriprep':
-                        #use ICA outputs
-                        if self.denoised_outputs == 'YES':
-                            self.ICA_string="_AROMAclean"
-                            self.bolds = [f.filename for f in self.layout.get(type='bold',subject=scanning_session) if 'smoothAROMAnonaggr' in f.filename]
-                        # do not use ICA outputs
-                        else:
-                            self.ICA_string=""
-                            self.bolds = [f.filename for f in self.layout.get(type='bold') if 'preproc' in f.filename]
-                        self.bolds_ref = [f.filename for f in self.layout.get(type='boldref')]
-                    self.combined_bolds_list.append(self.bolds)
-        self.bolds = self.combined_bolds_list
-    
-    # TODO incorporate variables into class
+                    window_states.seed_pending()
+                output.write_state_centroids(dynamic_states_dataset(network_metric),window_states.centroid_matrices(),window_states.counts)
+                rows = sorted(output.rows[i] for i in completed)
+                if comm is not None:
+                    rows = rows[comm.rank::comm.size]
+                for row in rows:
+                    output.write_rows(dynamic_states_dataset(network_metric),[row],window_states.predict(reader.edges(row))[None])
+                if comm is None or comm.rank == 0:
+                    pprint(" Labelled the %s windows of %d bolds with %d states" % (network_metric,len(completed),self.dynamic_states))
+
+    def compute_cohort_metrics(self,output,comm=None):
+        '''
+        Second pass over the cohort once every bold's covariance is written: fits the
+        tangent space reference (the geometric mean covariance) and writes the tangent
+        embedding of every bold. Under MPI each rank streams its share of the covariance
+        rows and the sums of every mean iteration are allreduced. Collective under MPI.
+        '''
+        if not 'tangent' in self.network_matrix_calculation:
+            return
+        indices = output.completed_indices('covariance')
+        reduce = None
+        if comm is not None:
+            indices = indices[comm.rank::comm.size]
+            reduce = lambda value: tuple(comm.allreduce(part) for part in value)
+        rows = sorted(output.rows[i] for i in indices)
+        row_chunks = [rows[start:start+TANGENT_CHUNK] for start in range(0,len(rows),TANGENT_CHUNK)]
+        pprint(" Estimating the tangent space reference")
+        with stage_timer.stage('cohort/tangent'):
+            tangent_space = TangentSpace().fit(lambda: (output.read_rows('covariance',chunk_rows) for chunk_rows in row_chunks),reduce)
+            for chunk_rows in row_chunks:
+                output.write_rows('tangent',chunk_rows,tangent_space.transform(output.read_rows('covariance',chunk_rows)))
+        output.write_cohort_reference('tangent',tangent_space.reference,tangent_space.count)
+        pprint(" Wrote tangent matrices of %d bolds" % tangent_space.count)
+
     def execute_MACCHIATO_instances(self):
+        '''
+        Runs every task through the selected backend and writes the network matrices to HDF5
+        '''
+        if self.backend == 'mpi':
+            self.execute_mpi_instances()
+        else:
+            self.execute_pool_instances()
+
+    def execute_mpi_instances(self):
         # now parse arguments and print to standard output (STDOUT), slight difference in call if done as batch or participant
+        from workflow.hdf5_output import HDF5Output
+        from workflow.scheduler import TaskScheduler
         
         # set up multiprocessing/parallelization allocation
-        comm = MPI.COMM_WORLD
+        comm = self.comm
         rank = comm.rank
         
         # retreive number of, height and width of matrices 
         image_count = len(self.bolds)
-        try:
-            read_parcel_file = cifti.read(self.parcellation_file)
-        except TypeError:
-            print('This does not look like a CIFTI parcel file. Must exit')
-        parcel_file_label_tuple = read_parcel_file[1][0][0][1]
-        parcel_labels = []
-        for value in parcel_file_label_tuple:
-                if not '???' in parcel_file_label_tuple[value][0]:
-                    parcel_labels.append(parcel_file_label_tuple[value][0])
+        # rank 0 cached the parsed label file next to the outputs while planning, the other ranks load the cache
+        parcellation = parcellation_cache.get(self.parcellation_file,cache_dir=self.output_dir)
+        parcel_labels = parcellation.parcel_labels
         height = len(parcel_labels) # height of functional connectome
         width = len(parcel_labels) # width of functional connectome
         pprint("============================================================================")
         pprint(" Running %d parallel MPI processes" % comm.size)
         pprint(" Processing %d images of size %d x %d" % (image_count, width, height))
         
-        comm.Barrier()    ### Start Stopwatch ###
-        today=date.today()
-        pretty_today=today.strftime("%b-%d-%Y")
-        with h5py.File(os.path.join(self.output_dir,'MACCHIATO_output_'+pretty_today+'.hdf5'),'w',driver='mpio',comm=comm) as hdf5:
-            if type(self.network_matrix_calculation) == str:
-                network_matrix_dset = hdf5.create_dataset(name=self.network_matrix_calculation, shape=(image_count,height,width), dtype='f')
-                network_matrix_dset.attrs['parcel_file'] = self.parcellation_file
-                network_matrix_dset.attrs['parcel_name'] = self.parcellation_name    
-                for i in range(rank, image_count, comm.size):                  
-                    bold = self.bolds[i]
-                    network_metric_init = NetworkIO(output_dir=self.output_dir, 
-                                        cifti_data=bold, 
-                                        parcel_file=self.parcellation_file, 
-                                        parcel_name=self.parcellation_name, 
-                                        network_metric=self.network_matrix_calculation,
-                                        fishers_r_to_z_transform=self.apply_Fishers_r_to_z_transform)
-                    
-                    metric_data = network_metric_init.create_network_matrix()
-                    network_matrix_dset[i,:,:]=metric_data
+        # task costs were estimated from the bold headers by rank 0 while planning
+        tasks, costs = self.plan['tasks'], self.plan['costs']
+        bold_mtimes, output_file = self.plan['bold_mtimes'], self.plan['output_file']
+        # dataset creation and resizing are collective, so every rank prepares the output up front
+        output = HDF5Output(output_file,self.bolds,bold_mtimes,self.network_matrix_calculation,height,width,
+                            self.parcellation_file,self.parcellation_name,parcellation.atlas_hash,
+                            resume=self.resume,comm=comm,scalar_datasets=self.scalar_datasets(),
+                            graph_theory_datasets=self.graph_theory_datasets(height),
+                            time_series_datasets=self.time_series_datasets(height),
+                            censored_datasets=self.censored_datasets(height),
+                            dynamic_datasets=self.dynamic_datasets(height),
+                            layout=self.output_layout,dtype=self.output_dtype,compression=self.output_compression,
+                            float32_datasets=self.float32_datasets)
+        self.cohort_alphas = list(output.scalar_values('sparse_alpha')) if 'sparse_alpha' in output.scalar_dsets else []
+        self.group_accumulators = self.create_group_accumulators(height,seed=rank)
+        self.window_states = self.create_window_states(height,seed=rank)
+        tasks, costs = output.filter_tasks(tasks,costs)
+        tasks, costs = batch_tasks(tasks,costs,self.bold_timepoints,self.batch_size)
+        pprint(" %d tasks left to compute" % len(tasks))
+        # tasks are handed out longest first to whichever rank is free
+        scheduler = TaskScheduler(comm,tasks,costs)
+        for task in scheduler:
+            self.write_task(output,task,self.compute_task(task,output))
+        # make every rank's rows visible before the cohort pass reads them
+        output.hdf5.flush()
+        scheduler.report()
+        self.compute_cohort_metrics(output,comm)
+        self.compute_group_metrics(output,comm)
+        self.compute_dynamic_states(output,comm)
+        # every rank's stage timings are gathered to rank 0 and appended to the timings table
+        records = stage_timer.gather(comm)
+        output.write_timings(records)
+        if rank == 0 and self.trace_file:
+            write_trace(self.trace_file,records)
+        output.close()
+
+    def execute_pool_instances(self):
+        '''
+        Runs tasks in a local process or thread pool (or serially) without MPI.
+        Only this process opens the HDF5 file, so h5py does not need parallel HDF5.
+        '''
+        # h5py is only loaded once there is an output to write, --plan_only never needs it
+        from workflow.hdf5_output import HDF5Output
+        image_count = len(self.bolds)
+        parcellation = parcellation_cache.get(self.parcellation_file,cache_dir=self.output_dir)
+        height = parcellation.parcel_count # height of functional connectome
+        width = parcellation.parcel_count # width of functional connectome
+        pprint("============================================================================")
+        pprint(" Running %s backend with %d workers" % (self.backend, self.num_cpus))
+        pprint(" Processing %d images of size %d x %d" % (image_count, width, height))
+        
+        tasks, costs = self.plan['tasks'], self.plan['costs']
+        output = HDF5Output(self.plan['output_file'],self.bolds,self.plan['bold_mtimes'],
+                            self.network_matrix_calculation,height,width,
+                            self.parcellation_file,self.parcellation_name,parcellation.atlas_hash,
+                            resume=self.resume,scalar_datasets=self.scalar_datasets(),
+                            graph_theory_datasets=self.graph_theory_datasets(height),
+                            time_series_datasets=self.time_series_datasets(height),
+                            censored_datasets=self.censored_datasets(height),
+                            dynamic_datasets=self.dynamic_datasets(height),
+                            layout=self.output_layout,dtype=self.output_dtype,compression=self.output_compression,
+                            float32_datasets=self.float32_datasets)
+        self.cohort_alphas = list(output.scalar_values('sparse_alpha')) if 'sparse_alpha' in output.scalar_dsets else []
+        self.group_accumulators = self.create_group_accumulators(height,seed=0)
+        self.window_states = self.create_window_states(height,seed=0)
+        tasks, costs = output.filter_tasks(tasks,costs)
+        tasks, costs = batch_tasks(tasks,costs,self.bold_timepoints,self.batch_size)
+        pprint(" %d tasks left to compute" % len(tasks))
+        # longest tasks first so the pool does not end on a straggler
+        tasks = [task for cost, task in sorted(zip(costs,tasks),key=lambda pair: -pair[0])]
+        try:
+            if self.backend == 'serial':
+                results = ((task, self.compute_task(task,output)) for task in tasks)
             else:
-                for j in self.network_matrix_calculation:
-                    network_matrix_dset = hdf5.create_dataset(name=j, shape=(image_count,height,width), dtype='f')
-                    network_matrix_dset.attrs['parcel_file'] = self.parcellation_file
-                    network_matrix_dset.attrs['parcel_name'] = self.parcellation_name    
-                    for i in range(rank, image_count, comm.size):                  
-                        bold = self.bolds[i]
-                        network_metric_init = NetworkIO(output_dir=self.output_dir, 
-                                            cifti_data=bold, 
-                                            parcel_file=self.parcellation_file, 
-                                            parcel_name=self.parcellation_name, 
-                                            network_metric=self.network_matrix_calculation,
-                                            fishers_r_to_z_transform=self.apply_Fishers_r_to_z_transform)
-                        
-                        metric_data = network_metric_init.create_network_matrix()
-                        network_matrix_dset[i,:,:]=metric_data
+                if self.backend == 'processes':
+                    executor = ProcessPoolExecutor(max_workers=self.num_cpus,initializer=clear_inherited_timings)
+                else:
+                    executor = ThreadPoolExecutor(max_workers=self.num_cpus)
+                # pool tasks are submitted up front, so they share the warm start of the earlier runs
+                estimator_options = self.estimator_options()
+                futures = {}
+                for task in tasks:
+                    indices, network_metrics = task
+                    futures[executor.submit(timed_network_task,[self.bolds[i] for i in indices],network_metrics,self.output_dir,
+                                            self.parcellation_file,self.parcellation_name,
+                                            self.apply_Fishers_r_to_z_transform,self.parcellation_engine,
+                                            estimator_options,self.stored_matrices(output,task),
+                                            self.graph_theory_density,self.time_series_space,self.dynamic_options())] = task
+                results = ((futures[future], future.result()) for future in as_completed(futures))
+            # the parent process is the single HDF5 writer
+            for task, network_matrices in results:
+                if self.backend != 'serial':
+                    network_matrices, records = network_matrices
+                    stage_timer.extend(records)
+                self.write_task(output,task,network_matrices)
+            if self.backend != 'serial':
+                executor.shutdown()
+            self.compute_cohort_metrics(output)
+            self.compute_group_metrics(output)
+            self.compute_dynamic_states(output)
+            records = stage_timer.drain()
+            output.write_timings(records)
+            if self.trace_file:
+                write_trace(self.trace_file,records)
+        finally:
+            output.close()
                 
 if __name__ == '__main__':
-    arg_string = sys.argv[1:]
-    args_dict = {}
-    for arg in arg_string:
-        key=arg.split('=')[0]
-        value=arg.split('=')[1]
-        args_dict[key] = value
+    # run.py parses the arguments once and passes them as a JSON file
+    with open(sys.argv[1]) as arguments_file:
+        args_dict = json.load(arguments_file)
     MACCHIATO_setup(args_dict)
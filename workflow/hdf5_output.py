@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HDF5 output of MACCHIATO runs.
+
+Every network metric is a resizable (bolds, parcels, parcels) dataset whose rows
+follow the bold_path dataset, graph theory metrics computed from them are
+graph_theory/<network metric>/<graph theory metric> datasets with the same rows,
+and time series metrics are (bolds, parcels or grayordinates) datasets for alff,
+falff and sample_entropy, (bolds, scales, parcels or grayordinates) for
+multiscale_entropy and (bolds, scales, parcels, parcels) for wavelet. A completion table records which
+(bold, bold mtime, atlas hash, metric) combinations have been written, so a
+resumed run only computes what is missing and appends new bolds as new rows.
+
+Under MPI every metadata operation (creating and resizing datasets) is collective,
+so it is done on all ranks before tasks are handed out. Completion rows are
+reserved up front for every pending (bold, metric) pair and flagged as done by
+the rank that writes the matrix, which keeps a killed run resumable.
+
+Cohort metrics (tangent) depend on every bold of the run, so they have no
+completion entries and are rewritten at the end of every run.
+
+Matrices are stored full or, with layout upper_triangle, as the upper triangle
+(diagonal included) of every parcels x parcels matrix, which halves symmetric
+outputs. Every row is one chunk, stored as float32 or float16 and optionally
+compressed. float16 keeps about three significant digits and overflows to inf
+above 65504, which correlations survive but unnormalised covariance and
+precision matrices may not, so datasets a run reads back (the covariance of
+tangent) stay float32. NetworkMatrixReader reads rows of either layout back as full matrices.
+subject_id and session_id datasets follow the bold_path rows. The timings table
+holds the wall time, CPU time and peak memory of every stage of every run, per
+bold and per rank. Group analyses add group/<network metric>/<statistic> summaries
+of the whole cohort (count, mean, variance, percentiles, consensus). Sliding-window
+matrices are stored as dynamic/<network metric> upper triangles, one row of
+windows per bold, with their connectivity states in dynamic_states/.
+"""
+import h5py
+import numpy as np
+import re
+
+from tools.stage_timer import TIMING_DTYPE, timing_table
+
+# fixed length strings, parallel HDF5 cannot write variable length data
+PATH_DTYPE = 'S1024'
+HASH_DTYPE = 'S40'
+METRIC_DTYPE = 'S128'
+LABEL_DTYPE = 'S64'
+
+OUTPUT_LAYOUTS = ['full','upper_triangle']
+OUTPUT_DTYPES = {'float32':'f4','float16':'f2'}
+OUTPUT_COMPRESSIONS = ['none','gzip','lzf','blosc']
+
+def compression_options(compression):
+    '''
+    Keyword arguments of h5py's create_dataset for a compression. blosc needs the optional
+    hdf5plugin package, which registers the filter with HDF5.
+    '''
+    if compression == 'none':
+        return {}
+    if compression == 'gzip':
+        return {'compression':'gzip','compression_opts':4,'shuffle':True}
+    if compression == 'lzf':
+        return {'compression':'lzf','shuffle':True}
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError('blosc compression of the output needs the hdf5plugin package, use gzip or lzf otherwise')
+        return dict(hdf5plugin.Blosc(cname='lz4',clevel=5,shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError('Unknown output compression "%s", choose from %s' % (compression,OUTPUT_COMPRESSIONS))
+
+def upper_triangle_shape(shape):
+    '''
+    Per-bold shape of a (..., parcels, parcels) dataset stored as upper triangles
+    '''
+    n_parcels = shape[-1]
+    return tuple(shape[:-2]) + (n_parcels*(n_parcels+1)//2,)
+
+def pack_upper_triangle(matrices):
+    rows, columns = np.triu_indices(matrices.shape[-1])
+    return matrices[...,rows,columns]
+
+def unpack_upper_triangle(edges,n_parcels):
+    rows, columns = np.triu_indices(n_parcels)
+    matrices = np.empty(edges.shape[:-1]+(n_parcels,n_parcels),dtype='f')
+    matrices[...,rows,columns] = edges
+    matrices[...,columns,rows] = edges
+    return matrices
+
+def bids_label(key,entity):
+    '''
+    Value of a BIDS entity (sub, ses) in a bold key, the last occurrence in its path
+    '''
+    labels = re.findall(r'(?:^|[/_;])' + entity + r'-([a-zA-Z0-9]+)',key)
+    return labels[-1] if labels else ''
+
+class NetworkMatrixReader:
+    def __init__(self,network_matrix_dset):
+        '''
+        Reads rows of a network matrix dataset as full float32 matrices, whatever its layout.
+        Only the rows asked for are read, e.g. reader[:100] or reader[[3,7]].
+
+        Parameters
+        ----------
+        network_matrix_dset : h5py.Dataset
+            Dataset of a MACCHIATO output, e.g. h5py.File(output_file,'r')['correlation']
+        '''
+        self.dset = network_matrix_dset
+        self.layout = network_matrix_dset.attrs.get('layout','full')
+        if isinstance(self.layout,bytes):
+            self.layout = self.layout.decode('utf-8')
+        if self.layout == 'upper_triangle':
+            self.n_parcels = int(network_matrix_dset.attrs['n_parcels'])
+            self.shape = network_matrix_dset.shape[:-1] + (self.n_parcels,self.n_parcels)
+        else:
+            self.shape = network_matrix_dset.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def edges(self,rows):
+        '''
+        Rows as stored, edge vectors for the upper_triangle layout
+        '''
+        return self.dset[rows]
+
+    def __getitem__(self,rows):
+        stored = self.dset[rows]
+        if self.layout == 'upper_triangle':
+            return unpack_upper_triangle(stored,self.n_parcels)
+        return stored.astype('f',copy=False)
+
+def bold_key(bold):
+    '''
+    Key of a bold in the output, a list of combined runs is joined with ";"
+    '''
+    if type(bold) == list:
+        return ';'.join(bold)
+    return bold
+
+class HDF5Output:
+    def __init__(self,output_file,bolds,bold_mtimes,network_metrics,height,width,
+                 parcellation_file,parcellation_name,atlas_hash,resume='NO',comm=None,scalar_datasets=(),
+                 graph_theory_datasets=None,time_series_datasets=None,censored_datasets=None,
+                 dynamic_datasets=None,layout='full',dtype='float32',compression='none',float32_datasets=()):
+        '''
+        Parameters
+        ----------
+        output_file : string
+            Path to the HDF5 file
+        bolds : list
+            Bold paths (or lists of paths for combined runs) of this run
+        bold_mtimes : list
+            Modification time of every bold
+        network_metrics : list
+            Network metrics that get a dataset
+        height, width : int
+            Size of the network matrices
+        parcellation_file : string
+            The CIFTI label file used to parcellate the brain.
+        parcellation_name : string
+            Shorthand name of the CIFTI label file.
+        atlas_hash : string
+            Content hash of the parcellation file
+        resume : [YES, NO]
+            Append to and skip what is already in output_file instead of truncating it
+        comm : mpi4py.MPI.Comm
+            Communicator for parallel HDF5, None for a single writer process
+        scalar_datasets : list
+            Names of per-bold values stored next to the matrices, e.g. the selected sparse_alpha
+        graph_theory_datasets : dict
+            graph_theory/<network metric>/<graph theory metric> name -> per-bold shape
+        time_series_datasets : dict
+            Time series metric -> per-bold shape
+        censored_datasets : dict
+            censored/fd_<threshold>/<network metric> name -> per-bold shape
+        dynamic_datasets : dict
+            dynamic/<network metric> and dynamic_states/<network metric> name -> per-bold shape.
+            Windowed matrices are stored as upper triangles whatever the layout. The window
+            axis grows when a resumed run has bolds with more windows, shorter bolds are NaN.
+        layout : [full, upper_triangle]
+            Store parcels x parcels matrices whole or as their upper triangle
+        dtype : [float32, float16]
+            Precision of the stored matrices and vectors
+        compression : [none, gzip, lzf, blosc]
+            Filter of the per-bold chunks. Parallel HDF5 writes uncompressed data.
+        float32_datasets : list
+            Datasets stored as float32 whatever dtype, e.g. the covariance the tangent
+            space is estimated from
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.output_file = output_file
+        self.bolds = bolds
+        self.bold_mtimes = bold_mtimes
+        self.network_metrics = network_metrics
+        self.height = height
+        self.width = width
+        # per-bold shape of every dataset that has completion entries
+        self.dataset_shapes = dict((network_metric,(height,width)) for network_metric in network_metrics)
+        self.dataset_shapes.update(graph_theory_datasets or {})
+        self.dataset_shapes.update(time_series_datasets or {})
+        self.dataset_shapes.update(censored_datasets or {})
+        self.dataset_shapes.update(dynamic_datasets or {})
+        self.triangle_datasets = set(dynamic_datasets or {})
+        # windows x ... datasets, widened when a later run has bolds with more windows
+        self.window_datasets = set(dynamic_datasets or {})
+        self.parcellation_file = parcellation_file
+        self.parcellation_name = parcellation_name
+        self.atlas_hash = atlas_hash
+        self.scalar_datasets = list(scalar_datasets)
+        self.comm = comm
+        self.rank = comm.rank if comm is not None else 0
+        self.layout = layout
+        self.dtype = OUTPUT_DTYPES[dtype]
+        self.float32_datasets = set(float32_datasets)
+        if comm is not None and compression != 'none':
+            # ranks write rows independently, which parallel HDF5 does not allow for filtered datasets
+            print('HDF5Output: %s compression is not supported by parallel HDF5 writes, the output is stored uncompressed' % compression)
+            compression = 'none'
+        self.compression = compression_options(compression)
+        mode = 'a' if resume == 'YES' else 'w'
+        if comm is not None:
+            self.hdf5 = h5py.File(output_file,mode,driver='mpio',comm=comm)
+        else:
+            self.hdf5 = h5py.File(output_file,mode)
+        self.assign_rows()
+        self.create_network_datasets()
+        self.create_scalar_datasets()
+        self.load_completion()
+
+    def create_resizable(self,name,shape,dtype,chunks=None,fillvalue=None,resizable_axes=1,**filters):
+        '''
+        Dataset name, created with its first resizable_axes axes unlimited if it does not exist
+        '''
+        if name in self.hdf5:
+            return self.hdf5[name]
+        maxshape = (None,)*resizable_axes + tuple(shape[resizable_axes:])
+        return self.hdf5.create_dataset(name,shape=shape,maxshape=maxshape,dtype=dtype,chunks=chunks,fillvalue=fillvalue,**filters)
+
+    def assign_rows(self):
+        '''
+        Maps every bold of this run to a row, reusing the row of bolds already in the file
+        and appending new ones.
+        '''
+        bold_path_dset = self.create_resizable('bold_path',(0,),PATH_DTYPE,chunks=(1024,))
+        existing = [path.decode('utf-8') for path in bold_path_dset[:]]
+        row_of_key = dict(zip(existing,range(len(existing))))
+        new_keys = []
+        self.rows = []
+        for bold in self.bolds:
+            key = bold_key(bold)
+            if len(key.encode('utf-8')) > int(PATH_DTYPE[1:]):
+                raise ValueError('Bold path is too long to be stored in the output: %s' % key)
+            if not key in row_of_key:
+                row_of_key[key] = len(existing) + len(new_keys)
+                new_keys.append(key)
+            self.rows.append(row_of_key[key])
+        self.row_count = len(existing) + len(new_keys)
+        bold_path_dset.resize((self.row_count,))
+        if self.rank == 0 and new_keys:
+            bold_path_dset[len(existing):] = np.array([key.encode('utf-8') for key in new_keys],dtype=PATH_DTYPE)
+        keys = existing + new_keys
+        for name, entity in [('subject_id','sub'),('session_id','ses')]:
+            label_dset = self.create_resizable(name,(0,),LABEL_DTYPE,chunks=(1024,))
+            labelled = label_dset.shape[0]
+            label_dset.resize((self.row_count,))
+            if self.rank == 0 and labelled < self.row_count:
+                label_dset[labelled:] = np.array([bids_label(key,entity).encode('utf-8') for key in keys[labelled:]],dtype=LABEL_DTYPE)
+
+    def create_network_datasets(self):
+        '''
+        Creates (or grows to the current number of rows) one dataset per network metric
+        and per graph theory dataset. With the upper_triangle layout, datasets whose bolds
+        are (..., parcels, parcels) store upper triangles, so do windowed matrices.
+        '''
+        self.network_matrix_dsets = {}
+        self.packed_dsets = set()
+        for network_metric, shape in self.dataset_shapes.items():
+            shape = tuple(shape)
+            packed = (self.layout == 'upper_triangle' or network_metric in self.triangle_datasets) and len(shape) >= 2 and shape[-2:] == (self.height,self.width)
+            if packed:
+                shape = upper_triangle_shape(shape)
+            windowed = network_metric in self.window_datasets
+            stored_shape = self.hdf5[network_metric].shape[1:] if network_metric in self.hdf5 else None
+            if windowed and stored_shape is not None:
+                # bolds of this run may have fewer or more windows than those already stored
+                shape = (max(stored_shape[0],shape[0]),) + shape[1:]
+            # only the window axis may differ from the stored shape
+            fixed_axes = 1 if windowed else 0
+            if stored_shape is not None and stored_shape[fixed_axes:] != shape[fixed_axes:]:
+                raise ValueError('%s holds %s data of shape %s, this run produces %s. Use a new output folder or the layout it was written with.'
+                                 % (self.output_file,network_metric,stored_shape,shape))
+            dtype = OUTPUT_DTYPES['float32'] if network_metric in self.float32_datasets else self.dtype
+            if network_metric in self.float32_datasets and network_metric in self.hdf5 and self.hdf5[network_metric].dtype.itemsize < 4:
+                raise ValueError('%s holds %s as %s, this run reads it back and needs float32. Use a new output folder.'
+                                 % (self.output_file,network_metric,self.hdf5[network_metric].dtype))
+            if windowed:
+                # the window axis may be empty when every bold is shorter than a window
+                chunks = (1,max(shape[0],1)) + shape[1:]
+                network_matrix_dset = self.create_resizable(network_metric,(self.row_count,)+shape,dtype,chunks=chunks,
+                                                            fillvalue=np.nan,resizable_axes=2,**self.compression)
+                network_matrix_dset.resize(shape[0],axis=1)
+            else:
+                network_matrix_dset = self.create_resizable(network_metric,(self.row_count,)+shape,dtype,
+                                                            chunks=(1,)+shape,**self.compression)
+            network_matrix_dset.resize(self.row_count,axis=0)
+            if packed:
+                self.packed_dsets.add(network_metric)
+                network_matrix_dset.attrs['layout'] = 'upper_triangle'
+                network_matrix_dset.attrs['n_parcels'] = self.height
+            else:
+                network_matrix_dset.attrs['layout'] = 'full'
+            network_matrix_dset.attrs['parcel_file'] = self.parcellation_file
+            network_matrix_dset.attrs['parcel_name'] = self.parcellation_name
+            network_matrix_dset.attrs['atlas_hash'] = self.atlas_hash
+            self.network_matrix_dsets[network_metric] = network_matrix_dset
+
+    def create_scalar_datasets(self):
+        '''
+        Creates (or grows) one (rows,) float dataset per scalar dataset, NaN until written
+        '''
+        self.scalar_dsets = {}
+        for name in self.scalar_datasets:
+            scalar_dset = self.create_resizable(name,(self.row_count,),'f8',chunks=(4096,),fillvalue=np.nan)
+            scalar_dset.resize((self.row_count,))
+            self.scalar_dsets[name] = scalar_dset
+
+    def scalar_values(self,name):
+        '''
+        Values of a scalar dataset that have been written, for any bold in the file
+        '''
+        values = self.scalar_dsets[name][:]
+        return values[np.isfinite(values)]
+
+    def load_completion(self):
+        '''
+        Reads the completion table into a set of (bold row, mtime, atlas hash, metric)
+        '''
+        self.hdf5.require_group('completion')
+        self.completion_dsets = {'bold_row':self.create_resizable('completion/bold_row',(0,),'i8',chunks=(4096,)),
+                                 'mtime':self.create_resizable('completion/mtime',(0,),'f8',chunks=(4096,)),
+                                 'atlas_hash':self.create_resizable('completion/atlas_hash',(0,),HASH_DTYPE,chunks=(4096,)),
+                                 'metric':self.create_resizable('completion/metric',(0,),METRIC_DTYPE,chunks=(4096,)),
+                                 'done':self.create_resizable('completion/done',(0,),'u1',chunks=(4096,))}
+        done = self.completion_dsets['done'][:].astype(bool)
+        self.completed = set(zip(self.completion_dsets['bold_row'][:][done].tolist(),
+                                 self.completion_dsets['mtime'][:][done].tolist(),
+                                 [h.decode('utf-8') for h in self.completion_dsets['atlas_hash'][:][done]],
+                                 [m.decode('utf-8') for m in self.completion_dsets['metric'][:][done]]))
+
+    def is_complete(self,i,network_metric):
+        return (self.rows[i],float(self.bold_mtimes[i]),self.atlas_hash,network_metric) in self.completed
+
+    def filter_tasks(self,tasks,costs):
+        '''
+        Drops (bold index, network metrics) tasks, or metrics within them, that are already
+        in the file, then reserves a completion row for every remaining (bold, metric) pair.
+        Collective under MPI: every rank must pass the same tasks.
+
+        Returns
+        -------
+        tasks, costs : list
+            Tasks still to compute and their costs
+        '''
+        pending_tasks = []
+        pending_costs = []
+        for (i, network_metrics), cost in zip(tasks,costs):
+            pending = tuple(m for m in network_metrics if not self.is_complete(i,m))
+            if pending:
+                pending_tasks.append((i,pending))
+                pending_costs.append(cost)
+        self.completion_rows = {}
+        start = self.completion_dsets['done'].shape[0]
+        for i, network_metrics in pending_tasks:
+            for network_metric in network_metrics:
+                self.completion_rows[(i,network_metric)] = start + len(self.completion_rows)
+        for dset in self.completion_dsets.values():
+            dset.resize((start+len(self.completion_rows),))
+        return pending_tasks, pending_costs
+
+    def write_network_matrices(self,indices,network_matrices):
+        '''
+        Writes the network matrices of a batch of bolds straight into their dataset rows
+        and flags them as complete
+
+        Parameters
+        ----------
+        indices : tuple
+            Indices of the bolds in the batch
+        network_matrices : dict
+            Network metric name -> bolds x parcels x parcels array, ordered like indices.
+            Scalar dataset names map to one value per bold instead.
+        '''
+        rows = [self.rows[i] for i in indices]
+        order = np.argsort(rows)
+        sorted_rows = [rows[k] for k in order]
+        for network_metric, metric_data in network_matrices.items():
+            if network_metric in self.scalar_dsets:
+                for row, value in zip(rows,metric_data):
+                    self.scalar_dsets[network_metric][row] = value
+                continue
+            self.write_rows(network_metric,sorted_rows,np.asarray(metric_data)[order])
+            for i, row in zip(indices,rows):
+                if not (i,network_metric) in self.completion_rows:
+                    continue
+                completion_row = self.completion_rows[(i,network_metric)]
+                self.completion_dsets['bold_row'][completion_row] = row
+                self.completion_dsets['mtime'][completion_row] = self.bold_mtimes[i]
+                self.completion_dsets['atlas_hash'][completion_row] = self.atlas_hash.encode('utf-8')
+                self.completion_dsets['metric'][completion_row] = network_metric.encode('utf-8')
+                self.completion_dsets['done'][completion_row] = 1
+
+    def read_network_matrices(self,indices,network_metric):
+        '''
+        Network matrices of bolds already in the file, ordered like indices
+        '''
+        rows = [self.rows[i] for i in indices]
+        order = np.argsort(rows)
+        sorted_data = self.read_rows(network_metric,[rows[k] for k in order])
+        metric_data = np.empty_like(sorted_data)
+        metric_data[order] = sorted_data
+        return metric_data
+
+    def read_rows(self,network_metric,rows):
+        '''
+        Full network matrices (or vectors) of increasing rows, whatever the layout
+        '''
+        return NetworkMatrixReader(self.network_matrix_dsets[network_metric])[list(rows)]
+
+    def write_rows(self,network_metric,rows,metric_data):
+        '''
+        Writes full network matrices (or vectors) to increasing rows, packing them for the upper_triangle
+        layout unless they already are upper triangles
+        '''
+        if network_metric in self.packed_dsets and np.ndim(metric_data) > self.network_matrix_dsets[network_metric].ndim:
+            metric_data = pack_upper_triangle(metric_data)
+        n_windows = self.network_matrix_dsets[network_metric].shape[1] if network_metric in self.window_datasets else None
+        if n_windows is not None and np.shape(metric_data)[1] < n_windows:
+            # bolds computed with fewer window rows than an earlier, longer run left in the file
+            padded = np.full((len(metric_data),n_windows)+np.shape(metric_data)[2:],np.nan,dtype=np.float32)
+            padded[:,:np.shape(metric_data)[1]] = metric_data
+            metric_data = padded
+        if len(rows) == 1:
+            # h5py writes a list of rows in one call when the rows are increasing
+            self.network_matrix_dsets[network_metric][rows[0],...] = metric_data[0]
+        else:
+            self.network_matrix_dsets[network_metric][list(rows),...] = metric_data
+
+    def completed_indices(self,network_metric):
+        '''
+        Indices of the bolds of this run whose network_metric matrix is in the file, read
+        from the completion table on disk so rows written by other ranks are included.
+        Flush the file (collectively under MPI) before calling it.
+        '''
+        self.load_completion()
+        return [i for i in range(len(self.bolds)) if self.is_complete(i,network_metric)]
+
+    def write_cohort_reference(self,network_metric,reference,n_bolds):
+        '''
+        Stores the group reference a cohort metric was estimated against as
+        <network_metric>_reference. Collective under MPI, rank 0 writes the data.
+        '''
+        name = network_metric + '_reference'
+        if name in self.hdf5:
+            del self.hdf5[name]
+        reference_dset = self.hdf5.create_dataset(name,shape=reference.shape,dtype='f8')
+        if self.rank == 0:
+            reference_dset[...] = reference
+        reference_dset.attrs['n_bolds'] = n_bolds
+        reference_dset.attrs['atlas_hash'] = self.atlas_hash
+
+    def write_group_statistics(self,network_metric,statistics,shapes):
+        '''
+        Stores the group summaries of a network metric as group/<network metric>/<statistic>,
+        replacing those of an earlier run. Collective under MPI, rank 0 writes the data.
+
+        Parameters
+        ----------
+        statistics : dict
+            Statistic -> array on rank 0, see tools.group_statistics.GroupAccumulator.statistics
+        shapes : dict
+            Statistic -> shape, on every rank
+        '''
+        for name, shape in shapes.items():
+            dataset_name = '/'.join(['group',network_metric,name])
+            if dataset_name in self.hdf5:
+                del self.hdf5[dataset_name]
+            group_dset = self.hdf5.create_dataset(dataset_name,shape=shape,dtype='f8')
+            if self.rank == 0:
+                group_dset[...] = statistics[name]
+            group_dset.attrs['atlas_hash'] = self.atlas_hash
+
+    def write_state_centroids(self,name,centroids,counts):
+        '''
+        Stores the states x parcels x parcels centroids of dynamic connectivity states as
+        <name>_centroids. Collective under MPI, rank 0 writes the data.
+        '''
+        name = name + '_centroids'
+        if name in self.hdf5:
+            del self.hdf5[name]
+        centroid_dset = self.hdf5.create_dataset(name,shape=centroids.shape,dtype='f8')
+        if self.rank == 0:
+            centroid_dset[...] = centroids
+        centroid_dset.attrs['window_counts'] = counts
+        centroid_dset.attrs['atlas_hash'] = self.atlas_hash
+
+    def write_timings(self,records):
+        '''
+        Appends stage timing records (tools.stage_timer) to the timings table. Collective
+        under MPI, rank 0 passes the records gathered from every rank and writes them.
+        '''
+        count = len(records)
+        if self.comm is not None:
+            count = self.comm.bcast(count,root=0)
+        timings_dset = self.create_resizable('timings',(0,),TIMING_DTYPE,chunks=(1024,))
+        start = timings_dset.shape[0]
+        timings_dset.resize((start+count,))
+        if self.rank == 0 and count:
+            timings_dset[start:] = timing_table(records)
+
+    def close(self):
+        self.hdf5.close()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dynamic scheduling of MACCHIATO tasks across MPI ranks.
+
+Tasks are sorted longest-first by an estimated cost and handed out on demand
+through a shared counter on rank 0: a rank that finishes a task atomically
+fetches and increments the counter to claim the next one. Fast ranks keep
+taking work while a rank stuck on an expensive estimator only holds one task.
+"""
+import numpy as np
+from pprint import pprint
+import time
+
+# network metrics derived from one shared empirical covariance are scheduled together,
+# and so are the two outputs of one graphical lasso fit, the metrics of one spectrum and the entropies
+from tools.batch_connectivity import COVARIANCE_METRICS
+from tools.sparse_covariance import SPARSE_METRICS
+from tools.censoring import censored_dataset, is_censored_dataset, split_censored_dataset
+from tools.connectivity_metrics import graph_theory_dataset, is_graph_theory_dataset, split_graph_theory_dataset
+from tools.dynamic_connectivity import dynamic_dataset, is_dynamic_dataset
+from tools.timeseries_metrics import ALFF_METRICS, ENTROPY_METRICS
+SHARED_ESTIMATES = [COVARIANCE_METRICS,SPARSE_METRICS,ALFF_METRICS,ENTROPY_METRICS]
+
+# network metrics estimated across the whole cohort after every bold's task is done
+COHORT_METRICS = ['tangent']
+
+# relative per timepoint x parcel cost of each estimator
+ESTIMATOR_COST = {'correlation':1.0,
+                  'partial_correlation':1.0,
+                  'covariance':1.0,
+                  'precision':1.0,
+                  'tangent':2.0,
+                  'dynamic_time_warping':50.0,
+                  'sparse_inverse_covariance':100.0,
+                  'sparse_inverse_precision':100.0,
+                  'alff':0.5,
+                  'falff':0.5,
+                  'wavelet':2.0,
+                  'sample_entropy':20.0,
+                  'multiscale_entropy':20.0}
+
+# per timepoint x parcel cost of sliding windows, every frame enters and leaves the window sums once
+DYNAMIC_COST = 2.0
+
+# relative per parcels x parcels cost of each graph theory metric
+GRAPH_THEORY_COST = {'strength':0.01,
+                     'eigenvector_centrality':1.0,
+                     'clustering_coefficient':1.0,
+                     'local_efficiency':20.0,
+                     'node_betweenness_centrality':20.0,
+                     'edge_betweenness_centrality':20.0}
+
+def group_network_metrics(network_metrics,graph_theory_metrics=None,time_series_metrics=None,fd_thresholds=None,dynamic_metrics=None):
+    '''
+    Splits the requested network metrics into task groups: the covariance
+    family shares one task, so do the sparse metrics, every other estimator gets
+    its own. Cohort metrics are not per-bold tasks. Graph theory datasets of a
+    network metric join its task, so they are computed from the matrices in memory.
+    Time series metrics computed from one spectrum (ALFF and fALFF) share a task, so do
+    sample and multiscale entropy, the other time series metrics get their own.
+    Censored covariance family datasets of every FD threshold join the covariance
+    family task, so the frames are parcellated once for all thresholds. Sliding-window
+    datasets join it too, or get a task of their own without covariance family metrics.
+
+    Returns
+    -------
+    list of tuples
+    '''
+    groups = []
+    for family in SHARED_ESTIMATES:
+        family_group = tuple(m for m in network_metrics if m in family)
+        if family_group:
+            groups.append(family_group)
+    shared = [m for family in SHARED_ESTIMATES for m in family]
+    groups.extend((m,) for m in network_metrics if not m in shared and not m in COHORT_METRICS)
+    if graph_theory_metrics:
+        groups = [group + tuple(graph_theory_dataset(m,g) for m in group for g in graph_theory_metrics) for group in groups]
+    if fd_thresholds:
+        groups = [group + tuple(censored_dataset(t,m) for t in fd_thresholds for m in group if m in COVARIANCE_METRICS) for group in groups]
+    if dynamic_metrics:
+        dynamic_group = tuple(dynamic_dataset(m) for m in dynamic_metrics)
+        covariance_groups = [k for k, group in enumerate(groups) if any(m in COVARIANCE_METRICS for m in group)]
+        if covariance_groups:
+            groups[covariance_groups[0]] += dynamic_group
+        else:
+            groups.append(dynamic_group)
+    if time_series_metrics:
+        for family in (ALFF_METRICS,ENTROPY_METRICS):
+            family_group = tuple(m for m in family if m in time_series_metrics)
+            if family_group:
+                groups.append(family_group)
+        groups.extend((m,) for m in time_series_metrics if not m in ALFF_METRICS + ENTROPY_METRICS)
+    return groups
+
+def estimate_task_cost(n_timepoints,n_parcels,network_metrics):
+    '''
+    Cost estimate of one task: timepoints x parcels (or grayordinates, for time series
+    metrics computed per grayordinate) x estimator weight. Metrics of the
+    covariance family, or the sparse family, share one estimate, so only the most
+    expensive of them counts. Graph theory metrics add parcels x parcels x their weight,
+    every censored FD threshold one more covariance estimate and sliding windows
+    DYNAMIC_COST per windowed metric.
+    '''
+    graph_theory_costs = [GRAPH_THEORY_COST.get(split_graph_theory_dataset(m)[1],1.0) for m in network_metrics if is_graph_theory_dataset(m)]
+    fd_thresholds = set(split_censored_dataset(m)[0] for m in network_metrics if is_censored_dataset(m))
+    dynamic_costs = [DYNAMIC_COST for m in network_metrics if is_dynamic_dataset(m)]
+    network_metrics = [m for m in network_metrics if not is_graph_theory_dataset(m) and not is_censored_dataset(m) and not is_dynamic_dataset(m)]
+    costs = [ESTIMATOR_COST.get(m,1.0) for m in network_metrics]
+    if costs and any(all(m in family for m in network_metrics) for family in SHARED_ESTIMATES):
+        costs = [max(costs)]
+    censored_costs = [ESTIMATOR_COST['covariance']]*len(fd_thresholds)
+    return float(n_timepoints)*n_parcels*sum(costs + censored_costs + dynamic_costs) + float(n_parcels)*n_parcels*sum(graph_theory_costs)
+
+def batch_tasks(tasks,costs,bold_timepoints,batch_size):
+    '''
+    Merges tasks of covariance derived metrics (and their graph theory, censored and sliding-window datasets) into
+    batches of up to batch_size bolds that are estimated together by the batch
+    connectivity engine. Bolds are batched in order of length so batches need little
+    padding. Other tasks keep a single bold.
+
+    Parameters
+    ----------
+    tasks : list of tuples
+        (bold index, tuple of network metrics)
+    costs : list
+        Estimated cost of every task
+    bold_timepoints : list
+        Number of timepoints of every bold
+    batch_size : int
+        Maximum number of bolds per batch
+
+    Returns
+    -------
+    tasks : list of tuples
+        (tuple of bold indices, tuple of network metrics)
+    costs : list
+    '''
+    batched_tasks = []
+    batched_costs = []
+    batchable = {}
+    for (i, network_metrics), cost in zip(tasks,costs):
+        if batch_size > 1 and all(m in COVARIANCE_METRICS for m in network_metrics
+                                  if not is_graph_theory_dataset(m) and not is_censored_dataset(m) and not is_dynamic_dataset(m)):
+            batchable.setdefault(network_metrics,[]).append((bold_timepoints[i],i,cost))
+        else:
+            batched_tasks.append(((i,),network_metrics))
+            batched_costs.append(cost)
+    for network_metrics, members in batchable.items():
+        members.sort()
+        for start in range(0,len(members),batch_size):
+            batch = members[start:start+batch_size]
+            batched_tasks.append((tuple(i for timepoints, i, cost in batch),network_metrics))
+            batched_costs.append(sum(cost for timepoints, i, cost in batch))
+    return batched_tasks, batched_costs
+
+class TaskScheduler:
+    def __init__(self,comm,tasks,costs):
+        '''
+        Parameters
+        ----------
+        comm : mpi4py.MPI.Comm
+            Communicator over which tasks are shared. Every rank must pass identical tasks and costs.
+        tasks : list
+            Picklable task descriptions
+        costs : list
+            Estimated cost of every task, tasks are handed out in decreasing cost
+
+        Returns
+        -------
+        None.
+
+        '''
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.comm = comm
+        self.rank = comm.rank
+        order = sorted(range(len(tasks)),key=lambda i: (-costs[i],i))
+        self.tasks = [tasks[i] for i in order]
+        self.costs = [costs[i] for i in order]
+        # shared task counter lives on rank 0
+        if self.rank == 0:
+            self.counter = np.zeros(1,dtype='i8')
+        else:
+            self.counter = np.zeros(0,dtype='i8')
+        self.window = self.MPI.Win.Create(self.counter,disp_unit=self.counter.itemsize,comm=comm)
+        self.busy_time = 0.0
+        self.completed_tasks = 0
+        self.completed_cost = 0.0
+        self.start_time = time.time()
+
+    def next_task_index(self):
+        increment = np.ones(1,dtype='i8')
+        task_index = np.zeros(1,dtype='i8')
+        self.window.Lock(0)
+        self.window.Fetch_and_op([increment,self.MPI.INT64_T],[task_index,self.MPI.INT64_T],0,0,self.MPI.SUM)
+        self.window.Unlock(0)
+        return int(task_index[0])
+
+    def __iter__(self):
+        while True:
+            task_index = self.next_task_index()
+            if task_index >= len(self.tasks):
+                break
+            task_start = time.time()
+            yield self.tasks[task_index]
+            self.busy_time += time.time() - task_start
+            self.completed_tasks += 1
+            self.completed_cost += self.costs[task_index]
+
+    def report(self):
+        '''
+        Gathers per-rank utilization to rank 0 and prints it. Collective: every rank must call it
+        once its loop over the scheduler has finished.
+
+        Returns
+        -------
+        list of dict or None
+            Per-rank utilization on rank 0, None on the other ranks
+        '''
+        self.comm.Barrier()
+        wall_time = time.time() - self.start_time
+        self.window.Free()
+        utilization = self.comm.gather({'rank':self.rank,
+                                        'tasks':self.completed_tasks,
+                                        'estimated_cost':self.completed_cost,
+                                        'busy_time':self.busy_time,
+                                        'wall_time':wall_time},root=0)
+        if self.rank == 0:
+            pprint("============================================================================")
+            pprint(" Per-rank utilization")
+            for rank_utilization in utilization:
+                pprint(" rank %d: %d tasks, busy %.1f s of %.1f s (%.0f%%)"
+                       % (rank_utilization['rank'],rank_utilization['tasks'],rank_utilization['busy_time'],
+                          rank_utilization['wall_time'],100*rank_utilization['busy_time']/max(rank_utilization['wall_time'],1e-9)))
+        return utilization